@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0006_archiveprofile_top_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivepost',
+            name='_text_rendered',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivepost',
+            name='_text_rendered_version',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0007_archivepost_rendered_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivepost',
+            name='_text_plain',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+from forum.topic_tree import build_topic_links
+
+
+def build_closure_table(apps, schema_editor):
+    """Fill the closure table for the existing topics (same as "python manage.py rebuild_topic_tree")."""
+    ArchiveTopic = apps.get_model('archive', 'ArchiveTopic')
+    ArchiveTopicClosure = apps.get_model('archive', 'ArchiveTopicClosure')
+    db_alias = schema_editor.connection.alias
+    parents = dict(ArchiveTopic.objects.using(db_alias).values_list('id', 'parent_id'))
+    ArchiveTopicClosure.objects.using(db_alias).bulk_create(
+        (ArchiveTopicClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth) for ancestor_id, descendant_id, depth in build_topic_links(parents)),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0008_archivepost_plain_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveTopicClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='archive.archivetopic')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='archive.archivetopic')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='archive_arc_descend_fe3f52_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_archive_topic_closure')],
+            },
+        ),
+        migrations.RunPython(build_closure_table, migrations.RunPython.noop),
+    ]
@@ -5,16 +5,17 @@ from django.contrib.auth.models import User
 from django.utils.timezone import now, make_aware, is_naive
 from django.utils.text import slugify
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from collections import deque
 import os
 import uuid
 from django.utils import timezone
 from precise_bbcode.models import SmileyTag
 import datetime
-from django.db.models import Count, Sum
+from django.db.models import Count, Sum, F
 import re
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
+from forum.bbcode_render import update_rendered_field, get_rendered_field, get_plain_field, render_plaintext, get_cached_render
+from forum.topic_tree import TopicTreeMixin, TopicClosureBase
 
 # def profile_picture_upload_path(instance, filename):
 #     """Generate a file path with username, original filename, and a 4-character UUID"""
@@ -116,57 +117,7 @@ def strip_bbcode(text: str) -> str:
     - [spoiler] content is replaced by black square emojis (1 per 3 chars).
     - Styling tags are removed.
     """
-    if not isinstance(text, str):
-        return ""
-
-    # Spoiler tag handler function
-    def replace_spoiler_with_emojis(match):
-        content = match.group(1)
-        # Calculate the number of emojis: 1 for every 3 characters
-        num_emojis = len(content) // 3
-        return '⬛' * num_emojis
-
-    # [spoiler=title]content[/spoiler] -> black square emojis
-    # This must be run first as it captures and replaces content.
-    text = re.sub(
-        r'\[spoiler(?:=.*?)?\](.*?)\[/spoiler\]',
-        replace_spoiler_with_emojis,
-        text,
-        flags=re.DOTALL | re.IGNORECASE
-    )
-
-    # [hr] -> horizontal line
-    text = re.sub(r'\[hr\]', '\n--------\n', text, flags=re.IGNORECASE)
-
-    # [youtube] and [yt] -> YouTube link
-    text = re.sub(r'\[youtube\](.*?)\[/youtube\]', r'https://www.youtube.com/watch?v=\1', text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r'\[yt\](.*?)\[/yt\]', r'https://www.youtube.com/watch?v=\1', text, flags=re.DOTALL | re.IGNORECASE)
-
-    # [quote=author]content[/quote] -> > content
-    # Replace opening quote tag with "> "
-    text = re.sub(r'\[quote(?:=.*?)?\]', '> ', text, flags=re.IGNORECASE | re.DOTALL)
-    # Remove closing quote tag completely
-    text = re.sub(r'\[/quote\]', '', text, flags=re.IGNORECASE | re.DOTALL)
-
-    # List of tags to be stripped, keeping the content.
-    tags_to_strip = [
-        'font', 'size', 'pxsize', 'color', 'justify', 'code', 'marquee', 'rawtext',
-        'b', 'i', 'u', 's', 'url', 'email', 'img', 'list', 'li', r'\*', 
-        'code', 'center'
-    ]
-
-    # Build a single regex to remove all the tags in the list.
-    tag_names = '|'.join(tags_to_strip)
-    pattern = r'\[/?(' + tag_names + r')(?:=[^\]]*)?\]'
-    text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.DOTALL)
-
-    # Clean up artifacts like a ">" followed by a newline and then text.
-    text = re.sub(r'>\s*\n', '> ', text)
-
-    # Trim leading/trailing whitespace from the whole text
-    text = text.strip()
-
-    return text
+    return render_plaintext(text)
 
 TYPE_CHOICES = (
     ("pacifist", "Pacifiste"),
@@ -303,6 +254,11 @@ class ArchiveProfile(models.Model):
                     return top_group
             return ArchiveForumGroup.objects.order_by('-priority').last()  # Return default group if none exists (lowest priority)
     
+    @property
+    def get_signature_html(self):
+        """Get the rendered HTML of the signature (rendered once for all the posts of a page, see get_cached_render)."""
+        return get_cached_render(self, 'signature')
+
     @property
     def get_group_color(self):
         if not self.name_color:
@@ -475,6 +431,9 @@ class ArchivePost(models.Model):
     author = models.ForeignKey(FakeUser, on_delete=models.SET_NULL, related_name="archive_posts", null=True, blank=True, db_constraint=False)
     topic = models.ForeignKey('ArchiveTopic', on_delete=models.CASCADE, related_name="archive_replies", null=True, blank=True)
     text = models.TextField(max_length=6553500, default="DEFAULT POST TEXT")
+    _text_rendered = models.TextField(null=True, blank=True, editable=False) # Rendered HTML of the text, see forum/bbcode_render.py
+    _text_rendered_version = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    _text_plain = models.TextField(null=True, blank=True, editable=False) # Plain text of the text, for the previews and notifications
     created_time = models.DateTimeField()
     updated_time = models.DateTimeField(null=True, blank=True)
     update_count = models.IntegerField(default=0, null=True)
@@ -506,16 +465,24 @@ class ArchivePost(models.Model):
     
     @property
     def get_raw_text(self):
-        """Get the raw text of this post, without bbcode tags using the strip_bbcode function, and shortens it."""
-        # Use the strip_bbcode function to remove BBCode tags
-        return strip_bbcode(self.text)
+        """Get the raw text of this post, without bbcode tags (see strip_bbcode)."""
+        # Stored at save time, see forum/bbcode_render.py
+        return get_plain_field(self, 'text')
     
     @property
     def get_absolute_url(self):
         return f"/archive/p{self.id}"
 
+    @property
+    def get_text_html(self):
+        """Get the rendered HTML of the post (stored at save time)."""
+        return get_rendered_field(self, 'text')
+
     def save(self, *args, **kwargs):
 
+        # Render the BBCode once here instead of on every page view
+        update_rendered_field(self, 'text', kwargs)
+
         # If this is a new post
         if self.pk is None:
             #print(f"New post {self} created")
@@ -547,17 +514,6 @@ class ArchivePost(models.Model):
             #         #print("No messages found")
             #         pass
 
-            # Increment total_replies for all ancestor topics and the topic itself
-            if self.topic:
-                current = self.topic
-                while current.parent is not None:
-                    current.total_replies += 1
-                    current.save()
-                    #print(f"Total replies for {current} incremented to {current.total_replies}")
-                    current = current.parent
-                current.total_replies += 1
-                current.save()
-
             # Check if author now has enough messages to be promoted to a new group
             if self.author:
                 if hasattr(self.author, 'archiveprofile'):
@@ -571,17 +527,17 @@ class ArchivePost(models.Model):
 
             # Update the topic's latest message
             super().save(*args, **kwargs) # Save the post first
-            current_topic = self.topic
-            counter = 1
-            while current_topic:
-                # Update the topic's latest message to this post
-                current_topic.latest_message = self
-                current_topic.last_message_time = self.created_time
-                current_topic.save()
-                print(f"Latest message for {current_topic} updated to {self} at {self.created_time} (pass {counter})")
-                # Update the parents subforums as well
-                current_topic = current_topic.parent
-                counter += 1
+            if self.topic:
+                # Increment total_replies and update the latest message for the topic and all its ancestors, in one UPDATE
+                ArchiveTopic.objects.filter(id__in=ArchiveTopicClosure.objects.filter(descendant_id=self.topic_id).values('ancestor_id')).update(
+                    total_replies=F('total_replies') + 1,
+                    latest_message=self,
+                    last_message_time=self.created_time,
+                )
+                self.topic.total_replies += 1
+                self.topic.latest_message = self
+                self.topic.last_message_time = self.created_time
+                print(f"Latest message for {self.topic} and its parents updated to {self} at {self.created_time}")
 
         # If this is an edit
         else:
@@ -594,7 +550,8 @@ class ArchivePost(models.Model):
     def __str__(self):
         return f"{self.author}'s reply on {self.topic}"
 
-class ArchiveTopic(models.Model):
+class ArchiveTopic(TopicTreeMixin, models.Model):
+    closure_model_name = 'ArchiveTopicClosure' # see forum/topic_tree.py
     id = models.IntegerField(primary_key=True)
     author = models.ForeignKey(FakeUser, on_delete=models.SET_NULL, related_name="archive_topics", null=True, blank=True, db_constraint=False)
     title = models.CharField(max_length=6000, null=True, blank=True)
@@ -637,17 +594,8 @@ class ArchiveTopic(models.Model):
             return self.latest_message
         else:
             if self.is_sub_forum:
-                # Collect all descendant topics including self using BFS
-                all_topics = []
-                queue = deque([self])
-
-                while queue:
-                    current_topic = queue.popleft()
-                    all_topics.append(current_topic)
-                    queue.extend(current_topic.archive_children.all())
-
-                # Get the latest post from all collected topics
-                latest_post = ArchivePost.objects.filter(topic__in=all_topics).order_by('-created_time').first()
+                # Get the latest post from this subforum and all the topics under it
+                latest_post = ArchivePost.objects.filter(topic__in=ArchiveTopicClosure.objects.filter(ancestor_id=self.id).values('descendant_id')).order_by('-created_time').first()
                 self.latest_message = latest_post
                 self.save() # Save the topic to update the latest_message field
                 return latest_post
@@ -662,21 +610,9 @@ class ArchiveTopic(models.Model):
     @property
     def get_tree(self):
         """Get the tree of topics starting from its parent, then its parent's parent, and stop at the root topic."""
-        tree = {}
-        if self.is_sub_forum: # this is because xooit is weird and the tree structure is different for sub forums, they include themselves in the tree but not the topics
-            current = self
-        else:
-            current = self.parent
-        while current:
-            if current not in tree:
-                tree[current] = []
-            if current.parent:
-                if current.parent not in tree:
-                    tree[current.parent] = [current]
-                else:
-                    tree[current.parent].append(current)
-            current = current.parent
-        return {parent: children for parent, children in reversed(tree.items())} # Reverse the tree so that the root topic is at the left
+        # this is because xooit is weird and the tree structure is different for sub forums, they include themselves in the tree but not the topics
+        chain = list(self.ancestors(include_self=self.is_sub_forum)) # from the root topic, so that it is at the left
+        return {topic: chain[index + 1:index + 2] for index, topic in enumerate(chain)}
     
     @property
     def get_absolute_url(self):
@@ -697,12 +633,7 @@ class ArchiveTopic(models.Model):
     @property
     def get_depth(self):
         """Get the depth of this topic in the tree."""
-        depth = 0
-        current = self
-        while current.parent:
-            depth += 1
-            current = current.parent
-        return depth
+        return self.ancestor_links.filter(depth__gt=0).count()
     
     @property
     def get_max_page(self):
@@ -756,17 +687,8 @@ class ArchiveTopic(models.Model):
     def get_latest_message_before(self, before_datetime=None):
         """Get the latest message in this topic before a given date."""
         if self.is_sub_forum:
-            # Collect all descendant topics including self using BFS
-            all_topics = []
-            queue = deque([self])
-
-            while queue:
-                current_topic = queue.popleft()
-                all_topics.append(current_topic)
-                queue.extend(current_topic.archive_children.all())
-
-            # Get the latest post from all collected topics
-            latest_post = ArchivePost.objects.filter(topic__in=all_topics, created_time__lte=before_datetime).order_by('-created_time').first()
+            # Get the latest post from this subforum and all the topics under it
+            latest_post = ArchivePost.objects.filter(topic__in=ArchiveTopicClosure.objects.filter(ancestor_id=self.id).values('descendant_id'), created_time__lte=before_datetime).order_by('-created_time').first()
             return latest_post
         
         else:
@@ -861,6 +783,23 @@ class ArchiveTopic(models.Model):
                 return f"{self.title} by {self.author}"
 
 
+class ArchiveTopicClosure(TopicClosureBase):
+    """One (ancestor, descendant) pair of the archived subforums tree, see forum/topic_tree.py."""
+    ancestor = models.ForeignKey(ArchiveTopic, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(ArchiveTopic, on_delete=models.CASCADE, related_name='ancestor_links')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_archive_topic_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id} ({self.depth})"
+
+
 class ArchiveForum(models.Model):
     name = models.CharField(max_length=2000)
     announcement_topics = models.ManyToManyField('ArchiveTopic', blank=True, related_name="archive_announcement_topics")
@@ -3,7 +3,7 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout
 from forum.forms import UserRegisterForm, ProfileForm, NewTopicForm, NewPostForm, QuickReplyForm, MemberSortingForm, UserEditForm, RecentTopicsForm, RecentPostsForm, PollForm, PollVoteFormUnique, PollVoteFormMultiple
-from .models import ArchiveProfile, ArchiveForumGroup, User, ArchiveCategory, ArchivePost, ArchiveTopic, ArchiveForum, ArchiveTopicReadStatus, ArchiveSmileyCategory, ArchivePoll, ArchivePollOption, FakeUser
+from .models import ArchiveProfile, ArchiveForumGroup, User, ArchiveCategory, ArchivePost, ArchiveTopic, ArchiveTopicClosure, ArchiveForum, ArchiveTopicReadStatus, ArchiveSmileyCategory, ArchivePoll, ArchivePollOption, FakeUser
 from django.contrib.auth.forms import AuthenticationForm
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
@@ -81,33 +81,12 @@ def get_descendants_map(subforum_ids):
         return {}
 
     descendants_map = {sf_id: [] for sf_id in subforum_ids}
-    
-    # Get all topics that have a parent in the subforum list
-    all_topics = ArchiveTopic.objects.all().select_related('parent')
-    topic_dict = {topic.id: topic for topic in all_topics}
-    
-    parent_child_map = {}
-    for topic in all_topics:
-        if topic.parent_id:
-            if topic.parent_id not in parent_child_map:
-                parent_child_map[topic.parent_id] = []
-            parent_child_map[topic.parent_id].append(topic)
 
-    for sf_id in subforum_ids:
-        queue = list(parent_child_map.get(sf_id, []))
-        visited = set(t.id for t in queue)
-        
-        while queue:
-            current_topic = queue.pop(0)
-            descendants_map[sf_id].append(current_topic)
-            
-            # If the current topic is a subforum, add its children to the queue
-            if current_topic.id in parent_child_map:
-                for child in parent_child_map[current_topic.id]:
-                    if child.id not in visited:
-                        queue.append(child)
-                        visited.add(child.id)
-                        
+    # One query for all the subtrees (see forum/topic_tree.py), level by level like a BFS
+    links = ArchiveTopicClosure.objects.filter(ancestor_id__in=subforum_ids, depth__gt=0).select_related('descendant').order_by('depth', 'descendant_id')
+    for link in links:
+        descendants_map[link.ancestor_id].append(link.descendant)
+
     return descendants_map
 
 def get_message_frequency(message_count, date_joined, date_now=None):
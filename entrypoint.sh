@@ -18,5 +18,8 @@ python manage.py createcachetable
 # Collect static files
 python manage.py collectstatic --noinput
 
+# The async views of the hottest pages (see forum/views_async.py)
+export ASYNC_VIEWS="${ASYNC_VIEWS:-True}"
+
 # Start Daphne ASGI server
 exec daphne -b 0.0.0.0 -p 8000 --proxy-headers utf.asgi:application
\ No newline at end of file
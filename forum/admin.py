@@ -258,6 +258,12 @@ class TopicReadStatusAdmin(admin.ModelAdmin):
         return "N/A"
     topic_link.short_description = "Topic"
 
+@admin.register(models.ReadWatermark)
+class ReadWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('user', 'category', 'subforum', 'read_before')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user', 'subforum')
+
 @admin.register(models.SmileyCategory)
 class SmileyCategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'smiley_count')
@@ -215,6 +215,19 @@ class PostBaseSerializer(PostMiniSerializer):
             "text"
         ]
 
+class PostSearchSerializer(PostBaseSerializer):
+    """Search results (the snippet has the searched words in span.posthilit)."""
+    topic = TopicBaseSerializer(read_only=True)
+    snippet = serializers.SerializerMethodField()
+
+    def get_snippet(self, obj):
+        return getattr(obj, 'search_snippet', None)
+
+    class Meta(PostBaseSerializer.Meta):
+        fields = PostBaseSerializer.Meta.fields + [
+            "topic", "snippet"
+        ]
+
 
 
 # --- Category Serializers ---
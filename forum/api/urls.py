@@ -11,4 +11,5 @@ urlpatterns = [
     path('post_details/<int:postid>/', views.post_details, name='api-post-details'),
     path('category/<int:categoryid>/', views.category, name='api-category'),
     path('category_details/<int:categoryid>/', views.category_details, name='api-category-details'),
+    path('search/', views.search, name='api-search'),
 ]
\ No newline at end of file
@@ -4,6 +4,7 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from django.core.paginator import Paginator
+from ..search import get_search_backend
 
 @api_view(['GET'])
 def posts_list(request): # This is a test endpoint to make sure the API is working
@@ -106,3 +107,50 @@ def category_details(request, categoryid):
     serializer._pagination_info = pagination_info
     
     return Response(serializer.data)
+
+@api_view(['GET'])
+def search(request):
+    """Search the posts with the full-text index (see forum/search.py), by time or by relevance."""
+    keyword = request.query_params.get('keyword', '').strip()
+    if not keyword:
+        return Response({"detail": "Keyword is required."}, status=status.HTTP_400_BAD_REQUEST)
+    search_terms = request.query_params.get('search_terms', 'any')
+    search_fields = request.query_params.get('search_fields', 'all')
+    sort_by = request.query_params.get('sort_by', 'relevance')
+
+    page = request.query_params.get('page', 1)
+    page_size = int(request.query_params.get('page_size', 15))
+    max_page_size = 75
+
+    if page_size > max_page_size:
+        page_size = max_page_size
+
+    search_backend = get_search_backend()
+    all_posts = search_backend.filter(Post.objects.filter(author__profile__is_hidden=False), keyword, search_terms, search_fields)
+    if sort_by == 'relevance':
+        all_posts = search_backend.annotate_rank(all_posts, keyword, search_terms, search_fields).order_by('-search_rank', '-id')
+    else:
+        all_posts = all_posts.order_by('-id')
+    paginator = Paginator(all_posts.select_related('topic', 'author', 'author__profile'), page_size)
+
+    try:
+        current_page = int(page)
+        posts_page = paginator.page(current_page)
+    except:
+        current_page = 1
+        posts_page = paginator.page(1)
+
+    posts = list(posts_page.object_list)
+    snippets = search_backend.get_snippets([post.id for post in posts], keyword, search_terms, search_fields)
+    for post in posts:
+        post.search_snippet = snippets.get(post.id)
+
+    return Response({
+        'results': PostSearchSerializer(posts, many=True).data,
+        'current_page': current_page,
+        'total_pages': paginator.num_pages,
+        'total_items': paginator.count,
+        'page_size': page_size,
+        'has_next': posts_page.has_next(),
+        'has_previous': posts_page.has_previous(),
+    })
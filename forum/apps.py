@@ -8,6 +8,11 @@ def register_bbcode_tags(sender, **kwargs):
     from forum import bbcode_tags
     bbcode_tags.register_all()
 
+def check_search_index(sender, using='default', **kwargs):
+    # The triggers of the SQLite full-text index are lost when a migration remakes forum_post (see forum/search.py)
+    from forum.search import ensure_search_triggers
+    ensure_search_triggers(using)
+
 class ForumConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'forum'
@@ -15,4 +20,5 @@ class ForumConfig(AppConfig):
     def ready(self):
         # Connect to post_migrate signal instead of importing directly
         post_migrate.connect(register_bbcode_tags, sender=self)
+        post_migrate.connect(check_search_index, sender=self)
         import forum.signals  # Ensure signals are imported
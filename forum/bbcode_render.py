@@ -0,0 +1,171 @@
+# forum/bbcode_render.py
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+from precise_bbcode.bbcode import get_parser
+
+# Posts, signatures and PMs keep their rendered HTML in the database (the same idea as the _<name>_rendered
+# column of precise_bbcode's BBCodeTextField), so topic pages don't have to re-parse everything on every view.
+# Each stored render is tagged with the version below, and "python manage.py rerender_bbcode" re-renders the rows
+# that don't match it anymore. Posts and PMs also keep their plain text (_text_plain, see render_plaintext()) for the
+# previews and notifications, under the same version.
+
+# Bump this when the rendering code itself changes (parser, custom tags in bbcode_tags.py...).
+# Changes to the tags or smilies stored in the database are picked up automatically by get_render_version().
+BBCODE_RENDER_VERSION = 3
+
+_render_version = None
+
+# Renders of the texts that are displayed many times on the same page (the signatures: once per post of their author),
+# see get_cached_render(). They are kept in this process (the most recently used ones) and in the Django cache.
+RENDER_CACHE_SIZE = 1000
+RENDER_CACHE_TIMEOUT = 60*60*12
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+
+def get_render_version():
+    """Get a short string identifying the current rendering pipeline (code version + loaded tags + smilies)."""
+    global _render_version
+    if _render_version is None:
+        parser = get_parser()
+        digest = hashlib.sha1(str(BBCODE_RENDER_VERSION).encode('utf-8'))
+        for tag_name in sorted(parser.bbcodes):
+            tag = parser.bbcodes[tag_name]
+            digest.update(f"{tag_name}|{type(tag).__module__}.{type(tag).__name__}|{tag.definition_string}|{tag.format_string}\n".encode('utf-8'))
+        for code, html in sorted(parser.smilies.items()):
+            digest.update(f"{code}|{html}\n".encode('utf-8'))
+        _render_version = f"{BBCODE_RENDER_VERSION}-{digest.hexdigest()[:12]}"
+    return _render_version
+
+
+def reset_render_version(*args, **kwargs):
+    """Forget the cached version, so the next call recomputes it. Connected to the BBCodeTag/SmileyTag signals."""
+    global _render_version
+    _render_version = None
+
+
+def render_bbcode(text):
+    """Render a text the same way the templates do with the bbcode filter"""
+    if not text:
+        return mark_safe("")
+    return mark_safe(get_parser().render(text))
+
+
+def render_plaintext(text):
+    """
+    Get the plain text of a BBCode text: spoilers become black squares, quotes become "> " blocks, youtube tags
+    become links and the other tags are removed (see the render_plaintext methods of the tags in bbcode_tags.py)
+    """
+    if not isinstance(text, str):
+        return ""
+    text = get_parser().render_plaintext(text)
+    # Clean up artifacts like a ">" followed by a newline and then text.
+    text = re.sub(r'>\s*\n', '> ', text)
+    return text.strip()
+
+
+def update_rendered_field(instance, field_name, save_kwargs, force=True):
+    """
+    Fill the _<field_name>_rendered and _<field_name>_rendered_version columns of an instance before it is saved
+    (and _<field_name>_plain if the model has it).
+    If the save only touches some fields (update_fields), the render is only done when field_name is one of them.
+    If force is False, the render is skipped when the stored version is already the current one.
+    """
+    rendered_field = f"_{field_name}_rendered"
+    version_field = f"_{field_name}_rendered_version"
+
+    update_fields = save_kwargs.get('update_fields')
+    if update_fields is not None and field_name not in update_fields:
+        return
+    if not force and getattr(instance, version_field) == get_render_version():
+        return
+
+    setattr(instance, rendered_field, str(render_bbcode(getattr(instance, field_name))))
+    setattr(instance, version_field, get_render_version())
+    updated_fields = [rendered_field, version_field]
+
+    plain_field = f"_{field_name}_plain"
+    if hasattr(instance, plain_field):
+        setattr(instance, plain_field, render_plaintext(getattr(instance, field_name)))
+        updated_fields.append(plain_field)
+
+    if update_fields is not None:
+        save_kwargs['update_fields'] = list(update_fields) + updated_fields
+
+
+def get_rendered_field(instance, field_name, cached=False):
+    """
+    Get the stored HTML of a field, or render it on the fly if it is missing or was rendered with an old version.
+    If cached is True, the on the fly render goes through get_cached_render() (for the signatures).
+    """
+    rendered = getattr(instance, f"_{field_name}_rendered")
+    if rendered is not None and getattr(instance, f"_{field_name}_rendered_version") == get_render_version():
+        return mark_safe(rendered)
+    if cached:
+        return get_cached_render(instance, field_name)
+    return render_bbcode(getattr(instance, field_name))
+
+
+def get_render_cache_key(instance, field_name, text):
+    """Get the cache key of the render of a text, for a field of an instance (the text is hashed, so an edited text gets a new key)"""
+    text_hash = hashlib.sha1((text or "").encode('utf-8')).hexdigest()[:16]
+    return f"bbcode_render_{instance._meta.label_lower}_{instance.pk}_{field_name}_{text_hash}_{get_render_version()}"
+
+
+def get_cached_render(instance, field_name):
+    """
+    Render a field of an instance, at most once per process for a given text: a topic page shows the signature of an
+    author under each of their posts, so it is rendered for the first one and taken from the cache for the others.
+    """
+    text = getattr(instance, field_name)
+    key = get_render_cache_key(instance, field_name, text)
+
+    with _render_cache_lock:
+        rendered = _render_cache.get(key)
+        if rendered is not None:
+            _render_cache.move_to_end(key)
+            return mark_safe(rendered)
+
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = str(render_bbcode(text))
+        cache.set(key, rendered, RENDER_CACHE_TIMEOUT)
+    _store_cached_render(key, rendered)
+    return mark_safe(rendered)
+
+
+def update_cached_render(instance, field_name, old_text=None):
+    """Put the new render of an edited field in the cache, and drop the render of its old text (called on save)."""
+    if old_text is not None:
+        old_key = get_render_cache_key(instance, field_name, old_text)
+        with _render_cache_lock:
+            _render_cache.pop(old_key, None)
+        cache.delete(old_key)
+
+    rendered = getattr(instance, f"_{field_name}_rendered", None)
+    if rendered is None:
+        rendered = str(render_bbcode(getattr(instance, field_name)))
+    key = get_render_cache_key(instance, field_name, getattr(instance, field_name))
+    cache.set(key, rendered, RENDER_CACHE_TIMEOUT)
+    _store_cached_render(key, rendered)
+
+
+def _store_cached_render(key, rendered):
+    with _render_cache_lock:
+        _render_cache[key] = rendered
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+
+def get_plain_field(instance, field_name):
+    """Get the stored plain text of a field, or compute it on the fly if it is missing or was made with an old version."""
+    plain = getattr(instance, f"_{field_name}_plain")
+    if plain is not None and getattr(instance, f"_{field_name}_rendered_version") == get_render_version():
+        return plain
+    return render_plaintext(getattr(instance, field_name))
@@ -1,6 +1,8 @@
 # forum/bbcode_tags.py
 
 import re
+import urllib.parse
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from precise_bbcode.bbcode.tag import BBCodeTag
 from precise_bbcode.tag_pool import tag_pool
@@ -21,6 +23,9 @@ class CustomQuoteTag(BBCodeTag):
         '</table>'
     )
 
+    def render_plaintext(self, parser, token, content=None):
+        return '> ' if token.is_start_tag else ''
+
 # This doesn't work yet but it should
 class CustomQuoteTagUnnamed(BBCodeTag):
     name = 'quoteunnamed'
@@ -46,6 +51,13 @@ class YoutubeTag(BBCodeTag):
         'frameborder="0" allowfullscreen></iframe>'
     )
 
+    plaintext_content = True
+
+    def render_plaintext(self, parser, token, content=None):
+        if content is None:
+            return None
+        return 'https://www.youtube.com/watch?v=' + parser.render_plaintext(content)
+
 class FontTag(BBCodeTag):
     name = 'font'
     definition_string = '[font={TEXT}]{TEXT1}[/font]'
@@ -56,28 +68,41 @@ class SizeTag(BBCodeTag):
     definition_string = '[size={TEXT}]{TEXT1}[/size]'
     format_string = '<font size="{TEXT}">{TEXT1}</font>'
 
-#  ====== The video embed tag has been replaced to video_tags.py, because it was too hard to make it work with precise_bbcode. ======
+def render_video(url):
+    """Get the HTML of a [video] tag, with some validation of the URL (https only, with a domain and no weird characters)"""
+    url_is_safe = False
+
+    if url.startswith('https://'):
+        # Parse the URL to validate its structure
+        parsed_url = urllib.parse.urlparse(url)
+        # Check if it has a valid netloc (domain) and no suspicious components
+        if parsed_url.netloc and not any(c in url for c in ['"', "'", '<', '>', ';', ' ', '\n']):
+            url_is_safe = True
+
+    if url_is_safe:
+        # Escape the URL to prevent XSS
+        safe_url = escape(url)
+        return f'<video controls style="max-width: 500px; max-height: 500px;" ><source src="{safe_url}" type="video/mp4"></video>'
+    else:
+        return "[URL vidéo invalide]"
+
+# The video tag used to be handled outside of precise_bbcode (process_video_tags and finalize_video_tags in templatetags.py),
+# because the URL was escaped and turned into a link before the tag could see it. Rendering the content as raw text fixes that.
+class VideoTag(BBCodeTag):
+    name = 'video'
 
-# Doesn't work yet because it puts spaces in the URL
-# class VideoEmbedTag(BBCodeTag):
-#     name = 'video'
-#     definition_string = r'[video]{TEXT}[/video]'
-#     format_string = (
-#         '<video controls width="250">'
-#         '<source src="{TEXT}" type="video/mp4"/>'
-#         '</video>'
-#     )
-#     parse_urls = False  # This tells precise_bbcode not to parse URLs inside this tag
-#     escape_html = False
-#     replace_links = False
-#     strip = False
-
-#     def render(self, value, options=None, parent=None):
-#         # No need to escape here, since we're disabling URL parsing
-#         video_html = f'<video controls width="250"><source src="{value}" type="video/mp4"/></video>'
-#         return mark_safe(video_html)
+    class Options:
+        render_embedded = False
+        escape_html = False
+        replace_links = False
+        transform_newlines = False
+        strip = True
 
+    def render(self, value, option=None, parent=None):
+        return render_video(value)
 
+    def render_plaintext(self, parser, token, content=None):
+        return None # Kept as is in the previews
 
 # class ImageWithResizeTag(BBCodeTag):
 #     name = 'img_resize'
@@ -102,6 +127,14 @@ class SpoilerTag(BBCodeTag): # TODO: [6] Fix the animation of the spoiler tag
         '</div>'
     )
 
+    plaintext_content = True
+
+    def render_plaintext(self, parser, token, content=None):
+        if content is None:
+            return None
+        # Hidden in the previews too: 1 black square for every 3 characters
+        return '⬛' * (len(content) // 3)
+
 class MarqueeTag(BBCodeTag):
     name = 'marquee'
     definition_string = '[marquee]{TEXT}[/marquee]'
@@ -153,6 +186,9 @@ class HRTag(BBCodeTag):
     class Options:
         standalone = True
 
+    def render_plaintext(self, parser, token, content=None):
+        return '\n--------\n' if token.option is None else None
+
 class NewYoutubeTag(BBCodeTag):
     name = 'yt'
     definition_string = '[yt]{TEXT}[/yt]'
@@ -160,12 +196,19 @@ class NewYoutubeTag(BBCodeTag):
         '<div style="text-align:center"><object allowscriptaccess="never" alt="http://www.youtube.com/embed/{TEXT}" controller="true" height="300" scale="aspect" standby="Loading ..." width="400"><param name="movie" value="http://www.youtube.com/embed/{TEXT}"/><param name="FileName" value="http://www.youtube.com/embed/{TEXT}"/><param name="allowScriptAccess" value="never"/><param name="stretchToFit" value="1"/><param name="AutoSize" value="0"/><param name="AutoRewind" value="True"/><param name="AutoStart" value="True"/><param name="BaseURL" value="path"/><param name="ShowControls" value="True"/><param name="ShowStatusBar" value="True"/><param name="CanSeek" value="True"/><param name="CanSeekToMarkers" value="True"/><param name="ShowTracker" value="True"/><param name="scale" value="aspect"/><param name="controller" value="true"/><param name="src" value="http://www.youtube.com/embed/{TEXT}"/><param name="target" value="myself"/><param name="width" value="400"/><param name="height" value="300"/><embed allowscriptaccess="never" alt="http://www.youtube.com/embed/{TEXT}" autorewind="True" autosize="0" autostart="True" canseek="1" canseektomarker="1" controller="true" height="300" scale="aspect" showcontrols="1" showstatusbar="1" showtracker="1" src="http://www.youtube.com/embed/{TEXT}" stretchtofit="1" target="myself" width="400"/></object><br/><a href="http://www.youtube.com/embed/{TEXT}" target="_blank">http://www.youtube.com/embed/{TEXT}</a></div>'
     )
 
+    plaintext_content = True
+
+    def render_plaintext(self, parser, token, content=None):
+        if content is None:
+            return None
+        return 'https://www.youtube.com/watch?v=' + parser.render_plaintext(content)
+
 tag_pool.register_tag(CustomQuoteTag)
 tag_pool.register_tag(CustomQuoteTagUnnamed)
 tag_pool.register_tag(YoutubeTag)
 tag_pool.register_tag(FontTag)
 tag_pool.register_tag(SizeTag)
-# tag_pool.register_tag(VideoEmbedTag)
+tag_pool.register_tag(VideoTag)
 tag_pool.register_tag(SpoilerTag)
 tag_pool.register_tag(MarqueeTag)
 tag_pool.register_tag(PxSizeTag)
@@ -0,0 +1,109 @@
+# forum/board_stats.py
+
+import time
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+# The data of the headers and sidebars (forum counters, who is online, recently active users, birthdays, latest user,
+# "Présentations" and "Règles"...) is the same for everyone, but it was rebuilt by the index view and most of the theme
+# processors on every request. get_board_stats() gives a snapshot of all of it, built at most every REFRESH_INTERVAL
+# seconds and shared through the cache. It is rebuilt by the "refresh-board-stats" Celery beat task, or by the first
+# request that finds it too old: the others keep using the old snapshot meanwhile (only one rebuild at a time).
+
+# How old the snapshot can be before it is rebuilt
+REFRESH_INTERVAL = 60 # seconds
+# How long an old snapshot is still used while it is being rebuilt (or when the rebuilds fail)
+STALE_TIMEOUT = 60 * 60 # seconds
+# How long a rebuild can take before another request tries again
+LOCK_TIMEOUT = 30 # seconds
+# How long a request waits for the first snapshot when another request is building it
+COLD_WAIT = 2 # seconds
+
+# Change the version when the content of the snapshot changes, so that the old snapshots are not used anymore
+STATS_VERSION = 1
+STATS_KEY = f"utf_forum:board_stats:v{STATS_VERSION}"
+LOCK_KEY = f"utf_forum:board_stats:v{STATS_VERSION}:lock"
+
+# The keys used by the stats header and the "who is online" block of the theme processors
+SIDEBAR_KEYS = ('utf', 'online', 'online_groups', 'online_users_by_group', 'online_users_with_groups',
+                'recently_active_users', 'creation_year', 'total_topics')
+
+
+def build_board_stats():
+    """Build the snapshot from the database (about ten queries)."""
+    from .models import Forum, Topic, User, ForumGroup
+    from .presence import get_online_users
+    from .views_context_processors import get_recently_active_users, organize_online_users_by_groups
+
+    utf, _ = Forum.objects.get_or_create(name='UTF')
+    online = list(get_online_users().select_related('profile', 'profile__top_group').prefetch_related('profile__groups'))
+    online_data = organize_online_users_by_groups(online)
+
+    today = timezone.now().date()
+    next_week = today + timezone.timedelta(days=7)
+    birthdays = User.objects.filter(profile__is_hidden=False).select_related('profile', 'profile__top_group').order_by('username')
+    birthdays_today = birthdays.filter(profile__birthdate__day=today.day, profile__birthdate__month=today.month)
+    if today.month == next_week.month:
+        birthdays_in_week = birthdays.filter(
+            profile__birthdate__month=today.month,
+            profile__birthdate__day__gte=today.day,
+            profile__birthdate__day__lte=next_week.day,
+        )
+    else:
+        birthdays_in_week = birthdays.filter(
+            Q(profile__birthdate__month=today.month, profile__birthdate__day__gte=today.day) |
+            Q(profile__birthdate__month=next_week.month, profile__birthdate__day__lte=next_week.day),
+        )
+
+    return {
+        'utf': utf,
+        'online': online,
+        'online_groups': online_data['groups'],
+        'online_users_by_group': online_data['users_by_group'],
+        'online_users_with_groups': online_data['structured_data'],
+        'recently_active_users': list(get_recently_active_users(12)),
+        'creation_year': "2025", # (the Forum has no creation date)
+        'total_topics': utf.get_total_topics,
+        'latest_user': utf.get_latest_user,
+        'groups': list(ForumGroup.objects.all()),
+        'presentations': Topic.objects.filter(is_sub_forum=True, title="Présentations").first(),
+        'regles': Topic.objects.filter(is_sub_forum=False, is_announcement=True).first(),
+        'birthdays_today': list(birthdays_today),
+        'birthdays_in_week': list(birthdays_in_week),
+    }
+
+def refresh_board_stats():
+    """Rebuild the snapshot and store it in the cache."""
+    stats = build_board_stats()
+    cache.set(STATS_KEY, {'built_at': time.time(), 'stats': stats}, STALE_TIMEOUT)
+    return stats
+
+def get_board_stats():
+    """Get the snapshot (a dict), rebuilt if it is older than REFRESH_INTERVAL seconds."""
+    entry = cache.get(STATS_KEY)
+    if entry is not None and time.time() - entry['built_at'] < REFRESH_INTERVAL:
+        return entry['stats']
+
+    # Only one request rebuilds it, the others use the old one
+    if cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+        try:
+            return refresh_board_stats()
+        finally:
+            cache.delete(LOCK_KEY)
+    if entry is not None:
+        return entry['stats']
+
+    # No snapshot at all yet: wait a bit for the request building it
+    deadline = time.monotonic() + COLD_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        entry = cache.get(STATS_KEY)
+        if entry is not None:
+            return entry['stats']
+    return build_board_stats()
+
+def get_sidebar_context():
+    """The part of the snapshot used by the stats header and the "who is online" block."""
+    stats = get_board_stats()
+    return {key: stats[key] for key in SIDEBAR_KEYS}
@@ -0,0 +1,166 @@
+# forum/log_pipeline.py
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from django.conf import settings
+
+# safe_async_log (forum/tasks.py) used to start an async_log Celery task for every call, even for the debug messages
+# of the hot views that the logging level then discarded: a broker round trip and a stored result per line. Now:
+# - the level is checked first (logger.isEnabledFor, cached by logging), so a filtered message costs nothing more;
+# - the records go to the "forum.views" logger, whose handlers (configured in LOGGING) are moved behind a bounded
+#   queue: the request only puts the record in the queue (QueueHandler), and one listener thread per process takes the
+#   waiting records by batches and writes them (BatchQueueListener). When the queue is full, the records are dropped
+#   and counted;
+# - the records at or above LOG_CELERY_LEVEL (disabled when empty) are still sent to Celery with async_log.
+# "python manage.py benchmark_logging" shows the cost of a call for each path.
+
+LOGGER_NAME = "forum.views"
+
+# Records waiting to be written, the next ones are dropped
+QUEUE_SIZE = 10000
+# Records written by the listener before flushing the handlers
+BATCH_SIZE = 100
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+_lock = threading.Lock()
+_pipeline = None
+_STOP = object() # (put in the queue to stop the listener)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops (and counts) the records when the queue is full instead of blocking or failing."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """A QueueListener that takes all the waiting records (up to BATCH_SIZE) at each wake-up, and flushes the handlers
+    once per batch. It runs its own thread with the public dequeue/handle methods."""
+
+    def __init__(self, log_queue, *handlers, batch_size=BATCH_SIZE):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.written = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="log-pipeline", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the waiting records and stop the thread. Waits for room in the queue instead of failing when it is
+        full (the thread is emptying it)."""
+        if self.thread is None:
+            return
+        while self.thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            records = [self.dequeue(True)]
+            try:
+                while len(records) < self.batch_size and records[-1] is not _STOP:
+                    records.append(self.dequeue(False))
+            except queue.Empty:
+                pass
+            for record in records:
+                if record is not _STOP:
+                    self.handle(record)
+                    self.written += 1
+                self.queue.task_done()
+            self._flush()
+            if records[-1] is _STOP:
+                return
+
+    def _flush(self):
+        for handler in self.handlers:
+            try:
+                handler.flush()
+            except Exception:
+                pass
+
+
+class LogPipeline:
+    """The queue, handler and listener of a process."""
+
+    def __init__(self, logger, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.logger = logger
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handlers = [handler for handler in logger.handlers if not isinstance(handler, DroppingQueueHandler)]
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.listener = BatchQueueListener(self.queue, *self.handlers, batch_size=batch_size)
+        logger.handlers = [self.queue_handler]
+        self.listener.start()
+
+    def stop(self):
+        """Write the waiting records, and give the handlers back to the logger."""
+        self.listener.stop()
+        self.logger.handlers = self.handlers
+
+    def get_stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.listener.written,
+            'dropped': self.queue_handler.dropped,
+        }
+
+
+def get_logger():
+    """Get the logger of the views, behind the queue of this process (started at the first call, and again in a
+    forked process)."""
+    global _pipeline
+    pipeline = _pipeline
+    if pipeline is None or pipeline.pid != os.getpid():
+        with _lock:
+            if _pipeline is None or _pipeline.pid != os.getpid():
+                logger = logging.getLogger(LOGGER_NAME)
+                if _pipeline is not None:
+                    # (forked: the listener thread of the parent doesn't exist here)
+                    logger.handlers = _pipeline.handlers
+                _pipeline = LogPipeline(logger)
+            pipeline = _pipeline
+    return pipeline.logger
+
+def stop_pipeline():
+    global _pipeline
+    with _lock:
+        if _pipeline is not None and _pipeline.pid == os.getpid():
+            _pipeline.stop()
+        _pipeline = None
+
+def get_pipeline_stats():
+    pipeline = _pipeline
+    return pipeline.get_stats() if pipeline is not None else None
+
+def get_celery_level():
+    """The level from which the records are also sent to Celery (None when disabled)."""
+    level = getattr(settings, 'LOG_CELERY_LEVEL', '')
+    return LEVELS.get(level.lower()) if level else None
+
+atexit.register(stop_pipeline)
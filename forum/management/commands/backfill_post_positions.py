@@ -0,0 +1,45 @@
+"""
+Django management command to fill the stored position of the posts in their topic
+Usage: python manage.py backfill_post_positions [--all] [--batch-size 1000]
+
+Post.position (the relative id of a post, used for the page numbers and the /p<id> redirects) is set when a post is
+created and recomputed when an author is hidden or unhidden. Run this once after the migration for the existing posts,
+until then the positions are computed by scanning the topic like before. With --all, every topic is renumbered.
+"""
+from django.core.management.base import BaseCommand
+from forum.models import Post, renumber_post_positions
+
+
+class Command(BaseCommand):
+    help = 'Fill the stored position of the posts in their topic'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Renumber every topic, not only the ones with posts without a position',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of posts updated at once',
+        )
+
+    def handle(self, *args, **options):
+        posts = Post.objects.filter(topic__isnull=False)
+        if not options['all']:
+            posts = posts.filter(position__isnull=True)
+        topic_ids = sorted(set(posts.values_list('topic_id', flat=True)))
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"BACKFILLING POST POSITIONS ({len(topic_ids)} topic(s))"))
+        self.stdout.write("=" * 70)
+
+        total = 0
+        for index, topic_id in enumerate(topic_ids, start=1):
+            total += renumber_post_positions([topic_id], batch_size=max(options['batch_size'], 1))
+            if index % 100 == 0:
+                self.stdout.write(f"   {index} topic(s) done...")
+
+        self.stdout.write(self.style.SUCCESS(f"   [+] {total} post(s) updated"))
@@ -0,0 +1,84 @@
+"""
+Django management command to measure the latency of requests through the in-process ASGI handler
+Usage: python manage.py benchmark_asgi [--path /] [--requests 200] [--warmup 10]
+
+The same requests are sent with the current MIDDLEWARE ("hybrid") and with the forum middlewares loaded as sync only
+("sync only", how they were before they became async capable), so Django adapts them with sync_to_async. The views
+are the same in both runs, only the hops of the middlewares change. "python manage.py check_middleware" lists the
+adapted middlewares.
+"""
+import asyncio
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from forum.middleware import ForceHTTPSMiddleware, WebhookMiddleware
+
+
+class SyncOnlyForceHTTPSMiddleware(ForceHTTPSMiddleware):
+    async_capable = False
+
+
+class SyncOnlyWebhookMiddleware(WebhookMiddleware):
+    async_capable = False
+
+
+SYNC_ONLY_MIDDLEWARE = {
+    'forum.middleware.ForceHTTPSMiddleware': f"{__name__}.SyncOnlyForceHTTPSMiddleware",
+    'forum.middleware.WebhookMiddleware': f"{__name__}.SyncOnlyWebhookMiddleware",
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure the latency of requests through the ASGI handler, with async capable and sync only middlewares'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default='/',
+            help='Path requested (as an anonymous user)',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Number of requests measured for each stack',
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=10,
+            help='Number of requests sent before measuring',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"ASGI REQUEST LATENCY ({options['path']})"))
+        self.stdout.write("=" * 70)
+        self.stdout.write(f"   {'stack':<10} {'requests':>8} {'median (ms)':>12} {'p95 (ms)':>10} {'mean (ms)':>10}")
+
+        stacks = {
+            "sync only": [SYNC_ONLY_MIDDLEWARE.get(middleware_path, middleware_path) for middleware_path in settings.MIDDLEWARE],
+            "hybrid": list(settings.MIDDLEWARE),
+        }
+        for name, middleware in stacks.items():
+            with override_settings(MIDDLEWARE=middleware):
+                timings = asyncio.run(self.time_requests(options['path'], max(options['requests'], 1), options['warmup']))
+            timings.sort()
+            p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+            self.stdout.write(
+                f"   {name:<10} {len(timings):>8} {statistics.median(timings) * 1000:>12.2f} "
+                f"{p95 * 1000:>10.2f} {statistics.mean(timings) * 1000:>10.2f}"
+            )
+
+    async def time_requests(self, path, requests, warmup):
+        client = AsyncClient() # (loads the middlewares of the current settings)
+        for _ in range(warmup):
+            await client.get(path)
+        timings = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            await client.get(path)
+            timings.append(time.perf_counter() - start)
+        return timings
@@ -0,0 +1,134 @@
+"""
+Django management command to benchmark the BBCode parser on generated inputs
+Usage: python manage.py benchmark_bbcode [--scenario nested_quotes] [--sizes 1000 2000 4000 8000] [--repeat 3]
+       python manage.py benchmark_bbcode --corpus archive [--limit 1000] [--repeat 3]
+
+For each scenario, the input size is doubled several times: with a linear parser the time should
+roughly double too (the "ratio" column should stay around 2).
+
+With --corpus, the text of the stored posts is split into tokens and the textual content (escaping,
+links and smilies) of each data token is rendered with BBCodeParser._render_textual_content and with
+the reference implementation, which must give the same output.
+"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from precise_bbcode.bbcode import get_parser
+from precise_bbcode.bbcode.parser import BBCodeToken
+from forum.management.commands.compare_bbcode_tokenizers import CORPUS_SOURCES
+
+
+# name: function building an input of size n
+SCENARIOS = {
+    'flat': lambda n: "[b]Hello[/b] [i]world[/i] :) www.example.com/page\n" * n,
+    'nested_quotes': lambda n: ("[quote=Toto]" * 50 + "Salut !" + "[/quote]" * 50 + "\n") * max(n // 50, 1),
+    'deep_nesting': lambda n: "[quote]" * n + "x" + "[/quote]" * n,
+    'unclosed_tags': lambda n: "[b]x" * n,
+    'unmatched_end_tags': lambda n: "[quote]" * 50 + "[/b]" * n + "[/quote]" * 50,
+    'interleaved_tags': lambda n: "[b][i]" * n + "[/b]" * n,
+    'list_items': lambda n: "[list]" + "[*]item\n" * n + "[/list]",
+    'videos': lambda n: "[quote=Toto]Regardez ça :) [video]https://example.com/video.mp4[/video][/quote]\n" * n,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the BBCode parser on generated inputs of growing sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario',
+            choices=list(SCENARIOS.keys()),
+            action='append',
+            help='Only run this scenario (can be given several times, defaults to all of them)',
+        )
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[1000, 2000, 4000, 8000],
+            help='Input sizes (number of repetitions of the scenario pattern)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of renders per size (the best time is kept)',
+        )
+        parser.add_argument(
+            '--corpus',
+            choices=list(CORPUS_SOURCES.keys()),
+            help='Benchmark the textual content rendering over the texts of this source instead',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Maximum number of texts used with --corpus',
+        )
+
+    def handle(self, *args, **options):
+        parser = get_parser()
+
+        if options['corpus']:
+            return self.benchmark_corpus(parser, options['corpus'], options['limit'], max(options['repeat'], 1))
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("BBCODE PARSER BENCHMARK"))
+        self.stdout.write("=" * 70)
+
+        for name in options['scenario'] or SCENARIOS.keys():
+            self.stdout.write(f"\n{name}")
+            self.stdout.write(f"   {'size':>8} {'chars':>10} {'tokens':>8} {'time (ms)':>10} {'ratio':>7}")
+            previous_time = None
+            for size in options['sizes']:
+                data = SCENARIOS[name](size)
+                tokens_count = len(parser.get_tokens(data))
+                best_time = min(self.time_render(parser, data) for _ in range(max(options['repeat'], 1)))
+                ratio = f"{best_time / previous_time:.2f}" if previous_time else "-"
+                self.stdout.write(f"   {size:>8} {len(data):>10} {tokens_count:>8} {best_time * 1000:>10.2f} {ratio:>7}")
+                previous_time = best_time
+        self.stdout.write("")
+
+    def time_render(self, parser, data):
+        start = time.perf_counter()
+        parser.render(data)
+        return time.perf_counter() - start
+
+    def benchmark_corpus(self, parser, source, limit, repeat):
+        model, field_name = CORPUS_SOURCES[source]
+        texts = model.objects.exclude(**{f"{field_name}__isnull": True}).order_by('pk').values_list(field_name, flat=True)
+        if limit:
+            texts = texts[:limit]
+
+        # Escaping, links and smilies, like for the data tokens outside of any tag
+        flags = (True, True, True)
+        chunks = [
+            token.text
+            for text in texts.iterator()
+            for token in parser.get_tokens(text)
+            if token.type == BBCodeToken.TK_DATA
+        ]
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"BBCODE TEXTUAL CONTENT BENCHMARK ({source})"))
+        self.stdout.write("=" * 70)
+
+        mismatches = sum(
+            parser._render_textual_content(chunk, *flags) != parser._render_textual_content_reference(chunk, *flags)
+            for chunk in chunks
+        )
+        new_time = min(self.time_chunks(parser._render_textual_content, chunks, flags) for _ in range(repeat))
+        reference_time = min(self.time_chunks(parser._render_textual_content_reference, chunks, flags) for _ in range(repeat))
+        speedup = f"{reference_time / new_time:.2f}x" if new_time else "-"
+
+        self.stdout.write(f"   {len(chunks)} data token(s), {sum(len(chunk) for chunk in chunks)} chars, {len(parser.smilies)} smilies")
+        self.stdout.write(f"   _render_textual_content: {new_time * 1000:.2f} ms")
+        self.stdout.write(f"   reference:               {reference_time * 1000:.2f} ms ({speedup})")
+        if mismatches:
+            raise CommandError(f"{mismatches} data token(s) are rendered differently")
+        self.stdout.write(self.style.SUCCESS("   [+] Same output everywhere"))
+
+    def time_chunks(self, render, chunks, flags):
+        start = time.perf_counter()
+        for chunk in chunks:
+            render(chunk, *flags)
+        return time.perf_counter() - start
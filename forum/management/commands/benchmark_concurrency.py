@@ -0,0 +1,159 @@
+"""
+Django management command to measure the throughput of the hottest pages with concurrent requests
+Usage: python manage.py benchmark_concurrency --path /t1-slug [--user admin] [--requests 200] [--concurrency 1 2 4 8 16 32]
+
+The requests are sent to the ASGI handler in this process (one event loop, like one Daphne process), with the sync
+views and with the async views of forum/views_async.py, whatever ASYNC_VIEWS is. For each number of concurrent
+requests, the throughput should grow with the async views while they wait for the database, the cache or Redis.
+Without --user the requests are anonymous, so most of them are served by the page cache (see forum/page_cache.py).
+The rate limits are disabled during the benchmark.
+"""
+import asyncio
+import time
+from importlib import import_module
+from types import ModuleType
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.urls import URLPattern, URLResolver, get_resolver
+from forum import views, views_async
+from forum.models import User
+
+HOT_VIEWS = ('index', 'subforum_details', 'topic_details', 'category_details')
+
+
+def make_urlconf(name, urlpatterns):
+    """A URLconf module made in memory (a module, since Django caches the resolvers by URLconf)."""
+    urlconf = ModuleType(name)
+    urlconf.urlpatterns = urlpatterns
+    return urlconf
+
+def swap_views(patterns, replacements):
+    """Copy URL patterns, with the views of replacements ({view: other view}) replaced."""
+    swapped = []
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            urlconf = make_urlconf(f"{__name__}.swapped", swap_views(pattern.url_patterns, replacements))
+            swapped.append(URLResolver(pattern.pattern, urlconf, pattern.default_kwargs, pattern.app_name, pattern.namespace))
+        else:
+            swapped.append(URLPattern(pattern.pattern, replacements.get(pattern.callback, pattern.callback), pattern.default_args, pattern.name))
+    return swapped
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of a page with concurrent requests, with the sync and the async views'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default='/index/',
+            help='Path requested',
+        )
+        parser.add_argument(
+            '--user',
+            help='Username of the user sending the requests (anonymous by default)',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Number of requests for each concurrency',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            nargs='+',
+            default=[1, 2, 4, 8, 16, 32],
+            help='Numbers of concurrent requests',
+        )
+
+    def handle(self, *args, **options):
+        headers = [(b'host', settings.ALLOWED_HOSTS[0].encode())]
+        if options['user']:
+            headers.append((b'cookie', f"{settings.SESSION_COOKIE_NAME}={self.create_session(options['user'])}".encode()))
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"CONCURRENT REQUESTS ({options['path']}, {options['user'] or 'anonymous'})"))
+        self.stdout.write("=" * 70)
+        self.stdout.write(f"   {'views':<6} {'concurrency':>11} {'requests/s':>11} {'mean (ms)':>10} {'errors':>7}")
+
+        stacks = {
+            'sync': {getattr(views_async, name): getattr(views, name) for name in HOT_VIEWS},
+            'async': {getattr(views, name): getattr(views_async, name) for name in HOT_VIEWS},
+        }
+        requests = max(options['requests'], 1)
+        for name, replacements in stacks.items():
+            urlconf = make_urlconf(f"{__name__}.{name}", swap_views(get_resolver().url_patterns, replacements))
+            with override_settings(ROOT_URLCONF=urlconf, RATELIMIT_ENABLE=False):
+                application = ASGIHandler()
+                for concurrency in options['concurrency']:
+                    elapsed, timings, errors = asyncio.run(self.run(application, options['path'], headers, requests, max(concurrency, 1)))
+                    self.stdout.write(
+                        f"   {name:<6} {concurrency:>11} {len(timings) / elapsed:>11.1f} "
+                        f"{sum(timings) / len(timings) * 1000:>10.2f} {errors:>7}"
+                    )
+
+    def create_session(self, username):
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            raise CommandError(f"User {username} not found")
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    async def run(self, application, path, headers, requests, concurrency):
+        remaining = iter(range(requests))
+        timings = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                status = await self.request(application, path, headers)
+                timings.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.perf_counter() - start, timings, errors
+
+    async def request(self, application, path, headers):
+        path, _, query_string = path.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query_string.encode(),
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': ('127.0.0.1', 80),
+        }
+        body_sent = False
+        status = None
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Future() # (the client never disconnects, Django stops waiting after the response)
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await application(scope, receive, send)
+        return status
@@ -0,0 +1,74 @@
+"""
+Django management command to measure the cost of safe_async_log in a view
+Usage: python manage.py benchmark_logging [--calls 10000] [--celery-calls 200]
+
+Times the calls of safe_async_log (see forum/log_pipeline.py) in the request thread:
+- "filtered": a message under the level of the "forum.views" logger (the debug messages in production);
+- "queued": a message put in the queue of the process (written by the listener thread, here to a NullHandler);
+- "celery": the previous behaviour, one async_log task per call (needs the Celery broker, skipped with --celery-calls 0).
+"""
+import logging
+import time
+from django.core.management.base import BaseCommand
+from forum import log_pipeline
+from forum.tasks import async_log, safe_async_log
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of a safe_async_log call in the request thread'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--calls',
+            type=int,
+            default=10000,
+            help='Number of calls for the filtered and queued messages',
+        )
+        parser.add_argument(
+            '--celery-calls',
+            type=int,
+            default=200,
+            help='Number of async_log tasks sent (0 to skip)',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("SAFE_ASYNC_LOG BENCHMARK"))
+        self.stdout.write("=" * 70)
+
+        # The records go to a NullHandler at the INFO level, not to the log files
+        logger = logging.getLogger(log_pipeline.LOGGER_NAME)
+        handlers, level = logger.handlers, logger.level
+        log_pipeline.stop_pipeline()
+        logger.handlers = [logging.NullHandler()]
+        logger.setLevel(logging.INFO)
+        try:
+            calls = max(options['calls'], 1)
+            self.write_result("filtered", calls, self.time_calls(calls, 'debug'))
+            self.write_result("queued", calls, self.time_calls(calls, 'info'))
+            self.stdout.write(f"   [+] Listener: {log_pipeline.get_pipeline_stats()}")
+        finally:
+            log_pipeline.stop_pipeline()
+            logger.handlers = handlers
+            logger.setLevel(level)
+
+        if options['celery_calls'] > 0:
+            try:
+                self.write_result("celery", options['celery_calls'], self.time_celery(options['celery_calls']))
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f"   celery: skipped ({e})"))
+
+    def time_calls(self, calls, level):
+        start = time.perf_counter()
+        for index in range(calls):
+            safe_async_log(f"Benchmark message {index}", level, 'benchmark_logging')
+        return time.perf_counter() - start
+
+    def time_celery(self, calls):
+        start = time.perf_counter()
+        for index in range(calls):
+            async_log.delay(f"Benchmark message {index}", 'debug', 'benchmark_logging')
+        return time.perf_counter() - start
+
+    def write_result(self, name, calls, elapsed):
+        self.stdout.write(f"   {name:<10} {calls:>8} call(s)   {elapsed * 1e6 / calls:>10.2f} µs per call")
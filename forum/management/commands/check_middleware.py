@@ -0,0 +1,73 @@
+"""
+Django management command to find the middlewares that force a sync/async adaptation
+Usage: python manage.py check_middleware [--wsgi] [--fail]
+
+Follows the logic of BaseHandler.load_middleware: the middlewares of MIDDLEWARE are loaded from the last one, and
+when a middleware can't run in the mode of the handler it wraps, Django adapts it with sync_to_async or async_to_sync
+(a hop between the event loop and the thread pool for each request). With Daphne the handler is async (ASGI), so all
+the middlewares should be async capable.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+def get_middleware_adaptations(middleware_paths, is_async=True):
+    """Get (path, mode, adapted) for each middleware, from the outermost one, and whether the top of the stack is
+    adapted too. mode is "hybrid", "async" or "sync"."""
+    handler_is_async = is_async
+    results = []
+    for middleware_path in reversed(middleware_paths):
+        middleware = import_string(middleware_path)
+        can_sync = getattr(middleware, 'sync_capable', True)
+        can_async = getattr(middleware, 'async_capable', False)
+        if not can_sync and not can_async:
+            raise CommandError(f"Middleware {middleware_path} must have at least one of sync_capable/async_capable set to True.")
+        if not handler_is_async and can_sync:
+            middleware_is_async = False
+        else:
+            middleware_is_async = can_async
+        mode = "hybrid" if can_sync and can_async else "async" if can_async else "sync"
+        results.append((middleware_path, mode, middleware_is_async != handler_is_async))
+        handler_is_async = middleware_is_async
+    results.reverse()
+    return results, handler_is_async != is_async
+
+
+class Command(BaseCommand):
+    help = 'Report the middlewares of MIDDLEWARE that force a sync/async adaptation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--wsgi',
+            action='store_true',
+            help='Check the middlewares for a sync (WSGI) handler instead of an async (ASGI) one',
+        )
+        parser.add_argument(
+            '--fail',
+            action='store_true',
+            help='Exit with an error if a middleware is adapted',
+        )
+
+    def handle(self, *args, **options):
+        is_async = not options['wsgi']
+        results, top_adapted = get_middleware_adaptations(settings.MIDDLEWARE, is_async)
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"MIDDLEWARE ADAPTATIONS ({'ASGI' if is_async else 'WSGI'})"))
+        self.stdout.write("=" * 70)
+
+        for middleware_path, mode, adapted in results:
+            line = f"   {middleware_path:<60} {mode:<7}"
+            self.stdout.write(self.style.WARNING(f"{line} adapted") if adapted else line)
+
+        adapted_paths = [middleware_path for middleware_path, mode, adapted in results if adapted]
+        if top_adapted:
+            self.stdout.write(self.style.WARNING("   The handler is adapted at the top of the stack"))
+        if not adapted_paths and not top_adapted:
+            self.stdout.write(self.style.SUCCESS("   [+] No adaptation"))
+            return
+        message = f"{len(adapted_paths)} middleware(s) adapted: {', '.join(adapted_paths)}"
+        if options['fail']:
+            raise CommandError(message)
+        self.stdout.write(self.style.WARNING(f"   {message}"))
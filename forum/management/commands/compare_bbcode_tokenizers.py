@@ -0,0 +1,85 @@
+"""
+Django management command to check that the BBCode tokenizer gives the same tokens as the reference one
+Usage: python manage.py compare_bbcode_tokenizers [--limit 1000] [--source archive]
+
+It runs BBCodeParser.get_tokens and BBCodeParser._get_tokens_reference (the original lexer) over the
+posts/PMs/signatures stored in the database and reports every text where the token streams differ.
+"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from precise_bbcode.bbcode import get_parser
+from forum.models import Post, Profile, PrivateMessage
+from archive.models import ArchivePost
+
+
+# name: (model, field with the BBCode source)
+CORPUS_SOURCES = {
+    'archive': (ArchivePost, 'text'),
+    'post': (Post, 'text'),
+    'pm': (PrivateMessage, 'text'),
+    'signature': (Profile, 'signature'),
+}
+
+
+def token_stream(tokens):
+    return [(token.type, token.tag_name, token.option, token.text) for token in tokens]
+
+
+class Command(BaseCommand):
+    help = 'Compare the BBCode tokenizer with the reference tokenizer over the stored texts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=list(CORPUS_SOURCES.keys()),
+            action='append',
+            help='Only use this source (can be given several times, defaults to all of them)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Maximum number of texts per source',
+        )
+
+    def handle(self, *args, **options):
+        parser = get_parser()
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("COMPARING BBCODE TOKENIZERS"))
+        self.stdout.write("=" * 70)
+
+        total_mismatches = 0
+        for name in options['source'] or CORPUS_SOURCES.keys():
+            model, field_name = CORPUS_SOURCES[name]
+            texts = model.objects.exclude(**{f"{field_name}__isnull": True}).order_by('pk').values_list('pk', field_name)
+            if options['limit']:
+                texts = texts[:options['limit']]
+
+            count = 0
+            mismatches = 0
+            new_time = 0
+            reference_time = 0
+            for pk, text in texts.iterator():
+                count += 1
+                start = time.perf_counter()
+                tokens = parser.get_tokens(text)
+                new_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                reference_tokens = parser._get_tokens_reference(text)
+                reference_time += time.perf_counter() - start
+
+                if token_stream(tokens) != token_stream(reference_tokens):
+                    mismatches += 1
+                    self.stdout.write(self.style.ERROR(f"   {model.__name__} {pk}: token streams differ"))
+
+            total_mismatches += mismatches
+            self.stdout.write(
+                f"   [+] {name}: {count} text(s), {mismatches} mismatch(es), "
+                f"get_tokens {new_time:.3f}s vs reference {reference_time:.3f}s"
+            )
+
+        if total_mismatches:
+            raise CommandError(f"{total_mismatches} text(s) are tokenized differently")
+        self.stdout.write(self.style.SUCCESS("   [+] Same token streams everywhere"))
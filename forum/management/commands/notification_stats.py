@@ -0,0 +1,29 @@
+"""
+Django management command to show the stats of the notification streams
+Usage: python manage.py notification_stats
+
+Each process serving sse_post_event reports its connected streams and the depth of their queues every 30 seconds
+(see forum/notification_hub.py). The processes that didn't report for a minute are left out.
+"""
+from django.core.management.base import BaseCommand
+from forum.notification_hub import get_notification_stats
+
+
+class Command(BaseCommand):
+    help = 'Show the connected notification streams and the depth of their queues'
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("NOTIFICATION STREAMS"))
+        self.stdout.write("=" * 70)
+
+        stats = get_notification_stats()
+        if stats is None:
+            self.stdout.write(self.style.ERROR("\nRedis client is not available!"))
+            return
+
+        for name, process in sorted(stats['processes'].items()) + [('total', stats['total'])]:
+            self.stdout.write(
+                f"   {name:<40} streams: {process['streams']:<6} users: {process['users']:<6} "
+                f"queued: {process['queued']:<6} max depth: {process['max_queue_depth']:<6} dropped: {process['dropped']}"
+            )
@@ -0,0 +1,33 @@
+"""
+Django management command to show the hit ratio of the anonymous pages cache
+Usage: python manage.py page_cache_stats [--reset]
+
+The hits and misses of the index, category, subforum and topic pages for the anonymous users (see forum/page_cache.py)
+are counted since the last reset. The responses also have a "X-Page-Cache: HIT" or "X-Page-Cache: MISS" header.
+"""
+from django.core.management.base import BaseCommand
+from forum.page_cache import get_page_cache_stats, reset_page_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show the hit ratio of the anonymous pages cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the counters after showing them',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("ANONYMOUS PAGES CACHE"))
+        self.stdout.write("=" * 70)
+
+        for page_name, stats in get_page_cache_stats().items():
+            ratio = f"{stats['hit_ratio']:.1%}" if stats['hit_ratio'] is not None else "-"
+            self.stdout.write(f"   {page_name:<20} hits: {stats['hits']:<10} misses: {stats['misses']:<10} hit ratio: {ratio}")
+
+        if options['reset']:
+            reset_page_cache_stats()
+            self.stdout.write(self.style.SUCCESS("   [+] Counters reset"))
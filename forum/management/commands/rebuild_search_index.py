@@ -0,0 +1,27 @@
+"""
+Django management command to fill the full-text index of the posts again
+Usage: python manage.py rebuild_search_index
+
+With SQLite, the FTS5 table forum_post_fts (see forum/search.py) is kept up to date by triggers on forum_post. The
+migrations altering forum_post remake the table without them, migrate then creates them again and rebuilds the index
+(ensure_search_triggers); this command does it by hand, e.g. after the table was filled without the triggers. With PostgreSQL, the search_vector columns are
+generated by the database, there is nothing to rebuild.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection
+from forum.search import rebuild_search_index, get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Fill the full-text index of the posts again'
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("REBUILDING THE SEARCH INDEX"))
+        self.stdout.write("=" * 70)
+
+        total = rebuild_search_index()
+        if total is None:
+            self.stdout.write(f"   [-] Nothing to rebuild ({connection.vendor}, {type(get_search_backend()).__name__})")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"   [+] {total} post(s) indexed"))
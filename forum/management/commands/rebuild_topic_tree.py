@@ -0,0 +1,45 @@
+"""
+Django management command to rebuild the closure tables of the subforums tree from the topics' parents
+Usage: python manage.py rebuild_topic_tree [--tree forum] [--batch-size 1000]
+
+The tables (TopicClosure and ArchiveTopicClosure, see forum/topic_tree.py) are kept up to date when the topics are
+saved, but not for the topics made with bulk_create or raw SQL (like the archive import scripts): run this afterwards.
+"""
+from django.core.management.base import BaseCommand
+from forum.models import Topic
+from forum.topic_tree import rebuild_topic_links
+from archive.models import ArchiveTopic
+
+
+# name: topic model
+TREES = {
+    'forum': Topic,
+    'archive': ArchiveTopic,
+}
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the closure tables of the subforums tree'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tree',
+            choices=list(TREES.keys()),
+            action='append',
+            help='Only rebuild this tree (can be given several times, defaults to all of them)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows inserted at once',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS("REBUILDING THE TOPIC TREES"))
+        self.stdout.write("=" * 70)
+
+        for name in options['tree'] or TREES.keys():
+            total = rebuild_topic_links(TREES[name], batch_size=max(options['batch_size'], 1))
+            self.stdout.write(self.style.SUCCESS(f"   [+] {name}: {total} link(s)"))
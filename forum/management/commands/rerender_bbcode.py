@@ -0,0 +1,92 @@
+"""
+Django management command to re-render the stored BBCode HTML of posts, signatures and PMs
+Usage: python manage.py rerender_bbcode [--force] [--batch-size 500] [--model post]
+
+Run it after changing BBCODE_RENDER_VERSION, the custom tags or the smilies, otherwise the pages
+will keep rendering the stale rows on the fly (which is correct but slow). The stored plain texts
+(_text_plain) of the posts and PMs are updated too.
+"""
+from django.core.management.base import BaseCommand
+from forum.models import Post, Profile, PrivateMessage
+from forum.bbcode_render import get_render_version, render_bbcode, render_plaintext
+from archive.models import ArchivePost
+
+
+# name: (model, field with the BBCode source)
+RENDERED_MODELS = {
+    'post': (Post, 'text'),
+    'signature': (Profile, 'signature'),
+    'pm': (PrivateMessage, 'text'),
+    'archive_post': (ArchivePost, 'text'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Re-render the stored BBCode HTML of the rows that were rendered with an old version'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-render every row, even the ones that are up to date',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of rows loaded and updated at once',
+        )
+        parser.add_argument(
+            '--model',
+            choices=list(RENDERED_MODELS.keys()),
+            action='append',
+            help='Only re-render this model (can be given several times)',
+        )
+
+    def handle(self, *args, **options):
+        version = get_render_version()
+        batch_size = max(options['batch_size'], 1)
+
+        self.stdout.write("=" * 70)
+        self.stdout.write(self.style.SUCCESS(f"RE-RENDERING BBCODE (version {version})"))
+        self.stdout.write("=" * 70)
+
+        for name in options['model'] or RENDERED_MODELS.keys():
+            model, field_name = RENDERED_MODELS[name]
+            total = self.rerender_model(model, field_name, version, batch_size, options['force'])
+            self.stdout.write(self.style.SUCCESS(f"   [+] {name}: {total} row(s) re-rendered"))
+
+    def rerender_model(self, model, field_name, version, batch_size, force):
+        rendered_field = f"_{field_name}_rendered"
+        version_field = f"_{field_name}_rendered_version"
+        plain_field = f"_{field_name}_plain"
+        has_plain_field = any(field.name == plain_field for field in model._meta.get_fields())
+        updated_fields = [rendered_field, version_field] + ([plain_field] if has_plain_field else [])
+
+        queryset = model.objects.all()
+        if not force:
+            queryset = queryset.exclude(**{version_field: version})
+        queryset = queryset.only('pk', field_name).order_by('pk')
+
+        total = 0
+        last_pk = None
+        while True:
+            # Walk by primary key instead of OFFSET, since the updated rows leave the "stale" queryset
+            batch_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            batch = list(batch_queryset[:batch_size])
+            if not batch:
+                break
+
+            for obj in batch:
+                setattr(obj, rendered_field, str(render_bbcode(getattr(obj, field_name))))
+                setattr(obj, version_field, version)
+                if has_plain_field:
+                    setattr(obj, plain_field, render_plaintext(getattr(obj, field_name)))
+
+            # bulk_update doesn't call save(), so the edit counters and auto_now dates are left alone
+            model.objects.bulk_update(batch, updated_fields)
+            total += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f"   {model.__name__}: {total} row(s) done...")
+
+        return total
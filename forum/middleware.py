@@ -1,36 +1,53 @@
 # forum/middleware.py
 
-import asyncio
-import inspect
 import logging
-import threading
 
-import httpx
-from asgiref.sync import async_to_sync
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
 
+from .webhooks import get_dispatcher
+
+# The middlewares are sync and async capable: under Daphne (ASGI) Django gives them an async get_response and calls
+# __acall__ in the event loop, under WSGI a sync one and __call__. They used to be sync only and to await the response
+# with async_to_sync, so each request went between the event loop and the thread pool several times.
+# "python manage.py check_middleware" reports the middlewares of MIDDLEWARE that still force an adaptation.
+
 class ForceHTTPSMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self._force_https(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self._force_https(request)
+        return await self.get_response(request)
+
+    def _force_https(self, request):
         request.META['HTTP_X_FORWARDED_PROTO'] = 'https'
         request._is_secure_override = True
-        response = self.get_response(request)
-        if inspect.isawaitable(response):
-            response = async_to_sync(self._await_response)(response)
-        return response
-
-    async def _await_response(self, awaitable_response):
-        return await awaitable_response
 
 logger = logging.getLogger(__name__)
 disable_prints = getattr(settings, 'DISABLE_CUSTOM_PRINTS', False)
 
 class WebhookMiddleware:
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
         # Ensure the webhook URL is configured.
         if not settings.GET_WEBHOOK_URL:
             if not disable_prints:
@@ -48,82 +65,30 @@ class WebhookMiddleware:
         return any(path.startswith(pattern) for pattern in skip_patterns)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
         response = self.get_response(request)
-        
-        # Skip webhook for certain URLs
-        if self._should_skip_webhook(request):
-            if inspect.isawaitable(response):
-                return async_to_sync(self._await_response)(response)
-            return response
-        
-        if inspect.isawaitable(response):
-            return async_to_sync(self._async_response_handler)(request, response)
-        self._fire_webhook_sync(request)
+        if settings.GET_WEBHOOK_URL and not self._should_skip_webhook(request):
+            self._queue_webhook(request, getattr(request, 'user', None), 'sync')
         return response
 
-    async def _async_response_handler(self, request, awaitable_response):
-        response = await awaitable_response
-        await self._fire_webhook_async(request)
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if settings.GET_WEBHOOK_URL and not self._should_skip_webhook(request):
+            # (request.user would load the user synchronously in the event loop)
+            user = await request.auser() if hasattr(request, 'auser') else None
+            # (never blocks, the event is sent by the dispatcher thread, see forum/webhooks.py)
+            self._queue_webhook(request, user, 'async')
         return response
 
-    def _fire_webhook_sync(self, request):
-        """Fire webhook in sync context using thread pool"""
-        if settings.GET_WEBHOOK_URL and hasattr(request, 'user') and request.user.is_authenticated:
-            
-            def run_webhook():
-                try:
-                    # Create new event loop for this thread
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    
-                    payload = {
-                        'username': f"{request.user.username} (sync)",
-                        'content': f"=================================================================\n"
-                                f"👤**User:** {request.user.username}\n"
-                                f"🌐 **Path:** {request.get_full_path()}\n"
-                                f"📍 **Method:** {request.method}\n"
-                                f"🖥️ **User Agent:** {request.META.get('HTTP_USER_AGENT', 'Unknown')[:200]}...\n"
-                                f"📡 **IP Address:** {request.META.get('REMOTE_ADDR', 'Unknown')}\n"
-                                f"🎨 **Theme:** {request.COOKIES.get('theme', 'None (Modern)')}\n"
-                                f"=================================================================\n"
-                    }
-                    
-                    async def send_webhook():
-                        try:
-                            async with httpx.AsyncClient() as client:
-                                await client.post(settings.GET_WEBHOOK_URL, json=payload, timeout=3.0)
-                        except httpx.RequestError as e:
-                            if not disable_prints:
-                                logger.error(f"Failed to send tracking data to webhook: {e}")
-                    
-                    loop.run_until_complete(send_webhook())
-                    loop.close()
-                except Exception as e:
-                    if not disable_prints:
-                        logger.error(f"Error in webhook thread: {e}")
-            
-            # Start webhook in background thread
-            webhook_thread = threading.Thread(target=run_webhook, daemon=True)
-            webhook_thread.start()
-
-    async def _fire_webhook_async(self, request):
-        """Fire webhook in async context"""
-        if settings.GET_WEBHOOK_URL and hasattr(request, 'user') and request.user.is_authenticated:
-            payload = {
-                'username': f"{request.user.username} (async)",
-                'content': f"=================================================================\n"
-                        f"👤**User:** {request.user.username}\n"
-                        f"🌐 **Path:** {request.get_full_path()}\n"
-                        f"📍 **Method:** {request.method}\n"
-                        f"🖥️ **User Agent:** {request.META.get('HTTP_USER_AGENT', 'Unknown')[:200]}...\n"
-                        f"📡 **IP Address:** {request.META.get('REMOTE_ADDR', 'Unknown')}\n"
-                        f"🎨 **Theme:** {request.COOKIES.get('theme', 'None (Modern)')}\n"
-                        f"=================================================================\n"
-            }
-
-            try:
-                async with httpx.AsyncClient() as client:
-                    await client.post(settings.GET_WEBHOOK_URL, json=payload, timeout=3.0)
-            except httpx.RequestError as e:
-                if not disable_prints:
-                    logger.error(f"Failed to send tracking data to webhook: {e}")
\ No newline at end of file
+    def _queue_webhook(self, request, user, mode):
+        if user is not None and user.is_authenticated:
+            content = (f"=================================================================\n"
+                       f"👤**User:** {user.username}\n"
+                       f"🌐 **Path:** {request.get_full_path()}\n"
+                       f"📍 **Method:** {request.method}\n"
+                       f"🖥️ **User Agent:** {request.META.get('HTTP_USER_AGENT', 'Unknown')[:200]}...\n"
+                       f"📡 **IP Address:** {request.META.get('REMOTE_ADDR', 'Unknown')}\n"
+                       f"🎨 **Theme:** {request.COOKIES.get('theme', 'None (Modern)')}\n"
+                       f"=================================================================\n")
+            get_dispatcher(settings.GET_WEBHOOK_URL).send(f"{user.username} ({mode})", content)
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0063_delete_chatboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='_text_rendered',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='_text_rendered_version',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='_text_rendered',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='_text_rendered_version',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='_signature_rendered',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='_signature_rendered_version',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
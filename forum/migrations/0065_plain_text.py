@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0064_rendered_bbcode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='_text_plain',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='_text_plain',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
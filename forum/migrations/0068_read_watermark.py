@@ -0,0 +1,29 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0067_topic_closure'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_before', models.DateTimeField()),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='forum.category')),
+                ('subforum', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='forum.topic')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('category__isnull', True), ('subforum__isnull', True)), fields=('user',), name='unique_global_read_watermark'), models.UniqueConstraint(condition=models.Q(('subforum__isnull', True)), fields=('user', 'category'), name='unique_category_read_watermark'), models.UniqueConstraint(condition=models.Q(('category__isnull', True)), fields=('user', 'subforum'), name='unique_subforum_read_watermark')],
+            },
+        ),
+    ]
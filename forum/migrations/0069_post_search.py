@@ -0,0 +1,22 @@
+from django.db import migrations
+from forum.search import create_search_index, drop_search_index
+
+
+def create_index(apps, schema_editor):
+    """Create the full-text index of the posts (PostgreSQL: search_vector columns, SQLite: FTS5 table)."""
+    create_search_index(schema_editor)
+
+
+def drop_index(apps, schema_editor):
+    drop_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0068_read_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -1,23 +1,28 @@
 # forum/models.py
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils.timezone import now, make_aware, is_naive
 from django.utils.text import slugify
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from collections import deque
 import os
 import uuid
 from django.utils import timezone
+from django.core.cache import cache
 from precise_bbcode.models import SmileyTag
 import datetime
-from django.db.models import Count, Sum
+from django.db.models import Count, Sum, F, Max
+from django.db.models.expressions import RawSQL
 import re
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
 from django.db.models.signals import post_save
 from rest_framework.authtoken.models import Token
 from utf.utils import cprint
+from .bbcode_render import update_rendered_field, get_rendered_field, get_plain_field, render_plaintext, update_cached_render
+from .view_counter import get_pending_views
+from .topic_tree import TopicTreeMixin, TopicClosureBase
+from .read_state import mark_read, get_read_times, touch_forum_read_state
 
 # def profile_picture_upload_path(instance, filename):
 #     """Generate a file path with username, original filename, and a 4-character UUID"""
@@ -90,23 +95,10 @@ class SafeDateTimeField(models.DateTimeField):
             return placeholder
 
 def mark_all_topics_read_for_user(user):
-    """Mark all topics as read for the user."""
+    """Mark all topics as read for the user (one watermark, not one row per topic, see forum/read_state.py)."""
     if not user.is_authenticated:
         return
-
-    # Circular import avoided by using local reference
-    from .models import Topic, TopicReadStatus
-    
-    # Get all topics in the forum
-    all_topics = Topic.objects.all()
-
-    # Iterate through each topic and mark it as read for the user
-    for topic in all_topics:
-        TopicReadStatus.objects.update_or_create(
-            user=user,
-            topic=topic,
-            defaults={'last_read': timezone.now()}
-        )
+    mark_read(user)
 
 def strip_bbcode(text: str) -> str:
     """
@@ -118,6 +110,11 @@ def strip_bbcode(text: str) -> str:
     - [spoiler] content is replaced by black square emojis (1 per 3 chars).
     - Styling tags are removed.
     """
+    return render_plaintext(text)
+
+
+def strip_bbcode_reference(text: str) -> str:
+    """The old regex implementation of strip_bbcode, only kept for the tests (the tags do it in one pass now, see render_plaintext)."""
     if not isinstance(text, str):
         return ""
 
@@ -233,6 +230,22 @@ class ForumGroup(models.Model):
         return self.name
     
 
+# The messages groups, by decreasing priority, used to promote the authors of new posts without querying the groups each time
+# (reset by the ForumGroup signals in forum/signals.py)
+MESSAGES_GROUP_LADDER_CACHE_KEY = "messages_group_ladder"
+
+def get_messages_group_ladder():
+    """Get the (id, minimum_messages) of the messages groups, by decreasing priority (cached).
+    Only the ids are cached, not the groups: the promoted authors are added to the groups read from the database."""
+    ladder = cache.get(MESSAGES_GROUP_LADDER_CACHE_KEY)
+    if ladder is None:
+        ladder = list(ForumGroup.objects.filter(is_messages_group=True).order_by('-priority').values_list('id', 'minimum_messages'))
+        cache.set(MESSAGES_GROUP_LADDER_CACHE_KEY, ladder, 60*60*12)
+    return ladder
+
+def reset_messages_group_ladder():
+    cache.delete(MESSAGES_GROUP_LADDER_CACHE_KEY)
+
 
 @receiver(post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
@@ -256,6 +269,8 @@ class Profile(models.Model):
     website = models.CharField(null=True, blank=True, max_length=255)
     skype = models.CharField(null=True, blank=True, max_length=255)
     signature = models.TextField(null=True, blank=True, max_length=65535)
+    _signature_rendered = models.TextField(null=True, blank=True, editable=False) # Rendered HTML of the signature, see forum/bbcode_render.py
+    _signature_rendered_version = models.CharField(max_length=64, null=True, blank=True, editable=False)
     email_is_public = models.BooleanField(default=False)    
     last_login = models.DateTimeField(auto_now=True)
     name_color = models.CharField(max_length=20, null=True, blank=True, help_text="Color of the user's name in the forum. Use a hex color code starting with #.")
@@ -337,18 +352,31 @@ class Profile(models.Model):
         else:
             return "#9E9E9E"  # Default to neutral color if type is unknown
 
+    @property
+    def get_signature_html(self):
+        """Get the rendered HTML of the signature (stored at save time, or rendered once for all the posts of a page)."""
+        return get_rendered_field(self, 'signature', cached=True)
+
     def save(self, *args, **kwargs):
         # Check if is_hidden field has changed (for existing instances)
         is_hidden_changed = False
         old_is_hidden = None
+        signature_changed = True
+        old_signature = None
         
         if self.pk is not None:
             try:
                 old_instance = Profile.objects.get(pk=self.pk)
                 old_is_hidden = old_instance.is_hidden
                 is_hidden_changed = old_is_hidden != self.is_hidden
+                signature_changed = old_instance.signature != self.signature
+                old_signature = old_instance.signature
             except Profile.DoesNotExist:
                 pass
+
+        # Only re-render the signature if it was edited or if it was rendered with an old version
+        update_rendered_field(self, 'signature', kwargs, force=signature_changed)
+        self._is_hidden_changed = is_hidden_changed # (for the post_save signals, see forum/signals.py)
         
         if self.pk is None:
 
@@ -379,6 +407,11 @@ class Profile(models.Model):
         if is_hidden_changed:
             self._handle_is_hidden_change(old_is_hidden, self.is_hidden)
 
+        # Replace the old signature in the render cache (used when the stored render is outdated, see get_signature_html)
+        update_fields = kwargs.get('update_fields')
+        if signature_changed and old_signature is not None and (update_fields is None or 'signature' in update_fields):
+            update_cached_render(self, 'signature', old_signature)
+
         
     def _handle_is_hidden_change(self, old_value, new_value):
         """Handle actions when is_hidden field changes."""
@@ -393,6 +426,14 @@ class Profile(models.Model):
             cprint(f"User {self.user.username} became visible")
             # TODO: Update latest_message references for topics where this user should now be visible
             self._update_latest_message_references()
+
+        else:
+            return
+
+        # The public positions of the posts change in all the topics where this user posted
+        topic_ids = Post.objects.filter(author=self.user).values_list('topic_id', flat=True).distinct()
+        renumbered = renumber_post_positions(topic_id for topic_id in topic_ids if topic_id is not None)
+        cprint(f"Renumbered {renumbered} post(s) after the is_hidden change of {self.user.username}")
     
     def _clear_latest_message_references(self):
         """Clear latest_message references for topics where this user was the latest poster."""        
@@ -497,27 +538,34 @@ class Post(models.Model):
     author = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="posts", null=True, blank=True)
     topic = models.ForeignKey('Topic', on_delete=models.CASCADE, related_name="replies", null=True, blank=True)
     text = models.TextField(max_length=65535, default="DEFAULT POST TEXT")
+    _text_rendered = models.TextField(null=True, blank=True, editable=False) # Rendered HTML of the text, see forum/bbcode_render.py
+    _text_rendered_version = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    _text_plain = models.TextField(null=True, blank=True, editable=False) # Plain text of the text, for the previews and notifications
     created_time = models.DateTimeField(auto_now_add=True)
     updated_time = models.DateTimeField(auto_now=True)
     update_count = models.IntegerField(default=0, null=True)
+    # 1-based position among the public posts of the topic (for a post of a hidden author: the position it would have),
+    # set on creation and recomputed by renumber_post_positions(). None until "python manage.py backfill_post_positions" ran.
+    position = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['topic', 'position']),
+        ]
 
     @property
     def get_page_number(self):
         """Get the page number of this post in the topic."""
-        if self.topic:
-            # Get all posts in the topic, ordered by created time
-            posts = list(self.topic.public_replies.all().order_by('created_time'))
-            # Find the index of this post in the list
-            index = posts.index(self)
-            # Calculate the page number (1-based)
+        if self.topic_id:
             posts_per_page = 15
-            page_number = max((index // posts_per_page) + 1, 1)  # Ensure at least page 1
-            return page_number
+            return max(((self.get_relative_id - 1) // posts_per_page) + 1, 1)  # Ensure at least page 1
         return None
     
     @property
     def get_relative_id(self):
         """Get the relative ID of this post in the topic."""
+        if self.position is not None:
+            return self.position
         if self.topic:
             # Get all posts in the topic, ordered by created time
             posts = list(self.topic.public_replies.all().order_by('created_time'))
@@ -529,13 +577,18 @@ class Post(models.Model):
     
     @property
     def get_raw_text(self):
-        """Get the raw text of this post, without bbcode tags using the strip_bbcode function."""
-        # Use the strip_bbcode function to remove BBCode tags
-        return strip_bbcode(self.text)
+        """Get the raw text of this post, without bbcode tags (see strip_bbcode)."""
+        # Stored at save time, see forum/bbcode_render.py
+        return get_plain_field(self, 'text')
     
     @property
     def get_absolute_url(self):
         return f"/p{self.id}"
+
+    @property
+    def get_text_html(self):
+        """Get the rendered HTML of the post (stored at save time)."""
+        return get_rendered_field(self, 'text')
     
     def get_short_text(self, length=100):
         """Get a shortened version of the post's raw text."""
@@ -547,71 +600,19 @@ class Post(models.Model):
 
     def save(self, *args, **kwargs):
 
+        # Render the BBCode once here instead of on every page view
+        update_rendered_field(self, 'text', kwargs)
+
         # If this is a new post
         if self.pk is None:
             cprint(f"New post {self} created")
 
-            # Increment total_messages for the forum
-            try:
-                UTF, _ = Forum.objects.get_or_create(name='UTF')
-                UTF.total_messages += 1
-                UTF.save()
-            except Exception as e:
-                cprint(f"ERROR : Forum UTF not found ({e})")
-
-            # Increment message count for author's profile
-            if self.author:
-                if self.author.profile:
-                    self.author.profile.messages_count += 1
-                    self.author.profile.save()
-                    cprint(f"Message count for {self.author} incremented to {self.author.profile.messages_count}")
-
-            # # Update latest message time for the topic
-            # if self.topic:
-            #     latest_message = self.topic.get_latest_message
-            #     if latest_message:
-            #         self.topic.last_message_time = timezone.now() # this is ugly and should be fixed with a signal or something
-            #         self.topic.save()
-            #         print(f"Latest message time for {self.topic} updated to {self.topic.last_message_time}")
-            #     else:
-            #         print("No messages found")
-
-            # Increment total_replies for all ancestor topics and the topic itself
-            if self.topic:
-                current = self.topic
-                while current.parent is not None:
-                    current.total_replies += 1
-                    current.save()
-                    cprint(f"Total replies for {current} incremented to {current.total_replies}")
-                    current = current.parent
-                current.total_replies += 1
-                current.save()
-
-            # Check if author now has enough messages to be promoted to a new group
-            if self.author:
-                if self.author.profile:
-                    # Exclude groups that the user is already in
-                    user_groups = self.author.profile.groups.all()
-                    for group in ForumGroup.objects.filter(is_messages_group=True).exclude(id__in=user_groups).order_by('-priority'):
-                        if self.author.profile.messages_count >= group.minimum_messages:
-                            self.author.profile.groups.add(group)
-                            self.author.profile.name_color = group.color if group.color else "#FFFFFF"  # Set the name color to the group's color
-                            self.author.profile.save()
-                            cprint(f"{self.author} promoted to {group} with color {group.color}")
-
-            # Update the topic's latest message
-            super().save(*args, **kwargs) # Save the post first
-            current_topic = self.topic
-            counter = 0
-            while current_topic:
-                # Update the topic's latest message to this post
-                current_topic.latest_message = self
-                current_topic.last_message_time = self.created_time
-                current_topic.save()
-                cprint(f"Latest message for {current_topic} updated to {self} at {self.created_time} (pass {counter})")
-                # Update the parents subforums as well
-                current_topic = current_topic.parent
-                counter += 1
+            # The post and all the counters are saved together, with one UPDATE per table whatever the subforum depth
+            with transaction.atomic():
+                self.position = self.get_next_position()
+                super().save(*args, **kwargs) # Save the post first, the topics point to it
+                self.update_counters_on_create()
+                transaction.on_commit(touch_forum_read_state) # the cached unread flags are outdated (see forum/read_state.py)
 
         # If this is an edit
         else:
@@ -620,10 +621,88 @@ class Post(models.Model):
             super().save(*args, **kwargs)
 
 
+    def get_next_position(self):
+        """Get the position of a new post at the end of its topic (to call in a transaction)."""
+        if not self.topic_id:
+            return None
+        # Lock the topic, so that concurrent replies can't get the same position
+        list(Topic.objects.select_for_update().filter(pk=self.topic_id).values_list('pk', flat=True))
+        public_posts = Post.objects.filter(topic_id=self.topic_id, author__profile__is_hidden=False)
+        last_position = public_posts.aggregate(last_position=Max('position'))['last_position']
+        if last_position is None and public_posts.exists():
+            return None # the positions of this topic were not backfilled yet
+        return (last_position or 0) + 1
+
+    def update_counters_on_create(self):
+        """Increment the forum, topics and author counters for this new post, and promote the author if needed."""
+        # Increment total_messages for the forum
+        if not Forum.objects.filter(name='UTF').update(total_messages=F('total_messages') + 1):
+            Forum.objects.create(name='UTF', total_messages=1)
+
+        # Increment total_replies and update the latest message for the topic and all its ancestors
+        if self.topic:
+            Topic.objects.filter(id__in=topic_ancestors_subquery(self.topic_id)).update(
+                total_replies=F('total_replies') + 1,
+                latest_message=self,
+                last_message_time=self.created_time,
+            )
+            # Keep the topics already loaded in sync (without querying the parents that are not)
+            current = self.topic
+            while current is not None:
+                current.total_replies += 1
+                current.latest_message = self
+                current.last_message_time = self.created_time
+                current = current.parent if Topic.parent.is_cached(current) else None
+            cprint(f"Total replies and latest message updated for {self.topic} and its parents")
+
+        # Increment message count for author's profile
+        if self.author:
+            profile = self.author.profile
+            Profile.objects.filter(pk=profile.pk).update(messages_count=F('messages_count') + 1)
+            profile.messages_count += 1
+            cprint(f"Message count for {self.author} incremented to {profile.messages_count}")
+
+            # Check if author now has enough messages to be promoted to a new group
+            eligible_group_ids = [group_id for group_id, minimum_messages in get_messages_group_ladder() if profile.messages_count >= minimum_messages]
+            if eligible_group_ids:
+                # Exclude groups that the user is already in
+                user_group_ids = set(profile.groups.values_list('id', flat=True))
+                new_group_ids = [group_id for group_id in eligible_group_ids if group_id not in user_group_ids]
+                new_groups = list(ForumGroup.objects.filter(id__in=new_group_ids, is_messages_group=True).order_by('-priority')) if new_group_ids else []
+                if new_groups:
+                    profile.groups.add(*new_groups)
+                    profile.name_color = new_groups[-1].color or "#FFFFFF"  # Set the name color to the (lowest) group's color, like before
+                    Profile.objects.filter(pk=profile.pk).update(name_color=profile.name_color)
+                    cprint(f"{self.author} promoted to {', '.join(str(group) for group in new_groups)} with color {profile.name_color}")
+
     def __str__(self):
         return f"{self.author}'s reply on {self.topic}"
 
-class Topic(models.Model):
+def renumber_post_positions(topic_ids, batch_size=1000):
+    """Recompute the position of all the posts of these topics (see Post.position). Returns the number of updated posts."""
+    updated = 0
+    for topic_id in topic_ids:
+        posts = Post.objects.filter(topic_id=topic_id).order_by('created_time', 'id').values_list('id', 'position', 'author__profile__is_hidden')
+        changed = []
+        public_count = 0
+        for post_id, position, is_hidden in posts.iterator():
+            if is_hidden is False: # (a post without author or profile is not public either)
+                public_count += 1
+                new_position = public_count
+            else:
+                new_position = public_count + 1
+            if position != new_position:
+                changed.append(Post(id=post_id, position=new_position))
+        Post.objects.bulk_update(changed, ['position'], batch_size=batch_size)
+        updated += len(changed)
+    return updated
+
+def topic_ancestors_subquery(topic_id):
+    """Subquery selecting the ids of a topic and of all its parents, to use with id__in (one query whatever the subforum depth)."""
+    return TopicClosure.objects.filter(descendant_id=topic_id).values('ancestor_id')
+
+class Topic(TopicTreeMixin, models.Model):
+    closure_model_name = 'TopicClosure' # see forum/topic_tree.py
     author = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="topics", null=True, blank=True)
     title = models.CharField(max_length=60, null=True, blank=True)
     description = models.CharField(max_length=255, null=True, blank=True)
@@ -661,17 +740,8 @@ class Topic(models.Model):
             return self.latest_message
         else:
             if self.is_sub_forum:
-                # Collect all descendant topics including self using BFS
-                all_topics = []
-                queue = deque([self])
-
-                while queue:
-                    current_topic = queue.popleft()
-                    all_topics.append(current_topic)
-                    queue.extend(current_topic.children.all())
-
-                # Get the latest post from all collected topics
-                latest_post = Post.objects.filter(topic__in=all_topics, author__profile__is_hidden=False).order_by('-created_time').first()
+                # Get the latest post from this subforum and all the topics under it
+                latest_post = Post.objects.filter(topic__in=TopicClosure.objects.filter(ancestor_id=self.id).values('descendant_id'), author__profile__is_hidden=False).order_by('-created_time').first()
                 self.latest_message = latest_post
                 self.save() # Save the topic to update the latest_message field
                 return latest_post
@@ -685,21 +755,9 @@ class Topic(models.Model):
     @property
     def get_tree(self):
         """Get the tree of topics starting from its parent, then its parent's parent, and stop at the root topic."""
-        tree = {}
-        if self.is_sub_forum: # this is because xooit is weird and the tree structure is different for sub forums, they include themselves in the tree but not the topics
-            current = self
-        else:
-            current = self.parent
-        while current:
-            if current not in tree:
-                tree[current] = []
-            if current.parent:
-                if current.parent not in tree:
-                    tree[current.parent] = [current]
-                else:
-                    tree[current.parent].append(current)
-            current = current.parent
-        return {parent: children for parent, children in reversed(tree.items())} # Reverse the tree so that the root topic is at the left
+        # this is because xooit is weird and the tree structure is different for sub forums, they include themselves in the tree but not the topics
+        chain = list(self.ancestors(include_self=self.is_sub_forum)) # from the root topic, so that it is at the left
+        return {topic: chain[index + 1:index + 2] for index, topic in enumerate(chain)}
     
     @property
     def get_absolute_url(self):
@@ -719,13 +777,17 @@ class Topic(models.Model):
     @property
     def get_depth(self):
         """Get the depth of this topic in the tree."""
-        depth = 0
-        current = self
-        while current.parent:
-            depth += 1
-            current = current.parent
-        return depth
+        return self.ancestor_links.filter(depth__gt=0).count()
     
+    @property
+    def get_total_views(self):
+        """Get the views of this topic, including the ones that are still buffered (see forum/view_counter.py).
+        The pages listing topics get the buffered views of all of them at once, with set_pending_views()."""
+        pending_views = getattr(self, 'pending_views', None)
+        if pending_views is None:
+            pending_views = get_pending_views([self.id]).get(self.id, 0)
+        return self.total_views + pending_views
+
     @property
     def get_max_page(self):
         """Get the maximum page number for this topic."""
@@ -760,11 +822,8 @@ class Topic(models.Model):
         # Get all direct child topics of this subforum
         child_topics = subforum.children.all()
 
-        # Get read statuses for these topics in bulk
-        read_statuses = TopicReadStatus.objects.filter(user=user,topic__in=child_topics).values('topic_id', 'last_read')
-
-        # Build a lookup dictionary {topic_id: last_read_time}
-        read_status_map = {rs['topic_id']: rs['last_read'] for rs in read_statuses}
+        # Get read times for these topics in bulk (rows and watermarks) {topic_id: last_read_time}
+        read_status_map = get_read_times(user, child_topics)
 
         # Check each child topic
         for topic in child_topics:
@@ -844,6 +903,22 @@ class Topic(models.Model):
                 return f"{self.title} by {self.author}"
 
 
+class TopicClosure(TopicClosureBase):
+    """One (ancestor, descendant) pair of the subforums tree, see forum/topic_tree.py."""
+    ancestor = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='ancestor_links')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_topic_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id} ({self.depth})"
+
 class Forum(models.Model):
     name = models.CharField(max_length=20)
     announcement_topics = models.ManyToManyField(Topic, blank=True)
@@ -883,6 +958,26 @@ class TopicReadStatus(models.Model):
 
     def __str__(self):
         return f"{self.user} last read {self.topic} at {self.last_read}"
+
+
+class ReadWatermark(models.Model):
+    """Everything before read_before is read by the user: in the whole forum (no category and no subforum), in a
+    category, or under a subforum (see forum/read_state.py)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_watermarks')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
+    subforum = models.ForeignKey(Topic, on_delete=models.CASCADE, null=True, blank=True)
+    read_before = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=models.Q(category__isnull=True, subforum__isnull=True), name='unique_global_read_watermark'),
+            models.UniqueConstraint(fields=['user', 'category'], condition=models.Q(subforum__isnull=True), name='unique_category_read_watermark'),
+            models.UniqueConstraint(fields=['user', 'subforum'], condition=models.Q(category__isnull=True), name='unique_subforum_read_watermark'),
+        ]
+
+    def __str__(self):
+        scope = self.subforum or self.category or "everything"
+        return f"{self.user} read {scope} before {self.read_before}"
     
 
 
@@ -1081,6 +1176,9 @@ class PrivateMessage(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pm_messages_sent')
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pm_messages_received')
     text = models.TextField(max_length=65535)
+    _text_rendered = models.TextField(null=True, blank=True, editable=False) # Rendered HTML of the text, see forum/bbcode_render.py
+    _text_rendered_version = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    _text_plain = models.TextField(null=True, blank=True, editable=False) # Plain text of the text, for the previews and notifications
     created_time = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_read = models.BooleanField(default=False)
@@ -1092,7 +1190,7 @@ class PrivateMessage(models.Model):
     
     def get_short_text(self, length=100):
         """Get a shortened version of the message's raw text."""
-        raw_text = strip_bbcode(self.text)
+        raw_text = get_plain_field(self, 'text')
         if len(raw_text) <= length:
             return raw_text
         else:
@@ -1100,6 +1198,15 @@ class PrivateMessage(models.Model):
         
     def get_absolute_url(self):
         return f"/pm_details/{self.id}"
+
+    @property
+    def get_text_html(self):
+        """Get the rendered HTML of the message (stored at save time)."""
+        return get_rendered_field(self, 'text')
+
+    def save(self, *args, **kwargs):
+        update_rendered_field(self, 'text', kwargs)
+        super().save(*args, **kwargs)
         
     def __str__(self):
         return f"Response {self.get_relative_id} by {self.author.username} to {self.recipient.username} in PM Thread: {self.thread.title}"
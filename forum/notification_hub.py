@@ -0,0 +1,204 @@
+# forum/notification_hub.py
+
+import asyncio
+import json
+import os
+import socket
+import time
+import re
+import weakref
+from utf.utils import cprint
+from .notifications import STREAM_KEY, get_stream_maxlen
+
+# sse_post_event used to open one Redis connection and subscription per connected tab, and to poll it every 0.1s.
+# Now each process has one NotificationHub (per event loop) with one Redis connection, pattern-subscribed to all the
+# user_notifications_<user_id> channels. It dispatches the messages into an asyncio.Queue per connected stream, and
+# the streams wait on their queue (with a heartbeat when nothing comes).
+# A full queue (a stream that doesn't read) drops its oldest message. The number of streams and the depth of the queues
+# are reported to Redis every STATS_INTERVAL seconds by each process, see get_notification_stats() and
+# "python manage.py notification_stats".
+# The messages are "<stream id>\n<notification>" (see forum/notifications.py): the queues get (event_id, data), and
+# read_missed() gets the notifications after a Last-Event-ID from the Redis Stream of the user.
+
+CHANNEL_PATTERN = "user_notifications_*"
+CHANNEL_PREFIX = "user_notifications_"
+STATS_KEY = "utf_forum:notifications:stats" # hash of the stats of each process (JSON)
+
+# Messages kept for a stream that doesn't read them
+QUEUE_SIZE = 100
+# How long to wait before connecting again after a Redis error
+RECONNECT_DELAY = 2 # seconds
+# How often each process reports its stats, and how long they are counted
+STATS_INTERVAL = 30 # seconds
+STATS_TIMEOUT = 2 * STATS_INTERVAL # seconds
+
+EVENT_ID_RE = re.compile(r"^\d+-\d+$")
+
+_hubs = weakref.WeakKeyDictionary() # event loop: NotificationHub
+
+
+def parse_message(message):
+    """Get the (event_id, data) of a published message (event_id is None for the messages without one)."""
+    event_id, separator, data = message.partition("\n")
+    if separator and EVENT_ID_RE.match(event_id):
+        return event_id, data
+    return None, message
+
+def event_id_key(event_id):
+    """Sort key of a Redis Stream id ("<milliseconds>-<sequence>")."""
+    milliseconds, _, sequence = event_id.partition("-")
+    return int(milliseconds), int(sequence)
+
+def format_event(event_id, data):
+    """An SSE event, with its id when it has one (sent back by the browser as Last-Event-ID when it reconnects)."""
+    if event_id is None:
+        return f"data: {data}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+def get_redis_url():
+    """The URL of the Redis server of the notifications (same logic as forum/signals.py)."""
+    if os.getenv('DEVELOPMENT_MODE', 'False') == 'True':
+        return "redis://localhost:6379"
+    return os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+
+class NotificationHub:
+    """The Redis subscriber of one process (and event loop), shared by all its notification streams."""
+
+    def __init__(self):
+        self.queues = {} # user_id: set of the queues of their streams
+        self.dropped = 0
+        self.process_name = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self._listener = None
+        self._reporter = None
+        self._client = None
+
+    def connect(self, user_id):
+        """Get a new queue receiving the notifications of a user (remove it with disconnect())."""
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.queues.setdefault(user_id, set()).add(queue)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+            self._reporter = asyncio.create_task(self._report_stats())
+        return queue
+
+    def disconnect(self, user_id, queue):
+        queues = self.queues.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.queues[user_id]
+        if not self.queues:
+            # No more streams: close the Redis connection (and remove the stats of this process)
+            for task in (self._listener, self._reporter):
+                if task is not None:
+                    task.cancel()
+            self._listener = self._reporter = None
+
+    def dispatch(self, channel, message):
+        """Put a message in the queues of the streams of the user of a channel."""
+        try:
+            user_id = int(channel[len(CHANNEL_PREFIX):])
+        except ValueError:
+            return
+        event = parse_message(message)
+        for queue in self.queues.get(user_id, ()):
+            if queue.full():
+                queue.get_nowait() # (the oldest one)
+                self.dropped += 1
+            queue.put_nowait(event)
+
+    async def read_missed(self, user_id, last_event_id):
+        """Get the (event_id, data) of the notifications of a user after last_event_id, from their Redis Stream
+        (the ones still kept, see NOTIFICATION_STREAM_MAXLEN and NOTIFICATION_STREAM_TTL)."""
+        if not EVENT_ID_RE.match(last_event_id or ""):
+            return []
+        client = await self._get_client()
+        entries = await client.xrange(STREAM_KEY.format(user_id=user_id), min=f"({last_event_id}", max="+", count=get_stream_maxlen())
+        return [(event_id.decode('utf-8'), fields[b'data'].decode('utf-8')) for event_id, fields in entries]
+
+    def get_stats(self):
+        depths = [queue.qsize() for queues in self.queues.values() for queue in queues]
+        return {
+            'streams': len(depths),
+            'users': len(self.queues),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'dropped': self.dropped,
+            'time': time.time(),
+        }
+
+    async def _get_client(self):
+        import redis.asyncio as redis
+        if self._client is None:
+            self._client = redis.from_url(get_redis_url(), socket_connect_timeout=5)
+        return self._client
+
+    async def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                client = await self._get_client()
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                await pubsub.psubscribe(CHANNEL_PATTERN)
+                cprint(f"Notification hub subscribed to {CHANNEL_PATTERN} ({len(self.queues)} user(s) connected)")
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'].decode('utf-8'), message['data'].decode('utf-8'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                cprint(f"Notification hub: Redis error, reconnecting in {RECONNECT_DELAY}s ({e})")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+
+    async def _report_stats(self):
+        try:
+            while True:
+                try:
+                    client = await self._get_client()
+                    await client.hset(STATS_KEY, self.process_name, json.dumps(self.get_stats()))
+                except Exception as e:
+                    cprint(f"Notification hub: could not report the stats ({e})")
+                await asyncio.sleep(STATS_INTERVAL)
+        finally:
+            try:
+                client = await self._get_client()
+                await client.hdel(STATS_KEY, self.process_name)
+            except Exception:
+                pass
+
+
+def get_hub():
+    """Get the hub of the current event loop."""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = NotificationHub()
+    return hub
+
+def get_notification_stats():
+    """Get the stats of the notification streams of all the processes (the ones reported in the last STATS_TIMEOUT
+    seconds), and their total."""
+    from .signals import redis_client # (forum.signals imports the models)
+    if redis_client is None:
+        return None
+    now = time.time()
+    processes = {}
+    for name, value in redis_client.hgetall(STATS_KEY).items():
+        stats = json.loads(value)
+        if now - stats['time'] <= STATS_TIMEOUT:
+            processes[name.decode('utf-8') if isinstance(name, bytes) else name] = stats
+    total = {
+        'streams': sum(stats['streams'] for stats in processes.values()),
+        'users': sum(stats['users'] for stats in processes.values()),
+        'queued': sum(stats['queued'] for stats in processes.values()),
+        'max_queue_depth': max((stats['max_queue_depth'] for stats in processes.values()), default=0),
+        'dropped': sum(stats['dropped'] for stats in processes.values()),
+    }
+    return {'processes': processes, 'total': total}
@@ -0,0 +1,116 @@
+# forum/notifications.py
+
+import json
+import logging
+from django.conf import settings
+from django.db import transaction
+from utf.utils import cprint
+
+logger = logging.getLogger(__name__)
+
+# The notifications of the new posts and topics (to the watchers of the topic, of its parent subforums and of its
+# category, and to the followers of the author) are sent by Celery tasks started after the commit (see forum/tasks.py),
+# so the time to post doesn't depend on the number of recipients anymore. The recipients are one UNION query over the
+# watchers and followers tables, the payload is built once and published to all of them with one Redis pipeline.
+# When Celery is unavailable, the notifications are sent in the request like before.
+# Each notification is also added to a capped Redis Stream of the user (NOTIFICATION_STREAM_MAXLEN notifications, kept
+# NOTIFICATION_STREAM_TTL seconds after the last one), and published with its stream id ("<id>\n<payload>"): the
+# notification streams send it as the SSE id, and replay the missed notifications from the Redis Stream when a browser
+# reconnects with a Last-Event-ID (see sse_post_event and forum/notification_hub.py).
+
+CHANNEL_NAME = "user_notifications_{user_id}"
+STREAM_KEY = "utf_forum:notifications:stream:{user_id}"
+
+
+def get_stream_maxlen():
+    return getattr(settings, 'NOTIFICATION_STREAM_MAXLEN', 100)
+
+def get_stream_ttl():
+    return getattr(settings, 'NOTIFICATION_STREAM_TTL', 24 * 60 * 60)
+
+
+def get_recipient_ids(author_id, category_id=None, topic_id=None):
+    """Get the ids of the users to notify (one query): the watchers of the topic and of all its parents, of the
+    category, and the followers of the author (never the author)."""
+    from .models import Topic, Category, Profile, topic_ancestors_subquery
+    recipients = Profile.followers.through.objects.filter(profile__user_id=author_id).values_list('user_id', flat=True)
+    if category_id is not None:
+        recipients = recipients.union(Category.watchers.through.objects.filter(category_id=category_id).values_list('user_id', flat=True))
+    if topic_id is not None:
+        recipients = recipients.union(Topic.watchers.through.objects.filter(topic_id__in=topic_ancestors_subquery(topic_id)).values_list('user_id', flat=True))
+    return set(recipients) - {author_id}
+
+def publish_notification(user_ids, notification):
+    """Add a notification to the streams of these users and publish it to their channels (two Redis round trips).
+    Returns the number of users."""
+    from .signals import redis_client # (forum.signals imports the models)
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    if redis_client is None:
+        logger.warning("Redis client not available, skipping notification")
+        return 0
+    payload = json.dumps(notification)
+    try:
+        # Add it to the stream of each user first, to publish it with its id
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            stream_key = STREAM_KEY.format(user_id=user_id)
+            pipe.xadd(stream_key, {'data': payload}, maxlen=get_stream_maxlen(), approximate=True)
+            pipe.expire(stream_key, get_stream_ttl())
+        event_ids = pipe.execute()[::2]
+
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id, event_id in zip(user_ids, event_ids):
+            event_id = event_id.decode('utf-8') if isinstance(event_id, bytes) else event_id
+            pipe.publish(CHANNEL_NAME.format(user_id=user_id), f"{event_id}\n{payload}")
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to publish notification to Redis: {e}")
+        return 0
+    cprint(f"Published notification to {len(user_ids)} user(s)")
+    return len(user_ids)
+
+def notify_new_post(post_id):
+    """Notify the watchers and followers of a new reply (not for the first post of a topic)."""
+    from .models import Post
+    post = Post.objects.select_related('author', 'topic').filter(id=post_id).first()
+    if post is None or post.topic is None or post.author is None or post.get_relative_id == 1:
+        return 0
+    topic = post.topic
+    notification = {
+        'message': f"{post.author.username} a posté une réponse sur \"{topic.get_short_title()}\".",
+        'text_preview': post.get_short_text(100),
+        'post_url': post.get_absolute_url,
+        'author_username': post.author.username,
+        'topic_full_title': topic.title,
+    }
+    return publish_notification(get_recipient_ids(post.author_id, topic.category_id, topic.id), notification)
+
+def notify_new_topic(topic_id):
+    """Notify the watchers of the parents and category of a new topic, and the followers of its author."""
+    from .models import Topic
+    topic = Topic.objects.select_related('author').filter(id=topic_id).first()
+    if topic is None or topic.author is None:
+        return 0
+    notification = {
+        'message': f"{topic.author.username} a créé un nouveau sujet \"{topic.get_short_title()}\".",
+        'text_preview': f"Cliquez ici pour voir le sujet.",
+        'post_url': topic.get_absolute_url,
+        'author_username': topic.author.username,
+        'topic_full_title': topic.title,
+    }
+    return publish_notification(get_recipient_ids(topic.author_id, topic.category_id, topic.parent_id), notification)
+
+def queue_notification(task, object_id):
+    """Start a notification task after the commit (sent in this process when Celery is unavailable)."""
+    def send():
+        try:
+            task.delay(object_id)
+        except Exception as e:
+            logger.warning(f"Celery unavailable, sending the notification in the request ({e})")
+            try:
+                task(object_id)
+            except Exception:
+                logger.error(f"Error while sending the notification of {object_id}", exc_info=True)
+    transaction.on_commit(send)
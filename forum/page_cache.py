@@ -0,0 +1,190 @@
+# forum/page_cache.py
+
+import hashlib
+import re
+import time
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+# The index, category, subforum and topic pages are the same for all the anonymous users of a theme, but they were
+# rebuilt (dozens of queries and BBCode renders) on every request. cache_anonymous_page() stores the whole response of
+# these views for anonymous GET requests, keyed by the path, the query string, the theme and the versions of the tags
+# of the page:
+# - "topic:<id>" for a topic or a subforum page (a subforum is a topic), changed by its posts, polls and children;
+# - "category:<id>" for a category page, changed by all the topics of the category;
+# - "announcements" for the announcements shown on the category and subforum pages;
+# - "index" for the index, changed by everything;
+# - "global" for all the pages, changed when a user is hidden or unhidden or when a subforum is moved.
+# touch_page_tags() sets a new version for tags (from the signals, see forum/signals.py): the pages stored with the old
+# versions are not used anymore and expire after PAGE_TIMEOUT. The CSRF tokens of the stored pages are replaced by the
+# token of each visitor. The hits and misses of each page are counted, see get_page_cache_stats().
+# The async views (see forum/views_async.py) are decorated the same way, the cache is then used with its async API.
+# The view counts and the "who is online" part can be up to PAGE_TIMEOUT seconds late.
+
+# How long a page is kept (the tags invalidate it anyway, this is for the view counts and the sidebars)
+PAGE_TIMEOUT = 5 * 60 # seconds
+
+PAGE_KEY = "utf_forum:page_cache:page:{page_name}:{theme}:{key_hash}"
+TAG_KEY = "utf_forum:page_cache:tag:{tag}"
+STATS_KEY = "utf_forum:page_cache:stats:{page_name}:{result}"
+
+GLOBAL_TAG = "global"
+INDEX_TAG = "index"
+ANNOUNCEMENTS_TAG = "announcements"
+
+# The pages using cache_anonymous_page (for the stats)
+CACHED_PAGES = ('index', 'category_details', 'subforum_details', 'topic_details')
+
+CSRF_INPUT_RE = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_PLACEHOLDER = b"__utf_page_cache_csrf_token__"
+
+
+def topic_tag(topic_id):
+    return f"topic:{topic_id}"
+
+def category_tag(category_id):
+    return f"category:{category_id}"
+
+def touch_page_tags(tags):
+    """Drop the stored pages of these tags (after the current transaction, so that they are not stored again from the
+    old data meanwhile)."""
+    keys = [TAG_KEY.format(tag=tag) for tag in set(tags)]
+    if keys:
+        transaction.on_commit(lambda: cache.set_many({key: time.time_ns() for key in keys}, None))
+
+def touch_topic_pages(topic_ids, category_id=None, is_announcement=False):
+    """Drop the stored pages showing these topics: their own pages and the pages of all their parents (one query for
+    the parents, from the closure table), their category page and the index."""
+    from .models import TopicClosure
+    topic_ids = [topic_id for topic_id in topic_ids if topic_id is not None]
+    tags = [INDEX_TAG]
+    if category_id is not None:
+        tags.append(category_tag(category_id))
+    if is_announcement:
+        tags.append(ANNOUNCEMENTS_TAG)
+    if topic_ids:
+        tags += [topic_tag(topic_id) for topic_id in topic_ids]
+        for ancestor_id, ancestor_category_id, ancestor_is_announcement in TopicClosure.objects.filter(
+            descendant_id__in=topic_ids
+        ).values_list('ancestor_id', 'ancestor__category_id', 'ancestor__is_announcement'):
+            tags.append(topic_tag(ancestor_id))
+            if ancestor_category_id is not None:
+                tags.append(category_tag(ancestor_category_id))
+            if ancestor_is_announcement:
+                tags.append(ANNOUNCEMENTS_TAG)
+    touch_page_tags(tags)
+
+def touch_all_pages():
+    """Drop all the stored pages."""
+    touch_page_tags([GLOBAL_TAG])
+
+def _get_theme(request):
+    theme = request.COOKIES.get('theme', settings.DEFAULT_THEME)
+    if theme not in settings.THEME_LIST:
+        theme = settings.DEFAULT_THEME
+    return theme
+
+def _count(page_name, result):
+    key = STATS_KEY.format(page_name=page_name, result=result)
+    try:
+        cache.incr(key)
+    except ValueError: # (first one)
+        cache.set(key, 1, None)
+
+def _make_entry(response):
+    """What is stored for a page: the content (with a placeholder instead of the CSRF tokens) and its content type."""
+    content = CSRF_INPUT_RE.sub(rb'\g<1>' + CSRF_PLACEHOLDER + rb'\g<2>', response.content)
+    return {'content': content, 'content_type': response.get('Content-Type')}
+
+def _make_response(request, entry):
+    content = entry['content']
+    if CSRF_PLACEHOLDER in content:
+        content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode())
+    return HttpResponse(content, content_type=entry['content_type'])
+
+def _get_page_key(request, page_name, tag_keys, versions):
+    return PAGE_KEY.format(
+        page_name=page_name,
+        theme=_get_theme(request),
+        key_hash=hashlib.md5("|".join(
+            [request.get_full_path()] + [f"{key}={versions.get(key, 0)}" for key in tag_keys]
+        ).encode()).hexdigest(),
+    )
+
+def _can_store(response):
+    return response.status_code == 200 and not response.streaming and not response.cookies
+
+def cache_anonymous_page(page_name, get_tags):
+    """Decorator storing the responses of a view (sync or async) for the anonymous users. get_tags gets the arguments
+    of the view (from the URL) and returns the tags of the page, see topic_tag() and category_tag()."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD') or (await request.auser()).is_authenticated:
+                    return await view(request, *args, **kwargs)
+
+                tag_keys = [TAG_KEY.format(tag=tag) for tag in (GLOBAL_TAG, *get_tags(*args, **kwargs))]
+                key = _get_page_key(request, page_name, tag_keys, await cache.aget_many(tag_keys))
+
+                entry = await cache.aget(key)
+                if entry is not None:
+                    await sync_to_async(_count)(page_name, 'hits')
+                    response = _make_response(request, entry)
+                    response['X-Page-Cache'] = 'HIT'
+                    return response
+
+                await sync_to_async(_count)(page_name, 'misses')
+                response = await view(request, *args, **kwargs)
+                if _can_store(response):
+                    await cache.aset(key, _make_entry(response), PAGE_TIMEOUT)
+                    response['X-Page-Cache'] = 'MISS'
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            # The versions are read before the view, so a page built while its tags change is stored with the old ones
+            tag_keys = [TAG_KEY.format(tag=tag) for tag in (GLOBAL_TAG, *get_tags(*args, **kwargs))]
+            key = _get_page_key(request, page_name, tag_keys, cache.get_many(tag_keys))
+
+            entry = cache.get(key)
+            if entry is not None:
+                _count(page_name, 'hits')
+                response = _make_response(request, entry)
+                response['X-Page-Cache'] = 'HIT'
+                return response
+
+            _count(page_name, 'misses')
+            response = view(request, *args, **kwargs)
+            if _can_store(response):
+                cache.set(key, _make_entry(response), PAGE_TIMEOUT)
+                response['X-Page-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+def get_page_cache_stats():
+    """Get the hits, misses and hit ratio of each cached page, and of all of them ('total')."""
+    counts = cache.get_many([STATS_KEY.format(page_name=page_name, result=result) for page_name in CACHED_PAGES for result in ('hits', 'misses')])
+    stats = {}
+    for page_name in (*CACHED_PAGES, 'total'):
+        if page_name == 'total':
+            hits = sum(page['hits'] for page in stats.values())
+            misses = sum(page['misses'] for page in stats.values())
+        else:
+            hits = counts.get(STATS_KEY.format(page_name=page_name, result='hits'), 0)
+            misses = counts.get(STATS_KEY.format(page_name=page_name, result='misses'), 0)
+        stats[page_name] = {'hits': hits, 'misses': misses, 'hit_ratio': hits / (hits + misses) if hits + misses else None}
+    return stats
+
+def reset_page_cache_stats():
+    cache.delete_many([STATS_KEY.format(page_name=page_name, result=result) for page_name in CACHED_PAGES for result in ('hits', 'misses')])
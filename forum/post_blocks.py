@@ -0,0 +1,105 @@
+# forum/post_blocks.py
+
+import re
+import secrets
+import time
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from .bbcode_render import get_render_version
+
+# The HTML of a post in topic_details.html (rendered message, signature, author panel, group...) is the same for all the
+# viewers, so it is rendered from themes/<theme>/includes/_post_block.html once and cached. The key changes with:
+# - the post (its update_count changes when it is edited);
+# - its author (a token changed when the profile, the user or their groups change, and their number of messages);
+# - the groups (a token changed when a group changes: colors, names, icons);
+# - the BBCode render version and the theme.
+# The parts that depend on the viewer are markers in the template ({{markers.<name>}}), replaced for each request:
+# "online" by online/offline (for the avatar classes), the VIEWER_CONTROLS by their template
+# (themes/<theme>/includes/_post_<name>.html) or by nothing. The markers contain a random token made for each render
+# and the block is cached already split at them, so a post or a signature can't contain a marker. A page of posts is
+# then two cache.get_many calls, and only the new or changed posts are rendered.
+
+# How long a post block is kept (the keys change anyway, this is only to free the space)
+BLOCK_TIMEOUT = 24 * 60 * 60 # seconds
+
+BLOCK_KEY = "utf_forum:post_block:v2:{theme}:{post_id}:{update_count}:{author_token}:{messages_count}:{groups_token}:{render_version}"
+AUTHOR_TOKEN_KEY = "utf_forum:post_block:author:{user_id}"
+GROUPS_TOKEN_KEY = "utf_forum:post_block:groups"
+
+ONLINE_MARKER = "online"
+MARKER_FORMAT = "\ue000{token}:{name}\ue000"
+
+# name: who sees it (the request, the post and whether the viewer is staff)
+VIEWER_CONTROLS = {
+    'edit': lambda request, post, is_staff: is_staff or (request.user.is_authenticated and request.user.id == post.author_id),
+    'member_links': lambda request, post, is_staff: request.user.is_authenticated,
+}
+
+
+def touch_post_block_author(user_id):
+    """Drop the cached blocks of the posts of a user (after a change of their profile)."""
+    cache.set(AUTHOR_TOKEN_KEY.format(user_id=user_id), time.time_ns(), None)
+
+def touch_post_block_groups():
+    """Drop all the cached blocks (after a change of a group)."""
+    cache.set(GROUPS_TOKEN_KEY, time.time_ns(), None)
+
+def _is_staff(request):
+    if not request.user.is_authenticated:
+        return False
+    profile = getattr(request.user, 'profile', None)
+    return profile is not None and profile.is_user_staff
+
+def _render_block(theme, post):
+    """Render the block of a post, as a list alternating the HTML and the names of the markers."""
+    token = secrets.token_hex(8)
+    markers = {name: MARKER_FORMAT.format(token=token, name=name) for name in [ONLINE_MARKER, *VIEWER_CONTROLS]}
+    html = render_to_string(f"themes/{theme}/includes/_post_block.html", {'post': post, 'markers': markers})
+    return re.split(MARKER_FORMAT.format(token=token, name=r"(\w+)"), html)
+
+def _add_viewer_parts(request, theme, post, parts, is_staff):
+    block = []
+    for index, part in enumerate(parts):
+        if index % 2 == 0:
+            block.append(part)
+        elif part == ONLINE_MARKER:
+            block.append("online" if getattr(post, 'user_is_online', False) else "offline")
+        elif VIEWER_CONTROLS[part](request, post, is_staff):
+            block.append(render_to_string(f"themes/{theme}/includes/_post_{part}.html", {'post': post}))
+    return mark_safe("".join(block))
+
+def render_post_blocks(request, theme, posts):
+    """Set post.block_html for each post of a page (the author and profile must be loaded with select_related)."""
+    posts = list(posts)
+    if not posts:
+        return posts
+
+    author_keys = {post.author_id: AUTHOR_TOKEN_KEY.format(user_id=post.author_id) for post in posts}
+    tokens = cache.get_many(list(author_keys.values()) + [GROUPS_TOKEN_KEY])
+    render_version = get_render_version()
+    keys = {
+        post.id: BLOCK_KEY.format(
+            theme=theme,
+            post_id=post.id,
+            update_count=post.update_count or 0,
+            author_token=tokens.get(author_keys[post.author_id], 0),
+            messages_count=post.author.profile.messages_count,
+            groups_token=tokens.get(GROUPS_TOKEN_KEY, 0),
+            render_version=render_version,
+        )
+        for post in posts
+    }
+    blocks = cache.get_many(list(keys.values()))
+
+    rendered = {}
+    is_staff = _is_staff(request)
+    for post in posts:
+        block = blocks.get(keys[post.id])
+        if block is None:
+            block = _render_block(theme, post)
+            rendered[keys[post.id]] = block
+        post.block_html = _add_viewer_parts(request, theme, post, block, is_staff)
+    if rendered:
+        cache.set_many(rendered, BLOCK_TIMEOUT)
+    return posts
@@ -0,0 +1,178 @@
+# forum/presence.py
+
+import threading
+import time
+import datetime
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+from utf.utils import cprint
+
+# Who is online is not read from Profile.last_login anymore (it was one COUNT on every page, and one query per online
+# list on most pages, plus a Profile.save() every 15 minutes per user). record_activity() puts the user in a Redis
+# sorted set (user id: time of the last request), or in this process when Redis is unavailable, and the online lists
+# and counts are read from there.
+# Profile.last_login is still kept up to date, in bulk: flush_presence() writes the buffered activity times and the
+# online record of the forum, from the "flush-presence" Celery beat task (see forum/tasks.py and CELERY_BEAT_SCHEDULE).
+
+# A user is online if they made a request in this window
+ONLINE_WINDOW = 30 * 60 # seconds
+# How often the buffer in this process is flushed when Redis is unavailable
+LOCAL_FLUSH_INTERVAL = 60 # seconds
+# How long to stop trying Redis after a connection error
+REDIS_RETRY_DELAY = 30 # seconds
+# Number of profiles updated per query by flush_presence()
+FLUSH_BATCH_SIZE = 500
+
+ONLINE_KEY = "utf_forum:presence:online" # sorted set of the visible users, scored by the time of their last request
+PENDING_KEY = "utf_forum:presence:pending" # hash of the last request times not written to Profile.last_login yet
+FLUSHING_KEY = "utf_forum:presence:flushing"
+
+_local_online = {} # user_id: time of the last request (visible users only)
+_local_pending = {} # user_id: time of the last request
+_local_lock = threading.Lock()
+_local_last_flush = time.monotonic()
+_redis_retry_time = 0
+
+
+def _get_redis():
+    """Get the Redis client of the notifications, or None when it is unavailable."""
+    from .signals import redis_client # (forum.signals imports the models)
+    if redis_client is None or time.monotonic() < _redis_retry_time:
+        return None
+    return redis_client
+
+def _redis_failed(e):
+    global _redis_retry_time
+    _redis_retry_time = time.monotonic() + REDIS_RETRY_DELAY
+    cprint(f"Presence: Redis unavailable, using the local tracker for {REDIS_RETRY_DELAY}s ({e})")
+
+
+def record_activity(user_id, hidden=False):
+    """Record a request of the user (hidden users are not shown online, but their last_login is still updated)."""
+    now = time.time()
+    client = _get_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            if hidden:
+                pipe.zrem(ONLINE_KEY, user_id)
+            else:
+                pipe.zadd(ONLINE_KEY, {user_id: now})
+            pipe.hset(PENDING_KEY, user_id, now)
+            pipe.execute()
+            return
+        except Exception as e:
+            _redis_failed(e)
+
+    with _local_lock:
+        if hidden:
+            _local_online.pop(user_id, None)
+        else:
+            _local_online[user_id] = now
+        _local_pending[user_id] = now
+        flush_due = time.monotonic() - _local_last_flush > LOCAL_FLUSH_INTERVAL
+
+    # Without Redis, the beat task can't see the buffer of this process: flush it from here once in a while
+    if flush_due:
+        flush_local_presence()
+
+def get_online_user_ids():
+    """Get the ids of the users online (visible users with a request in the last ONLINE_WINDOW seconds)."""
+    since = time.time() - ONLINE_WINDOW
+    client = _get_redis()
+    if client is not None:
+        try:
+            return {int(user_id) for user_id in client.zrangebyscore(ONLINE_KEY, since, "+inf")}
+        except Exception as e:
+            _redis_failed(e)
+    with _local_lock:
+        return {user_id for user_id, last_seen in _local_online.items() if last_seen >= since}
+
+def get_online_count():
+    """Get the number of users online."""
+    since = time.time() - ONLINE_WINDOW
+    client = _get_redis()
+    if client is not None:
+        try:
+            return client.zcount(ONLINE_KEY, since, "+inf")
+        except Exception as e:
+            _redis_failed(e)
+    with _local_lock:
+        return sum(1 for last_seen in _local_online.values() if last_seen >= since)
+
+def get_online_users():
+    """Get the online users, ordered by username (one query, for the users themselves)."""
+    from .models import User
+    return User.objects.filter(id__in=get_online_user_ids(), profile__is_hidden=False).order_by('username')
+
+def is_user_online(user_id):
+    """Check if a user is online."""
+    return user_id in get_online_user_ids()
+
+
+def write_last_logins(last_logins):
+    """Write the activity times ({user_id: timestamp}) to Profile.last_login, one UPDATE per batch of profiles."""
+    from .models import Profile
+    user_ids = list(last_logins.keys())
+    for start in range(0, len(user_ids), FLUSH_BATCH_SIZE):
+        batch = user_ids[start:start + FLUSH_BATCH_SIZE]
+        Profile.objects.filter(user_id__in=batch).update(last_login=Case(
+            *[When(user_id=user_id, then=Value(datetime.datetime.fromtimestamp(last_logins[user_id], tz=datetime.timezone.utc))) for user_id in batch],
+            output_field=DateTimeField(),
+        ))
+    return len(user_ids)
+
+def update_online_record(online_count):
+    """Raise the online record of the forum if it was beaten (a conditional UPDATE: two flushes can't lower it)."""
+    from .models import Forum
+    if not online_count:
+        return 0
+    return Forum.objects.filter(name='UTF', online_record__lt=online_count).update(online_record=online_count, online_record_date=timezone.now())
+
+def flush_local_presence():
+    """Write the activity buffered in this process to the database."""
+    global _local_last_flush
+    since = time.time() - ONLINE_WINDOW
+    with _local_lock:
+        last_logins = dict(_local_pending)
+        _local_pending.clear()
+        for user_id in [user_id for user_id, last_seen in _local_online.items() if last_seen < since]:
+            del _local_online[user_id]
+        online_count = len(_local_online)
+        _local_last_flush = time.monotonic()
+    try:
+        written = write_last_logins(last_logins) if last_logins else 0
+    except Exception:
+        # Put them back for the next flush (unless there is a newer one)
+        with _local_lock:
+            for user_id, last_seen in last_logins.items():
+                _local_pending.setdefault(user_id, last_seen)
+        raise
+    update_online_record(online_count)
+    return written
+
+def flush_presence():
+    """Write all the buffered activity (Redis and this process) to Profile.last_login, forget the users that went
+    offline and update the online record. Returns the number of updated profiles."""
+    written = flush_local_presence()
+
+    client = _get_redis()
+    if client is None:
+        return written
+    try:
+        client.zremrangebyscore(ONLINE_KEY, "-inf", time.time() - ONLINE_WINDOW)
+        # The pending times are moved aside, so that the new requests don't wait for (or get lost in) this flush.
+        # If a flush failed, its times are still there and are written first.
+        if not client.exists(FLUSHING_KEY) and client.exists(PENDING_KEY):
+            client.rename(PENDING_KEY, FLUSHING_KEY)
+        last_logins = {int(user_id): float(last_seen) for user_id, last_seen in client.hgetall(FLUSHING_KEY).items()}
+        online_count = client.zcard(ONLINE_KEY)
+    except Exception as e:
+        _redis_failed(e)
+        return written
+
+    if last_logins:
+        written += write_last_logins(last_logins)
+        client.delete(FLUSHING_KEY)
+    update_online_record(online_count)
+    return written
@@ -0,0 +1,137 @@
+# forum/read_state.py
+
+import hashlib
+import time
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+# What a user has read is stored in two places:
+# - ReadWatermark: "everything before read_before is read", for the whole forum (no category and no subforum, set when
+#   the account is created and by "mark all as read"), for a category, or for a subforum and everything under it.
+#   Marking something as read is one UPDATE (or INSERT) of a watermark instead of one row per topic.
+# - TopicReadStatus: one row per topic read after the watermarks (updated by topic_details).
+# A topic is read if any of them is newer than its last message. get_read_times() gives the combined read times of a
+# list of topics, read_topics_filter() does the same check in SQL.
+# compact_read_statuses() (Celery beat task "compact-read-statuses") deletes the rows made useless by a newer watermark.
+# get_unread_flags() is what the listing views use: the unread flags of a whole page of topics and subforums (at any
+# depth, from the closure table) in one query, cached per user. The cached flags are dropped when the user reads or
+# marks something as read (touch_user_read_state) and when a message is posted anywhere (touch_forum_read_state).
+
+# How long the unread flags of a page are cached (they are invalidated anyway, this is only a safety net)
+UNREAD_FLAGS_TIMEOUT = 5 * 60 # seconds
+
+UNREAD_FLAGS_KEY = "utf_forum:unread:{user_id}:{user_token}:{forum_token}:{ids_hash}"
+USER_TOKEN_KEY = "utf_forum:unread:user:{user_id}"
+FORUM_TOKEN_KEY = "utf_forum:unread:forum"
+
+
+def _applicable_watermarks(user, category_ref, topic_ref):
+    """The watermarks of the user that apply to a topic (the arguments can be OuterRef)."""
+    from .models import ReadWatermark
+    return ReadWatermark.objects.filter(user=user).filter(
+        Q(category__isnull=True, subforum__isnull=True)
+        | Q(category=category_ref)
+        | Q(subforum__descendant_links__descendant=topic_ref) # the subforum or one of its parents (see forum/topic_tree.py)
+    )
+
+def mark_read(user, category=None, subforum=None, when=None):
+    """Mark everything before `when` (now by default) as read for the user: in the whole forum, or only in a category
+    or under a subforum. Only the watermark is written, whatever the number of topics."""
+    from .models import ReadWatermark
+    if when is None:
+        when = timezone.now()
+    scope = {'user': user, 'category': category, 'subforum': subforum}
+    if not ReadWatermark.objects.filter(**scope).update(read_before=when):
+        ReadWatermark.objects.create(read_before=when, **scope)
+    touch_user_read_state(user.id)
+
+def get_read_times(user, topics):
+    """Get the time until which the user read each topic ({topic_id: datetime}, without the never read topics).
+    Three queries at most, whatever the number of topics."""
+    from .models import ReadWatermark, TopicReadStatus, TopicClosure
+    topics = list(topics)
+    if not user.is_authenticated or not topics:
+        return {}
+    topic_ids = [topic.id for topic in topics]
+
+    read_times = dict(TopicReadStatus.objects.filter(user=user, topic_id__in=topic_ids).values_list('topic_id', 'last_read'))
+
+    # A user only has a few watermarks: load all of them
+    global_time = None
+    category_times = {}
+    subforum_times = {}
+    for category_id, subforum_id, read_before in ReadWatermark.objects.filter(user=user).values_list('category_id', 'subforum_id', 'read_before'):
+        if subforum_id is not None:
+            subforum_times[subforum_id] = read_before
+        elif category_id is not None:
+            category_times[category_id] = read_before
+        else:
+            global_time = read_before
+
+    subforum_ancestors = {}
+    if subforum_times:
+        for ancestor_id, descendant_id in TopicClosure.objects.filter(descendant_id__in=topic_ids, ancestor_id__in=subforum_times.keys()).values_list('ancestor_id', 'descendant_id'):
+            subforum_ancestors.setdefault(descendant_id, []).append(ancestor_id)
+
+    for topic in topics:
+        candidates = [read_times.get(topic.id), global_time, category_times.get(topic.category_id)]
+        candidates += [subforum_times[ancestor_id] for ancestor_id in subforum_ancestors.get(topic.id, [])]
+        candidates = [candidate for candidate in candidates if candidate is not None]
+        if candidates:
+            read_times[topic.id] = max(candidates)
+    return read_times
+
+def read_topics_filter(user, topic_path=None):
+    """A filter for the Topic querysets, keeping the topics read by the user since their last message.
+    With topic_path (like 'descendant'), the filter is on the topics of this relation instead."""
+    from .models import TopicReadStatus
+    prefix = f"{topic_path}__" if topic_path else ""
+    topic_ref = OuterRef(topic_path or 'pk')
+    last_message_ref = OuterRef(f"{prefix}last_message_time")
+    read_status = TopicReadStatus.objects.filter(user=user, topic=topic_ref, last_read__gte=last_message_ref)
+    watermarks = _applicable_watermarks(user, OuterRef(f"{prefix}category"), topic_ref).filter(read_before__gte=last_message_ref)
+    return Q(Exists(read_status)) | Q(Exists(watermarks))
+
+def touch_user_read_state(user_id):
+    """Drop the cached unread flags of a user (after a read)."""
+    cache.set(USER_TOKEN_KEY.format(user_id=user_id), time.time_ns(), None)
+
+def touch_forum_read_state():
+    """Drop the cached unread flags of everyone (after a new message)."""
+    cache.set(FORUM_TOKEN_KEY, time.time_ns(), None)
+
+def get_unread_flags(user, topic_ids):
+    """Get the unread flags of topics and subforums ({topic_id: bool}): a topic is unread if the user didn't read it
+    since its last message, a subforum if one of the topics under it (at any depth) is unread.
+    One query for all of them (none when cached)."""
+    from .models import TopicClosure
+    topic_ids = sorted(set(topic_ids))
+    if not user.is_authenticated or not topic_ids:
+        return {topic_id: False for topic_id in topic_ids}
+
+    tokens = cache.get_many([USER_TOKEN_KEY.format(user_id=user.id), FORUM_TOKEN_KEY])
+    cache_key = UNREAD_FLAGS_KEY.format(
+        user_id=user.id,
+        user_token=tokens.get(USER_TOKEN_KEY.format(user_id=user.id), 0),
+        forum_token=tokens.get(FORUM_TOKEN_KEY, 0),
+        ids_hash=hashlib.md5(",".join(map(str, topic_ids)).encode()).hexdigest(),
+    )
+    unread_ids = cache.get(cache_key)
+    if unread_ids is None:
+        # The unread topics at any depth under the given ones (a topic is at depth 0 under itself)
+        unread_ids = set(
+            TopicClosure.objects.filter(ancestor_id__in=topic_ids, descendant__is_sub_forum=False)
+            .exclude(read_topics_filter(user, 'descendant'))
+            .values_list('ancestor_id', flat=True).distinct()
+        )
+        cache.set(cache_key, unread_ids, UNREAD_FLAGS_TIMEOUT)
+    return {topic_id: topic_id in unread_ids for topic_id in topic_ids}
+
+def compact_read_statuses():
+    """Delete the TopicReadStatus rows older than a watermark of their user (they don't change anything anymore).
+    Returns the number of deleted rows."""
+    from .models import TopicReadStatus
+    watermarks = _applicable_watermarks(OuterRef('user'), OuterRef('topic__category'), OuterRef('topic')).filter(read_before__gte=OuterRef('last_read'))
+    deleted, _ = TopicReadStatus.objects.filter(Exists(watermarks)).delete()
+    return deleted
@@ -0,0 +1,299 @@
+# forum/search.py
+
+import html
+import re
+from django.db import connections, OperationalError
+from django.db.models import BooleanField, F, FloatField, Func, Q, Value
+from django.utils.safestring import mark_safe
+
+# search_results used to filter the posts with chains of text__icontains/topic__title__icontains, sequential scans of
+# all the posts. The keyword part of the search is now done by a search backend (get_search_backend()):
+# - PostgreSQL: a search_vector column of forum_post (text) and of forum_topic (title), generated by the database
+#   with the utf_french text search configuration (unaccent, then the french stemmer), with GIN indexes;
+# - SQLite (development): the FTS5 table forum_post_fts (text, title of the topic), kept up to date by triggers, with
+#   the unicode61 tokenizer removing the accents (FTS5 has no french stemmer, the prefix queries replace it);
+# - otherwise (or before the migration): the icontains filters, like before.
+# The columns, tables and triggers are created by the migration 0069_post_search (see create_search_index()), and the
+# triggers again after migrate when a migration remade forum_post (see ensure_search_triggers()).
+# The semantics of search_terms are kept: "any" finds the posts with one of the words, "all" the ones with the whole
+# keyword (a phrase), in the text or the title of the topic (search_fields="all") or only in the text ("msgonly").
+# The words match as prefixes ("chat" finds "chats" and "château"). The backends can also rank the results
+# (sort_by=relevance) and give the snippets of the results with the words highlighted.
+
+SEARCH_CONFIG = "utf_french"
+FTS_TABLE = "forum_post_fts"
+
+# Words around the highlighted words in a snippet
+SNIPPET_WORDS = 30
+
+WORD_RE = re.compile(r"\w+")
+BBCODE_TAG_RE = re.compile(r"\[/?\*?\w*(?:=[^\]]*)?\]")
+HIGHLIGHT_START = "\ue000" # (private use characters, replaced after the HTML escaping)
+HIGHLIGHT_STOP = "\ue001"
+
+POSTGRES_CREATE_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    f"""DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{SEARCH_CONFIG}') THEN
+            CREATE TEXT SEARCH CONFIGURATION {SEARCH_CONFIG} (COPY = french);
+            ALTER TEXT SEARCH CONFIGURATION {SEARCH_CONFIG} ALTER MAPPING FOR hword, hword_part, word WITH unaccent, french_stem;
+        END IF;
+    END $$""",
+    f"ALTER TABLE forum_post ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}'::regconfig, coalesce(text, ''))) STORED",
+    "CREATE INDEX forum_post_search_vector_idx ON forum_post USING GIN (search_vector)",
+    f"ALTER TABLE forum_topic ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}'::regconfig, coalesce(title, ''))) STORED",
+    "CREATE INDEX forum_topic_search_vector_idx ON forum_topic USING GIN (search_vector)",
+]
+POSTGRES_DROP_SQL = [
+    "ALTER TABLE forum_topic DROP COLUMN IF EXISTS search_vector",
+    "ALTER TABLE forum_post DROP COLUMN IF EXISTS search_vector",
+    f"DROP TEXT SEARCH CONFIGURATION IF EXISTS {SEARCH_CONFIG}",
+]
+
+SQLITE_CREATE_SQL = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(text, title, topic_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON forum_post BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, text, title, topic_id) VALUES (new.id, new.text, (SELECT title FROM forum_topic WHERE id = new.topic_id), new.topic_id);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF text, topic_id ON forum_post BEGIN
+        UPDATE {FTS_TABLE} SET text = new.text, title = (SELECT title FROM forum_topic WHERE id = new.topic_id), topic_id = new.topic_id WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON forum_post BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_topic_update AFTER UPDATE OF title ON forum_topic BEGIN
+        UPDATE {FTS_TABLE} SET title = new.title WHERE topic_id = new.id;
+    END""",
+]
+SQLITE_TRIGGERS = [f"{FTS_TABLE}_insert", f"{FTS_TABLE}_update", f"{FTS_TABLE}_delete", f"{FTS_TABLE}_topic_update"]
+SQLITE_FILL_SQL = [
+    f"DELETE FROM {FTS_TABLE}",
+    f"""INSERT INTO {FTS_TABLE} (rowid, text, title, topic_id)
+        SELECT forum_post.id, forum_post.text, forum_topic.title, forum_post.topic_id FROM forum_post LEFT JOIN forum_topic ON forum_topic.id = forum_post.topic_id""",
+]
+SQLITE_DROP_SQL = [f"DROP TRIGGER IF EXISTS {trigger}" for trigger in SQLITE_TRIGGERS] + [f"DROP TABLE IF EXISTS {FTS_TABLE}"]
+
+_fts_tables = {} # database name: whether the FTS5 table exists
+
+
+def get_words(keyword):
+    return WORD_RE.findall(keyword)
+
+def format_snippet(snippet):
+    """The HTML of a snippet: escaped, without the BBCode tags, with the highlighted words in span.posthilit."""
+    snippet = html.escape(BBCODE_TAG_RE.sub("", snippet))
+    return mark_safe(snippet.replace(HIGHLIGHT_START, '<span class="posthilit">').replace(HIGHLIGHT_STOP, "</span>"))
+
+
+class SearchExpression(Func):
+    """A SQL template with the compiled expressions in {0}, {1}... (in this order in the template)."""
+
+    def __init__(self, sql, *expressions, output_field):
+        super().__init__(*expressions, output_field=output_field)
+        self.sql = sql
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sqls, params = [], []
+        for expression in self.get_source_expressions():
+            sql, expression_params = compiler.compile(expression)
+            sqls.append(sql)
+            params.extend(expression_params)
+        return self.sql.format(*sqls), params
+
+
+class SearchBackend:
+    """The keyword part of the search of the posts. terms is "any" or "all", fields is "all" or "msgonly"."""
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def filter(self, queryset, keyword, terms='any', fields='all'):
+        """Filter a queryset of posts."""
+        raise NotImplementedError
+
+    def annotate_rank(self, queryset, keyword, terms='any', fields='all'):
+        """Annotate a queryset of posts (already filtered) with search_rank, higher for the better results."""
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    def get_snippets(self, post_ids, keyword, terms='any', fields='all'):
+        """Get the snippets of the text of these posts with the words highlighted ({post_id: HTML})."""
+        return {}
+
+
+class BasicSearchBackend(SearchBackend):
+    """The icontains filters (without index), when the database has no full-text index."""
+
+    def filter(self, queryset, keyword, terms='any', fields='all'):
+        if not keyword or fields not in ('all', 'msgonly'):
+            return queryset
+        if terms == "all":
+            keyword_filter = Q(text__icontains=keyword)
+            if fields == "all":
+                keyword_filter |= Q(topic__title__icontains=keyword)
+            return queryset.filter(keyword_filter)
+        if terms == "any":
+            keyword_filter = Q()
+            for word in keyword.split():
+                keyword_filter |= Q(text__icontains=word)
+                if fields == "all":
+                    keyword_filter |= Q(topic__title__icontains=word)
+            return queryset.filter(keyword_filter)
+        return queryset
+
+
+class FullTextSearchBackend(SearchBackend):
+    """The common part of the full-text backends: the keywords without words (only punctuation) use the basic search."""
+
+    def get_query(self, words, terms, fields):
+        raise NotImplementedError
+
+    def filter(self, queryset, keyword, terms='any', fields='all'):
+        if not keyword or fields not in ('all', 'msgonly') or terms not in ('any', 'all'):
+            return queryset
+        words = get_words(keyword)
+        if not words:
+            return BasicSearchBackend(self.using).filter(queryset, keyword, terms, fields)
+        return queryset.filter(self.get_filter(self.get_query(words, terms, fields), fields))
+
+    def annotate_rank(self, queryset, keyword, terms='any', fields='all'):
+        words = get_words(keyword)
+        if not words or fields not in ('all', 'msgonly') or terms not in ('any', 'all'):
+            return super().annotate_rank(queryset, keyword, terms, fields)
+        return queryset.annotate(search_rank=self.get_rank(self.get_query(words, terms, fields), fields))
+
+    def get_snippets(self, post_ids, keyword, terms='any', fields='all'):
+        words = get_words(keyword)
+        if not words or not post_ids or terms not in ('any', 'all'):
+            return {}
+        return {post_id: format_snippet(snippet) for post_id, snippet in self.fetch_snippets(list(post_ids), self.get_query(words, terms, fields)) if snippet}
+
+
+class PostgresSearchBackend(FullTextSearchBackend):
+    """The search_vector columns (GIN indexes), see POSTGRES_CREATE_SQL."""
+
+    def get_query(self, words, terms, fields):
+        """A to_tsquery query: the words as prefixes, one of them ("any") or all of them following each other ("all")."""
+        if terms == "all":
+            return " <-> ".join(f"{word}:*" for word in words)
+        return " | ".join(f"{word}:*" for word in words)
+
+    def get_filter(self, query, fields):
+        post_match = f"{{0}} IN (SELECT p.id FROM forum_post p WHERE p.search_vector @@ to_tsquery('{SEARCH_CONFIG}', {{1}}))"
+        if fields == "msgonly":
+            return SearchExpression(post_match, F('id'), Value(query), output_field=BooleanField())
+        topic_match = f"{{2}} IN (SELECT t.id FROM forum_topic t WHERE t.search_vector @@ to_tsquery('{SEARCH_CONFIG}', {{3}}))"
+        return SearchExpression(f"({post_match} OR {topic_match})", F('id'), Value(query), F('topic_id'), Value(query), output_field=BooleanField())
+
+    def get_rank(self, query, fields):
+        post_rank = f"COALESCE((SELECT ts_rank(p.search_vector, to_tsquery('{SEARCH_CONFIG}', {{0}})) FROM forum_post p WHERE p.id = {{1}}), 0)"
+        if fields == "msgonly":
+            return SearchExpression(post_rank, Value(query), F('id'), output_field=FloatField())
+        topic_rank = f"COALESCE((SELECT ts_rank(t.search_vector, to_tsquery('{SEARCH_CONFIG}', {{2}})) FROM forum_topic t WHERE t.id = {{3}}), 0)"
+        return SearchExpression(f"({post_rank} + {topic_rank})", Value(query), F('id'), Value(query), F('topic_id'), output_field=FloatField())
+
+    def fetch_snippets(self, post_ids, query):
+        options = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}"
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, ts_headline('{SEARCH_CONFIG}', text, to_tsquery('{SEARCH_CONFIG}', %s), %s) FROM forum_post WHERE id = ANY(%s)",
+                [query, options, post_ids],
+            )
+            return cursor.fetchall()
+
+
+class SQLiteSearchBackend(FullTextSearchBackend):
+    """The FTS5 table forum_post_fts, see SQLITE_CREATE_SQL."""
+
+    def get_query(self, words, terms, fields):
+        """A FTS5 query: the words as prefixes, one of them ("any") or the phrase ("all"), in the text and title
+        columns or only in the text."""
+        columns = "{text title}" if fields == "all" else "text"
+        if terms == "all":
+            words = ['"' + " ".join(words) + '"*']
+        else:
+            words = ['"' + word + '"*' for word in words]
+        return f"{columns} : ({' OR '.join(words)})"
+
+    def get_filter(self, query, fields):
+        return SearchExpression(f"{{0}} IN (SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH {{1}})", F('id'), Value(query), output_field=BooleanField())
+
+    def get_rank(self, query, fields):
+        # (bm25 is lower for the better results)
+        return SearchExpression(f"COALESCE((SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH {{0}} AND rowid = {{1}}), 0)", Value(query), F('id'), output_field=FloatField())
+
+    def fetch_snippets(self, post_ids, query):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', %s) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({', '.join(['%s'] * len(post_ids))})",
+                [HIGHLIGHT_START, HIGHLIGHT_STOP, min(SNIPPET_WORDS, 64), query, *post_ids],
+            )
+            return cursor.fetchall()
+
+
+def has_fts_table(connection):
+    name = connection.settings_dict['NAME']
+    if name not in _fts_tables:
+        _fts_tables[name] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[name]
+
+def get_search_backend(using='default'):
+    """Get the search backend of a database."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend(using)
+    if connection.vendor == 'sqlite' and has_fts_table(connection):
+        return SQLiteSearchBackend(using)
+    return BasicSearchBackend(using)
+
+def create_search_index(schema_editor):
+    """Create the full-text index of the database (from the migration 0069_post_search)."""
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in POSTGRES_CREATE_SQL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_CREATE_SQL[0])
+        except OperationalError:
+            return # (SQLite without FTS5: the basic search is used)
+        for sql in SQLITE_CREATE_SQL[1:] + SQLITE_FILL_SQL:
+            schema_editor.execute(sql)
+    _fts_tables.clear()
+
+def drop_search_index(schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in POSTGRES_DROP_SQL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite':
+        for sql in SQLITE_DROP_SQL:
+            schema_editor.execute(sql)
+    _fts_tables.clear()
+
+def rebuild_search_index(using='default'):
+    """Create the triggers and fill the FTS5 table again from the posts (SQLite only, the PostgreSQL columns are
+    generated). Returns the number of indexed posts, or None if there is nothing to rebuild."""
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not has_fts_table(connection):
+        return None
+    with connection.cursor() as cursor:
+        for sql in SQLITE_DROP_SQL[:-1] + SQLITE_CREATE_SQL[1:] + SQLITE_FILL_SQL:
+            cursor.execute(sql)
+        cursor.execute(f"SELECT COUNT(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+def ensure_search_triggers(using='default'):
+    """Rebuild the FTS5 index if its triggers are missing: with SQLite, the migrations altering forum_post remake the
+    table without them. Called after each migrate (see forum/apps.py). Returns whether the index was rebuilt."""
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not has_fts_table(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({', '.join(['%s'] * len(SQLITE_TRIGGERS))})",
+            SQLITE_TRIGGERS,
+        )
+        if cursor.fetchone()[0] == len(SQLITE_TRIGGERS):
+            return False
+    rebuild_search_index(using)
+    return True
@@ -1,10 +1,16 @@
 import redis
-import json
+from django.db import transaction
 import os
 import logging
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from .models import Topic, Post, PrivateMessage, PrivateMessageThread
+from .models import User, Topic, Post, Poll, PollOption, Profile, PrivateMessage, PrivateMessageThread, ForumGroup, reset_messages_group_ladder, renumber_post_positions
+from .page_cache import touch_topic_pages, touch_page_tags, touch_all_pages, topic_tag, INDEX_TAG
+from .post_blocks import touch_post_block_author, touch_post_block_groups
+from .notifications import queue_notification, publish_notification
+from .tasks import notify_new_post, notify_new_topic
+from .bbcode_render import reset_render_version
+from precise_bbcode.models import BBCodeTag, SmileyTag
 from utf.utils import cprint
 
 logger = logging.getLogger(__name__)
@@ -34,118 +40,18 @@ except Exception as e:
 @receiver(post_save, sender=Post)
 def send_watched_topic_notification_post(sender, instance, created, **kwargs):
     """
-    After a post is created, notify all users watching the topic/subforum/category.
+    After a post is created, notify all users watching the topic/subforum/category (in a Celery task, see forum/notifications.py).
     """
-    try:
-        if created and instance.get_relative_id != 1:  # Only notify for replies, not the first post in a topic
-            topic = instance.topic
-
-            watchers_id_list = []
-            for user in topic.watchers.all():
-                watchers_id_list.append(user.id)
-
-            for user in topic.category.watchers.all():
-                if user.id not in watchers_id_list:
-                    watchers_id_list.append(user.id)
-
-            parent = topic.parent
-            while parent:
-                for user in parent.watchers.all():
-                    if user.id not in watchers_id_list:
-                        watchers_id_list.append(user.id)
-                parent = parent.parent
-
-            followers_id_list = []
-            for user in instance.author.profile.followers.all():
-                followers_id_list.append(user.id)
-
-            to_notify_id_list = watchers_id_list + followers_id_list
-            to_notify_id_list = list(set(to_notify_id_list))  # Remove duplicates
-            
-            already_notified_user_ids = [instance.author.id]
-
-            for user_id in to_notify_id_list:
-                if user_id in already_notified_user_ids:
-                    continue
-                channel_name = f"user_notifications_{user_id}"
-
-                notification = {
-                    'message': f"{instance.author.username} a posté une réponse sur \"{topic.get_short_title()}\".",
-                    'text_preview': instance.get_short_text(100),
-                    'post_url': instance.get_absolute_url,
-                    'author_username': instance.author.username,
-                    'topic_full_title': topic.title,
-                }
-                
-                # Publish notification to Redis (with error handling)
-                if redis_client:
-                    try:
-                        redis_client.publish(channel_name, json.dumps(notification))
-                        cprint(f"Published notification for User {user_id} to channel {channel_name}")
-                    except Exception as e:
-                        logger.error(f"Failed to publish notification to Redis: {e}")
-                else:
-                    logger.warning("Redis client not available, skipping notification")
-                
-                already_notified_user_ids.append(user_id)
-    except Exception as e:
-        logger.error("Error in send_watched_topic_notification_post signal handler", exc_info=True)
+    if created:
+        queue_notification(notify_new_post, instance.id)
 
 @receiver(post_save, sender=Topic)
 def send_watched_topic_notification_topic(sender, instance, created, **kwargs):
     """
-    After a topic is created, notify all users watching the subforum/category.
+    After a topic is created, notify all users watching the subforum/category (in a Celery task, see forum/notifications.py).
     """
-    try:
-        if created:
-            topic = instance
-
-            watchers_id_list = []
-            for user in topic.category.watchers.all():
-                watchers_id_list.append(user.id)
-
-            parent = topic.parent
-            while parent:
-                for user in parent.watchers.all():
-                    if user.id not in watchers_id_list:
-                        watchers_id_list.append(user.id)
-                parent = parent.parent
-
-            followers_id_list = []
-            for user in instance.author.profile.followers.all():
-                followers_id_list.append(user.id)
-
-            to_notify_id_list = watchers_id_list + followers_id_list
-            to_notify_id_list = list(set(to_notify_id_list))  # Remove duplicates
-            
-            already_notified_user_ids = [instance.author.id]
-
-            for user_id in to_notify_id_list:
-                if user_id in already_notified_user_ids:
-                    continue
-                channel_name = f"user_notifications_{user_id}"
-
-                notification = {
-                    'message': f"{instance.author.username} a créé un nouveau sujet \"{topic.get_short_title()}\".",
-                    'text_preview': f"Cliquez ici pour voir le sujet.",
-                    'post_url': instance.get_absolute_url,
-                    'author_username': instance.author.username,
-                    'topic_full_title': topic.title,
-                }
-                
-                # Publish notification to Redis (with error handling)
-                if redis_client:
-                    try:
-                        redis_client.publish(channel_name, json.dumps(notification))
-                        cprint(f"Published notification for User {user_id} to channel {channel_name}")
-                    except Exception as e:
-                        logger.error(f"Failed to publish notification to Redis: {e}")
-                else:
-                    logger.warning("Redis client not available, skipping notification")
-                
-                already_notified_user_ids.append(user_id)
-    except Exception as e:
-        logger.error("Error in send_watched_topic_notification_topic signal handler", exc_info=True)
+    if created:
+        queue_notification(notify_new_topic, instance.id)
 
 
 @receiver(post_save, sender=PrivateMessage)
@@ -155,9 +61,6 @@ def send_private_message_notification(sender, instance, created, **kwargs):
     """
     try:
         if created:
-            recipient = instance.recipient
-            channel_name = f"user_notifications_{recipient.id}"
-
             notification = {
                 'message': f"Vous avez reçu un nouveau message privé de {instance.author.username}.",
                 'text_preview': instance.get_short_text(100),
@@ -165,15 +68,122 @@ def send_private_message_notification(sender, instance, created, **kwargs):
                 'author_username': instance.author.username,
                 'topic_full_title': instance.thread.title,
             }
-
-            # Publish notification to Redis (with error handling)
-            if redis_client:
-                try:
-                    redis_client.publish(channel_name, json.dumps(notification))
-                    cprint(f"Published notification for User {recipient.id} to channel {channel_name}")
-                except Exception as e:
-                    logger.error(f"Failed to publish notification to Redis: {e}")
-            else:
-                logger.warning("Redis client not available, skipping notification")
+            publish_notification([instance.recipient_id], notification) # (kept for the replays, see forum/notifications.py)
     except Exception as e:
-        logger.error("Error in send_private_message_notification signal handler", exc_info=True)
\ No newline at end of file
+        logger.error("Error in send_private_message_notification signal handler", exc_info=True)
+
+
+@receiver([post_save, post_delete], sender=BBCodeTag)
+@receiver([post_save, post_delete], sender=SmileyTag)
+def reset_bbcode_render_version(sender, **kwargs):
+    """
+    The tags and smilies are part of the render version, so stored renders become stale when they change.
+    (use "python manage.py rerender_bbcode" to update them)
+    """
+    reset_render_version()
+
+
+@receiver([post_save, post_delete], sender=ForumGroup)
+def reset_forum_group_ladder(sender, **kwargs):
+    """
+    The messages groups are cached for the promotions on new posts (see Post.update_counters_on_create).
+    """
+    reset_messages_group_ladder()
+
+
+@receiver(post_delete, sender=Post)
+def renumber_posts_after_delete(sender, instance, origin=None, **kwargs):
+    """
+    The posts after a deleted post move up by one (see Post.position), unless the whole topic is deleted.
+    """
+    if instance.topic_id is None or isinstance(origin, Topic):
+        return
+    topic_id = instance.topic_id
+    transaction.on_commit(lambda: renumber_post_positions(Topic.objects.filter(id=topic_id).values_list('id', flat=True)))
+
+
+@receiver([post_save, post_delete], sender=Post)
+def touch_post_pages(sender, instance, origin=None, **kwargs):
+    """
+    The stored anonymous pages of the topic of a post and of its parents are outdated (see forum/page_cache.py).
+    """
+    if instance.topic_id is None or isinstance(origin, Topic): # (the pages are dropped with the topic)
+        return
+    touch_topic_pages([instance.topic_id])
+
+
+@receiver([post_save, post_delete], sender=Topic)
+def touch_topic_pages_on_change(sender, instance, **kwargs):
+    """
+    The stored anonymous pages of a topic, of its parents (old and new ones) and of its category are outdated.
+    A moved subforum changes the tree shown by all the pages under it, so all the pages are dropped then.
+    """
+    old_parent_id = getattr(instance, '_loaded_parent_id', instance.parent_id) # (still the old parent in post_save)
+    if old_parent_id != instance.parent_id and instance.is_sub_forum:
+        touch_all_pages()
+    touch_topic_pages([instance.parent_id, old_parent_id], instance.category_id, instance.is_announcement)
+    touch_page_tags([topic_tag(instance.id)])
+
+
+@receiver([post_save, post_delete], sender=Poll)
+@receiver([post_save, post_delete], sender=PollOption)
+def touch_poll_pages(sender, instance, **kwargs):
+    """
+    The polls are shown on their topic and on the index.
+    """
+    topic_id = instance.topic_id if sender is Poll else Poll.objects.filter(id=instance.poll_id).values_list('topic_id', flat=True).first()
+    touch_page_tags([INDEX_TAG] + ([topic_tag(topic_id)] if topic_id is not None else []))
+
+
+@receiver(m2m_changed, sender=PollOption.voters.through)
+def touch_poll_vote_pages(sender, instance, action, reverse, pk_set=None, **kwargs):
+    """
+    The results of a poll are shown on its topic.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    option_ids = (pk_set or []) if reverse else [instance.id] # (reverse: user.poll_votes.add(...))
+    topic_ids = Poll.objects.filter(options__id__in=option_ids).values_list('topic_id', flat=True).distinct()
+    touch_page_tags([topic_tag(topic_id) for topic_id in topic_ids])
+
+
+@receiver(post_save, sender=Profile)
+def touch_hidden_profile_pages(sender, instance, **kwargs):
+    """
+    The posts, topics and latest messages of a hidden user are left out of every page.
+    """
+    if getattr(instance, '_is_hidden_changed', False):
+        touch_all_pages()
+
+
+@receiver([post_save, post_delete], sender=ForumGroup)
+def touch_group_post_blocks(sender, **kwargs):
+    """
+    The groups (names, colors, icons) are shown in the cached post blocks (see forum/post_blocks.py).
+    """
+    touch_post_block_groups()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Profile)
+def touch_author_post_blocks(sender, instance, **kwargs):
+    """
+    The author panel and the signature are part of the cached post blocks.
+    """
+    touch_post_block_author(instance.id if sender is User else instance.user_id)
+
+
+@receiver(m2m_changed, sender=Profile.groups.through)
+def touch_author_post_blocks_on_groups_change(sender, instance, action, reverse, pk_set=None, **kwargs):
+    """
+    The top group of an author is shown in their post blocks.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        touch_post_block_author(instance.user_id)
+    elif pk_set is None: # (group.users.clear())
+        touch_post_block_groups()
+    else: # (group.users.add(...))
+        for user_id in Profile.objects.filter(id__in=pk_set).values_list('user_id', flat=True):
+            touch_post_block_author(user_id)
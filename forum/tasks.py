@@ -1,61 +1,44 @@
 from celery import shared_task
 from celery.exceptions import Retry
 import logging
-import os
 from django.conf import settings
-from utf.utils import cprint
+from .log_pipeline import LEVELS, get_logger, get_celery_level
 
 # Get or create logger
 logger = logging.getLogger(__name__)
 
 def safe_async_log(message, level='info', view_name=None):
     """
-    Safely call async logging with fallback to synchronous logging if Celery fails.
+    Log a message from a view without blocking (see forum/log_pipeline.py).
+
+    The messages under the level of the "forum.views" logger are discarded before any work. The other ones are put in
+    the queue of the process and written by its listener thread, or sent to Celery (async_log) from LOG_CELERY_LEVEL.
     
     Args:
         message (str): The message to log
         level (str): Log level - 'debug', 'info', 'warning', 'error', 'critical'  
         view_name (str): Optional view name for context
     """
-    disable_prints = getattr(settings, 'DISABLE_CUSTOM_PRINTS', False)
-    if disable_prints:
+    if getattr(settings, 'DISABLE_CUSTOM_PRINTS', False):
+        return
+    levelno = LEVELS.get(level.lower(), logging.INFO)
+    view_logger = get_logger()
+    if not view_logger.isEnabledFor(levelno):
         return
-    # Format message with view name if provided
+
+    celery_level = get_celery_level()
+    if celery_level is not None and levelno >= celery_level:
+        try:
+            async_log.delay(message, level, view_name)
+            return
+        except Exception as e:
+            # If Celery fails, write it here
+            message = f"{message} (Celery unavailable: {str(e)})"
+
     if view_name:
-        formatted_message = f"[{view_name}] {message}"
+        view_logger.log(levelno, "[%s] %s", view_name, message)
     else:
-        formatted_message = message
-    
-    # In development mode, always print to console for immediate feedback
-    if os.getenv('DEVELOPMENT_MODE', '').lower() in ['true', '1', 'yes']:
-        level_upper = level.upper()
-        cprint(f"[{level_upper}] {formatted_message}")
-    
-    try:
-        # Try to send task to Celery
-        async_log.delay(message, level, view_name)
-    except Exception as e:
-        # If Celery fails, log synchronously as fallback            
-        # Add note about Celery failure in development
-        if os.getenv('DEVELOPMENT_MODE', '').lower() in ['true', '1', 'yes']:
-            fallback_message = f"{formatted_message} (Celery unavailable: {str(e)})"
-        else:
-            fallback_message = formatted_message
-        
-        # Log synchronously at the appropriate level
-        if level.lower() == 'debug':
-            logger.debug(fallback_message)
-        elif level.lower() == 'info':
-            logger.info(fallback_message)
-        elif level.lower() == 'warning':
-            logger.warning(fallback_message)
-        elif level.lower() == 'error':
-            logger.error(fallback_message)
-        elif level.lower() == 'critical':
-            logger.critical(fallback_message)
-        else:
-            # Default to info level
-            logger.info(fallback_message)
+        view_logger.log(levelno, "%s", message)
 
 @shared_task
 def async_log(message, level='info', view_name=None):
@@ -89,3 +72,60 @@ def async_log(message, level='info', view_name=None):
         logger.info(formatted_message)
     
     return f"Logged: {formatted_message}"
+
+@shared_task
+def flush_topic_views():
+    """
+    Write the buffered topic views to the database (run every minute by Celery beat, see forum/view_counter.py).
+    """
+    from .view_counter import flush_topic_views as flush
+    updated = flush()
+    if updated:
+        logger.info(f"Flushed the buffered views of {updated} topic(s)")
+    return updated
+
+@shared_task
+def flush_presence():
+    """
+    Write the buffered activity to Profile.last_login and update the online record (run every minute by Celery beat, see forum/presence.py).
+    """
+    from .presence import flush_presence as flush
+    updated = flush()
+    if updated:
+        logger.info(f"Flushed the last activity of {updated} user(s)")
+    return updated
+
+@shared_task
+def refresh_board_stats():
+    """
+    Rebuild the snapshot of the headers and sidebars data (run every minute by Celery beat, see forum/board_stats.py).
+    """
+    from .board_stats import refresh_board_stats as refresh
+    refresh()
+
+@shared_task
+def notify_new_post(post_id):
+    """
+    Notify the watchers and followers of a new reply (started after the commit by the post_save signal, see forum/notifications.py).
+    """
+    from .notifications import notify_new_post as notify
+    return notify(post_id)
+
+@shared_task
+def notify_new_topic(topic_id):
+    """
+    Notify the watchers and followers of a new topic (started after the commit by the post_save signal, see forum/notifications.py).
+    """
+    from .notifications import notify_new_topic as notify
+    return notify(topic_id)
+
+@shared_task
+def compact_read_statuses():
+    """
+    Delete the TopicReadStatus rows made useless by a newer read watermark (run every day by Celery beat, see forum/read_state.py).
+    """
+    from .read_state import compact_read_statuses as compact
+    deleted = compact()
+    if deleted:
+        logger.info(f"Deleted {deleted} redundant topic read status(es)")
+    return deleted
@@ -12,6 +12,7 @@ from django.utils import timezone
 from archive.models import *
 import random
 from ..views_context_processors import return_random_color
+from ..bbcode_tags import render_video
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 
@@ -20,6 +21,9 @@ from rest_framework.authtoken.models import Token
 
 register = template.Library()
 
+# The [video] tag is now a real BBCode tag (VideoTag in bbcode_tags.py), the templates only need the bbcode filter.
+# These two filters are the old way to render it, they are only kept to compare the outputs (compare_video_rendering command).
+
 @register.filter
 def process_video_tags(value):
     """Convert video tags to placeholders with base64-encoded URLs"""
@@ -45,24 +49,7 @@ def finalize_video_tags(value):
         try:
             # Decode the base64 URL
             url = base64.b64decode(encoded_url.encode('utf-8')).decode('utf-8')
-            
-            url_is_safe = False
-            
-            # More thorough URL validation
-            if url.startswith('https://'):
-                # Parse the URL to validate its structure
-                parsed_url = urllib.parse.urlparse(url)
-                # Check if it has a valid netloc (domain) and no suspicious components
-                if parsed_url.netloc and not any(c in url for c in ['"', "'", '<', '>', ';', ' ']):
-                    url_is_safe = True
-            
-            if url_is_safe:
-                # Escape the URL to prevent XSS
-                safe_url = escape(url)
-                return f'<video controls style="max-width: 500px; max-height: 500px;" ><source src="{safe_url}" type="video/mp4"></video>'
-            else:
-                return "[URL vidéo invalide]"
-                
+            return render_video(url)
         except Exception as e:
             # Handle decoding errors safely
             return f"[Error processing video: {escape(str(e))}]"
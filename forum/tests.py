@@ -1,6 +1,6 @@
 # forum/tests.py
 
-from django.test import TestCase, SimpleTestCase
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.urls import reverse
 from forum.models import User, Profile, ForumGroup, Topic, Category, Post
 from django.core.exceptions import ValidationError
@@ -832,4 +832,1378 @@ class RestrictNewUsersTest(TestCase):
         # Reset environment variable
         import os
         if 'RESTRICT_NEW_USERS' in os.environ:
-            del os.environ['RESTRICT_NEW_USERS']
\ No newline at end of file
+            del os.environ['RESTRICT_NEW_USERS']
+
+class RenderedBBCodeTest(TestCase):
+    """The rendered HTML of posts and signatures is stored at save time instead of being rendered in the templates."""
+
+    def setUp(self):
+        self.user = User.objects.create(username="bbcode_user")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male", signature="[b]Ma signature[/b]")
+
+    def test_post_rendered_text_is_stored_on_save(self):
+        from forum.bbcode_render import get_render_version, render_bbcode
+        text = "[b]Gras[/b] [video]https://example.com/video.mp4[/video]"
+        post = Post.objects.create(author=self.user, text=text)
+        post.refresh_from_db()
+        self.assertEqual(post._text_rendered, render_bbcode(text))
+        self.assertEqual(post._text_rendered_version, get_render_version())
+        self.assertIn("<strong>Gras</strong>", post.get_text_html)
+        self.assertIn('<source src="https://example.com/video.mp4" type="video/mp4">', post.get_text_html)
+
+    def test_post_rendered_text_is_updated_on_edit(self):
+        post = Post.objects.create(author=self.user, text="[i]Avant[/i]")
+        post.text = "[u]Après[/u]"
+        post.save()
+        post.refresh_from_db()
+        self.assertNotIn("Avant", post._text_rendered)
+        self.assertIn("Après", post._text_rendered)
+
+    def test_signature_is_only_rendered_when_saved_with_it(self):
+        self.assertIn("<strong>Ma signature</strong>", self.profile.get_signature_html)
+        self.profile.signature = "[i]Nouvelle signature[/i]"
+        self.profile.save(update_fields=["last_login"])
+        self.profile.refresh_from_db()
+        self.assertIn("Ma signature", self.profile._signature_rendered)
+
+    def test_stale_rows_are_rendered_on_the_fly_and_by_the_command(self):
+        from django.core.management import call_command
+        from io import StringIO
+        post = Post.objects.create(author=self.user, text="[b]Texte[/b]")
+        Post.objects.filter(pk=post.pk).update(_text_rendered="stale", _text_rendered_version="0-old")
+        post.refresh_from_db()
+        self.assertIn("<strong>Texte</strong>", post.get_text_html)
+
+        call_command("rerender_bbcode", "--model", "post", stdout=StringIO())
+        post.refresh_from_db()
+        self.assertIn("<strong>Texte</strong>", post._text_rendered)
+        self.assertEqual(post.update_count, 0)
+
+
+class BBCodeTokenizerTest(TestCase):
+    """The single-pass tokenizer must give exactly the same tokens as the original one."""
+    databases = {'default', 'archive'}
+
+    def token_stream(self, tokens):
+        return [(token.type, token.tag_name, token.option, token.text) for token in tokens]
+
+    def assertSameTokens(self, parser, text):
+        self.assertEqual(
+            self.token_stream(parser.get_tokens(text)),
+            self.token_stream(parser._get_tokens_reference(text)),
+            msg=repr(text),
+        )
+
+    def test_same_tokens_on_edge_cases(self):
+        from precise_bbcode.bbcode import get_parser
+        parser = get_parser()
+        texts = [
+            "", "plain text", "hello [world", "a[b[c", "a[b[c]", "[b]bold[/b] and [i]italic",
+            "[quote=Toto]Salut\r\n[b]ça va ?[/b][/quote]", "[ B ]x[/ b ]", "[/b=x]", "[]", "[ ]", "[/]",
+            "[url=https://example.com/?a=b]lien[/url]", "[unknown]tag[/unknown]", "[b\n]x[/b]",
+            "[[b]]", "]][[", "x [b]y[/b] z [q", "[code][b]not bold[/b][/code]", "[hr]\n[hr]\n\n",
+        ]
+        for text in texts:
+            self.assertSameTokens(parser, text)
+
+    def test_same_tokens_on_random_inputs(self):
+        import random
+        from precise_bbcode.bbcode import get_parser
+        parser = get_parser()
+        pieces = ['[', ']', '[b]', '[/b]', '[quote=a]', '[/quote]', '[ I ]', '[/ i]', '[url=x]', '[/url=x]',
+                  '\n', '\r\n', '\r', 'a', 'bc', ' ', '=', '/', '[code]', '[/code]', '[hr]', '[*]', '[ ]', ':)']
+        rng = random.Random(42)
+        for _ in range(2000):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+            self.assertSameTokens(parser, text)
+
+    def test_compare_command_over_the_archive_corpus(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from archive.models import ArchivePost
+        ArchivePost.objects.bulk_create([
+            ArchivePost(id=1, text="[quote=x][b]Hello[/b] :) www.example.com/a\n[/quote]", created_time="2010-01-01T00:00:00Z"),
+            ArchivePost(id=2, text="unclosed [b]tag and a lone [ bracket", created_time="2010-01-01T00:00:00Z"),
+        ])
+        out = StringIO()
+        call_command("compare_bbcode_tokenizers", "--source", "archive", stdout=out)
+        self.assertIn("archive: 2 text(s), 0 mismatch(es)", out.getvalue())
+
+
+class BBCodeRendererTest(TestCase):
+    """The non-recursive renderer must give the same HTML as the original recursive one, and must survive pathological inputs."""
+
+    def test_same_html_as_the_recursive_renderer(self):
+        import random
+        from precise_bbcode.bbcode import get_parser
+        parser = get_parser()
+        pieces = ['[', ']', '[b]', '[/b]', '[i]', '[/i]', '[quote=a]', '[quote]', '[/quote]', '[*]', '[list]', '[/list]',
+                  '[/*]', '[code]', '[/code]', '[rawtext]', '[/rawtext]', '[url=http://x.com]', '[/url]', '[hr]',
+                  '[spoiler]', '[/spoiler]', '\n', 'a', ' b ', 'www.example.com/x', '<&>', '[size=5]', '[/size]']
+        rng = random.Random(42)
+        for _ in range(1000):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 40)))
+            tokens = parser._drop_syntactic_errors(parser.get_tokens(text))
+            self.assertEqual(parser._render_tokens(tokens), parser._render_tokens_reference(tokens), msg=repr(text))
+
+    def test_deeply_nested_tags_do_not_crash(self):
+        from precise_bbcode.bbcode import get_parser
+        parser = get_parser()
+        depth = 5000 # Way more than the recursion limit of the old renderer
+        rendered = parser.render("[b]" * depth + "x" + "[/b]" * depth)
+        # The tags over the nesting limit are rendered as text
+        self.assertEqual(rendered.count("<strong>"), parser.max_nesting_depth)
+        self.assertIn("[b]", rendered)
+
+    def test_tags_over_the_token_limit_are_rendered_as_text(self):
+        from precise_bbcode.bbcode import get_parser
+        parser = get_parser()
+        old_max_tokens = parser.max_tokens
+        parser.max_tokens = 30
+        try:
+            rendered = parser.render("[b]x[/b]" * 20)
+        finally:
+            parser.max_tokens = old_max_tokens
+        self.assertEqual(rendered.count("<strong>x</strong>"), 10)
+        self.assertIn("[b]x[/b]", rendered)
+
+
+class BBCodeSmiliesTest(TestCase):
+    """The compiled smilies table must give the same text as the original one-replace-per-smiley loop."""
+
+    def test_same_text_as_the_original_substitutions(self):
+        import random
+        from precise_bbcode.bbcode.parser import BBCodeParser
+        rng = random.Random(42)
+        alphabet = ":)(D;-o<>&\"' .wab"
+        for _ in range(300):
+            parser = BBCodeParser()
+            for _ in range(rng.randint(1, 8)):
+                code = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+                parser.add_smiley(code, rng.choice(['<img src="/media/smilies/x.gif" alt="%s" />' % code, 'b', '', code + ':']))
+            for _ in range(20):
+                text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+                for flags in ((True, True, True), (False, False, True), (True, True, False)):
+                    self.assertEqual(
+                        parser._render_textual_content(text, *flags),
+                        parser._render_textual_content_reference(text, *flags),
+                        msg=repr((text, sorted(parser.smilies.items()))),
+                    )
+
+    def test_overlapping_codes(self):
+        from precise_bbcode.bbcode.parser import BBCodeParser
+        parser = BBCodeParser()
+        parser.add_smiley(':idea:', '<img alt="idea" />')
+        parser.add_smiley(':arrow:', '<img alt="arrow" />')
+        parser.add_smiley(':)', '<img alt="smile" />')
+        # ':idea:' is replaced first, so the ':' it shares with ':arrow:' is gone
+        self.assertEqual(parser._render_textual_content(":arrow:idea:)", True, True, True), ':arrow<img alt="idea" />)')
+        self.assertTrue(parser._get_smilies_matcher().exact)
+
+    def test_table_is_recompiled_when_smilies_change(self):
+        from precise_bbcode.bbcode.parser import BBCodeParser
+        parser = BBCodeParser()
+        parser.add_smiley(':)', '<img alt="smile" />')
+        self.assertEqual(parser._render_textual_content(":) :(", True, True, True), '<img alt="smile" /> :(')
+        parser.add_smiley(':(', '<img alt="sad" />')
+        self.assertEqual(parser._render_textual_content(":) :(", True, True, True), '<img alt="smile" /> <img alt="sad" />')
+        parser.remove_smiley(':)')
+        self.assertEqual(parser._render_textual_content(":) :(", True, True, True), ':) <img alt="sad" />')
+
+
+class VideoTagTest(TestCase):
+    """The [video] tag is a real BBCode tag now, it must render like the old process_video_tags|bbcode|finalize_video_tags."""
+
+    def render_legacy(self, text):
+        import copy
+        from precise_bbcode.bbcode import get_parser
+        from forum.templatetags.templatetags import process_video_tags, finalize_video_tags
+        legacy_parser = copy.copy(get_parser())
+        legacy_parser.bbcodes = {name: tag for name, tag in legacy_parser.bbcodes.items() if name != 'video'}
+        return str(finalize_video_tags(legacy_parser.render(process_video_tags(text))))
+
+    def test_valid_video(self):
+        from forum.bbcode_render import render_bbcode
+        html = str(render_bbcode("[video] https://example.com/video.mp4?a=1&b=2 [/video]"))
+        self.assertEqual(html, '<video controls style="max-width: 500px; max-height: 500px;" ><source src="https://example.com/video.mp4?a=1&amp;b=2" type="video/mp4"></video>')
+
+    def test_invalid_urls(self):
+        from forum.bbcode_render import render_bbcode
+        for url in ['http://example.com/video.mp4', 'https://', 'https://example.com/"onerror="alert(1)', 'javascript:alert(1)', '']:
+            self.assertEqual(str(render_bbcode(f"[video]{url}[/video]")), "[URL vidéo invalide]", msg=url)
+
+    def test_same_html_as_the_old_filters(self):
+        from forum.bbcode_render import render_bbcode
+        texts = [
+            "Regardez ça :) [video]https://example.com/video.mp4[/video]\nC'est www.example.com",
+            "[quote=Toto][video]https://example.com/a.mp4[/video][/quote] [b]x[/b] [video]https://cdn.example.com/b.mp4[/video]",
+            "[video]http://example.com/a.mp4[/video] [video]https://example.com/<b>.mp4[/video]",
+            "[spoiler=Vidéo][center][video]https://example.com/a.mp4[/video][/center][/spoiler]",
+            "[video]https://example.com/a.mp4",
+            "Pas de vidéo ici [b]gras[/b]",
+        ]
+        for text in texts:
+            self.assertEqual(str(render_bbcode(text)), self.render_legacy(text), msg=text)
+
+
+class PlainTextTest(TestCase):
+    """The plain text of posts is made from the BBCode tokens now, it must be the same as the old regex strip_bbcode."""
+
+    def test_same_text_as_the_regex_implementation(self):
+        import random
+        from forum.models import strip_bbcode, strip_bbcode_reference
+        rng = random.Random(42)
+        words = ['Salut', 'tout', 'le monde', ':)', 'www.example.com', '>', 'a > b', 'é', '  ']
+        tags = ['b', 'i', 'u', 's', 'color=red', 'size=12', 'font=Arial', 'center', 'url=http://x.com', 'quote', 'quote=Toto',
+                'spoiler', 'spoiler=Titre', 'youtube', 'yt', 'code', 'list', 'hr', 'newline']
+
+        def block(depth):
+            if depth > 3 or rng.random() < 0.35:
+                return ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+            inner = ''.join(block(depth + 1) for _ in range(rng.randint(1, 3)))
+            tag = rng.choice(tags)
+            if tag == 'newline':
+                return inner + '\n'
+            if tag == 'hr':
+                return inner + '[hr]'
+            if tag == 'list':
+                return '[list]\n[*]' + inner + '\n[*]x\n[/list]'
+            if tag in ('youtube', 'yt'):
+                inner = 'dQw4w9WgXcQ'
+            return f"[{tag}]{inner}[/{tag.split('=')[0]}]"
+
+        for _ in range(1000):
+            text = ''.join(block(0) for _ in range(rng.randint(1, 4)))
+            self.assertEqual(strip_bbcode(text), strip_bbcode_reference(text), msg=repr(text))
+
+    def test_plain_text(self):
+        from forum.models import strip_bbcode
+        text = "[quote=Toto]\nSalut[/quote]\n[b]Gras[/b] [spoiler=Fin]Asgore meurt[/spoiler][hr][yt]dQw4w9WgXcQ[/yt] [video]https://example.com/a.mp4[/video]"
+        self.assertEqual(
+            strip_bbcode(text),
+            "> Salut\nGras ⬛⬛⬛⬛\n--------\nhttps://www.youtube.com/watch?v=dQw4w9WgXcQ [video]https://example.com/a.mp4[/video]"
+        )
+
+    def test_plain_text_is_stored_on_save(self):
+        from forum.models import PrivateMessage, PrivateMessageThread
+        user = User.objects.create(username="plain_user")
+        Profile.objects.create(user=user, birthdate="2000-01-01", gender="male")
+        post = Post.objects.create(author=user, text="[b]Gras[/b] et [i]italique[/i]")
+        post.refresh_from_db()
+        self.assertEqual(post._text_plain, "Gras et italique")
+        self.assertEqual(post.get_short_text(7), "Gras...")
+
+        thread = PrivateMessageThread.objects.create(author=user, recipient=user, title="Test")
+        message = PrivateMessage.objects.create(thread=thread, author=user, recipient=user, text="[u]Coucou[/u]")
+        message.refresh_from_db()
+        self.assertEqual(message._text_plain, "Coucou")
+        self.assertEqual(message.get_short_text(), "Coucou")
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SignatureRenderCacheTest(TestCase):
+    """A signature shown under many posts must only be rendered once when its stored render can't be used."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        from forum import bbcode_render
+        cache.clear()
+        bbcode_render._render_cache.clear()
+        self.user = User.objects.create(username="signature_user")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male", signature="[b]Ma signature[/b]")
+        # Pretend the stored render is outdated
+        Profile.objects.filter(pk=self.profile.pk).update(_signature_rendered_version="0-old")
+
+    def test_signature_is_rendered_once_per_page(self):
+        from unittest import mock
+        from forum import bbcode_render
+        with mock.patch.object(bbcode_render, 'render_bbcode', wraps=bbcode_render.render_bbcode) as render:
+            for _ in range(20):
+                # Each post of the page has its own instance of the profile
+                html = Profile.objects.get(pk=self.profile.pk).get_signature_html
+                self.assertIn("<strong>Ma signature</strong>", html)
+        self.assertEqual(render.call_count, 1)
+
+    def test_edited_signature_replaces_the_cached_one(self):
+        from forum import bbcode_render
+        old_key = bbcode_render.get_render_cache_key(self.profile, 'signature', self.profile.signature)
+        Profile.objects.get(pk=self.profile.pk).get_signature_html
+        self.assertIn(old_key, bbcode_render._render_cache)
+
+        profile = Profile.objects.get(pk=self.profile.pk)
+        profile.signature = "[i]Nouvelle signature[/i]"
+        profile.save()
+        self.assertNotIn(old_key, bbcode_render._render_cache)
+
+        Profile.objects.filter(pk=self.profile.pk).update(_signature_rendered_version="0-old")
+        self.assertIn("<em>Nouvelle signature</em>", Profile.objects.get(pk=self.profile.pk).get_signature_html)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PostCreationCountersTest(TestCase):
+    """Creating a post updates the counters with a constant number of queries, whatever the subforum depth."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.addCleanup(cache.clear) # (the ladder would outlive the groups rolled back after the test)
+        self.category = Category.objects.create(name="Counters Category", slug="counters-category")
+        self.user = User.objects.create_user(username="counters_user", password="testpass")
+        Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        ForumGroup.objects.filter(is_messages_group=True).delete() # the groups made by the migrations
+        ForumGroup.objects.create(name="Nouveau", priority=1, description="Desc", minimum_messages=1, is_messages_group=True, color="#111111")
+        ForumGroup.objects.create(name="Habitué", priority=2, description="Desc", minimum_messages=3, is_messages_group=True, color="#222222")
+
+    def make_topic(self, depth):
+        """A topic inside depth - 1 nested subforums."""
+        parent = None
+        for level in range(depth):
+            parent = Topic.objects.create(author=self.user, title=f"Level {level}", category=self.category,
+                                          is_sub_forum=level < depth - 1, parent=parent)
+        return parent
+
+    def create_post(self, topic):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        # Fresh instances, like in a view
+        author = User.objects.select_related('profile').get(pk=self.user.pk)
+        topic = Topic.objects.get(pk=topic.pk)
+        with CaptureQueriesContext(connection) as queries:
+            post = Post.objects.create(author=author, topic=topic, text="[b]Salut[/b]")
+        return post, len(queries)
+
+    def test_same_number_of_queries_whatever_the_depth(self):
+        # (depth 2 at least: the logs print the topic with its direct parent)
+        shallow = self.make_topic(2)
+        deep = self.make_topic(6)
+        # The first posts promote the author (and the first post of a topic doesn't notify), compare the posts after that
+        for _ in range(3):
+            self.create_post(shallow)
+        self.create_post(deep)
+        _, shallow_queries = self.create_post(shallow)
+        _, deep_queries = self.create_post(deep)
+        self.assertEqual(shallow_queries, deep_queries)
+        self.assertLessEqual(deep_queries, 15)
+
+    def test_counters_are_updated(self):
+        from forum.models import Forum
+        topic = self.make_topic(4)
+        total_messages = Forum.objects.get(name="UTF").total_messages
+        post, _ = self.create_post(topic)
+        current = Topic.objects.get(pk=topic.pk)
+        self.assertEqual(current.total_replies, 0) # the first post of a topic is not a reply
+        current = current.parent
+        while current:
+            self.assertEqual(current.total_replies, 1)
+            self.assertEqual(current.latest_message_id, post.id)
+            self.assertEqual(current.last_message_time, post.created_time)
+            current = current.parent
+        self.assertEqual(Forum.objects.get(name="UTF").total_messages, total_messages + 1)
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.messages_count, 1)
+        self.assertEqual([group.name for group in profile.groups.all()], ["Nouveau"])
+        self.assertEqual(profile.top_group.name, "Nouveau")
+        self.assertEqual(profile.name_color, "#111111")
+
+    def test_promotion_uses_the_cached_ladder(self):
+        topic = self.make_topic(1)
+        for _ in range(3):
+            self.create_post(topic)
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.messages_count, 3)
+        self.assertEqual(sorted(group.name for group in profile.groups.all()), ["Habitué", "Nouveau"])
+        self.assertEqual(profile.top_group.name, "Habitué")
+        # A new messages group resets the ladder
+        ForumGroup.objects.create(name="Pilier", priority=3, description="Desc", minimum_messages=4, is_messages_group=True, color="#333333")
+        self.create_post(topic)
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.top_group.name, "Pilier")
+        self.assertEqual(profile.name_color, "#333333")
+
+    def test_stale_ladder_is_ignored(self):
+        from django.core.cache import cache
+        from forum.models import MESSAGES_GROUP_LADDER_CACHE_KEY
+        # A group deleted without the signals (like a rolled back transaction) is still in the cached ladder
+        cache.set(MESSAGES_GROUP_LADDER_CACHE_KEY, [(999999, 0)] + list(ForumGroup.objects.filter(is_messages_group=True).order_by('-priority').values_list('id', 'minimum_messages')))
+        self.create_post(self.make_topic(1))
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual([group.name for group in profile.groups.all()], ["Nouveau"])
+
+
+class TopicViewCounterTest(TestCase):
+    """The topic views are buffered and written to the topic and its parents in bulk."""
+
+    def setUp(self):
+        from unittest import mock
+        from forum import view_counter
+        # Use the buffer of this process, like when Redis is unavailable
+        patcher = mock.patch.object(view_counter, '_get_redis', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        view_counter._local_pending.clear()
+        view_counter._local_seen.clear()
+        self.category = Category.objects.create(name="Views Category", slug="views-category")
+        self.user = User.objects.create_user(username="views_user", password="testpass")
+        self.subforum = Topic.objects.create(author=self.user, title="Subforum", category=self.category, is_sub_forum=True)
+        self.topic = Topic.objects.create(author=self.user, title="Topic", category=self.category, parent=self.subforum)
+
+    def test_views_are_deduplicated_and_flushed(self):
+        from forum.view_counter import record_topic_view, flush_topic_views
+        self.assertTrue(record_topic_view(self.topic.id, "user:1"))
+        self.assertFalse(record_topic_view(self.topic.id, "user:1")) # same viewer, in the window
+        self.assertTrue(record_topic_view(self.topic.id, "user:2"))
+
+        # Not in the database yet, but shown with the pending views
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual(topic.total_views, 0)
+        self.assertEqual(topic.get_total_views, 2)
+
+        with self.assertNumQueries(4): # the topics and their parents, and one UPDATE (with its savepoint)
+            flush_topic_views()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).get_total_views, 2)
+        self.assertEqual(Topic.objects.get(pk=self.subforum.pk).total_views, 2)
+
+    def test_pending_views_of_a_page_at_once(self):
+        from unittest import mock
+        from forum import view_counter
+        view_counter.record_topic_view(self.topic.id, "user:1")
+        topics = [Topic.objects.get(pk=self.topic.pk), Topic.objects.get(pk=self.subforum.pk)]
+        with mock.patch.object(view_counter, 'get_pending_views', wraps=view_counter.get_pending_views) as get_pending_views:
+            view_counter.set_pending_views(topics)
+            self.assertEqual([topic.get_total_views for topic in topics], [1, 0])
+        self.assertEqual(get_pending_views.call_count, 1)
+
+    def test_pending_views_of_the_filtered_index(self):
+        from unittest import mock
+        from django.test import RequestFactory
+        from forum import view_counter, views_context_processors
+        view_counter.record_topic_view(self.topic.id, "user:1")
+        request = RequestFactory().get("/index/", {'filter': 'newposts'})
+        with mock.patch.object(views_context_processors, 'get_sidebar_context', return_value={}), \
+             mock.patch.object(view_counter, 'get_pending_views', wraps=view_counter.get_pending_views) as get_pending_views:
+            topics = views_context_processors.modern__index__processor(request, {})['filtered_topics']
+            views = {topic.id: topic.get_total_views for topic in topics}
+        self.assertEqual(views[self.topic.id], 1)
+        self.assertEqual(get_pending_views.call_count, 1)
+
+    def test_topic_details_counts_the_view_once(self):
+        from forum.view_counter import flush_topic_views
+        Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.client.force_login(self.user)
+        for _ in range(3):
+            self.client.get(f"/t{self.topic.id}-{self.topic.slug}")
+        flush_topic_views()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).total_views, 1)
+        self.assertEqual(Topic.objects.get(pk=self.subforum.pk).total_views, 1)
+
+
+class PostPositionTest(TestCase):
+    """The position of the posts in their topic is stored, so the relative ids and pages don't scan the topic."""
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Position Category", slug="position-category")
+        self.user = User.objects.create_user(username="position_user", password="testpass")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.other = User.objects.create_user(username="position_other", password="testpass")
+        self.other_profile = Profile.objects.create(user=self.other, birthdate="2000-01-01", gender="male")
+        self.topic = Topic.objects.create(author=self.user, title="Positions", category=self.category)
+
+    def make_posts(self, authors):
+        return [Post.objects.create(author=author, topic=self.topic, text=f"Message {index}") for index, author in enumerate(authors)]
+
+    def positions(self):
+        return list(Post.objects.filter(topic=self.topic).order_by('created_time', 'id').values_list('position', flat=True))
+
+    def test_positions_are_set_on_creation(self):
+        posts = self.make_posts([self.user, self.other] * 10)
+        self.assertEqual(self.positions(), list(range(1, 21)))
+        post = Post.objects.get(pk=posts[16].pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(post.get_relative_id, 17)
+            self.assertEqual(post.get_page_number, 2)
+
+    def test_hidden_author_renumbers_the_topic(self):
+        self.make_posts([self.user, self.other, self.user, self.other])
+        self.other_profile.is_hidden = True
+        self.other_profile.save()
+        self.assertEqual(self.positions(), [1, 2, 2, 3])
+        # New posts continue after the public ones
+        self.make_posts([self.user])
+        self.assertEqual(self.positions(), [1, 2, 2, 3, 3])
+        self.other_profile.is_hidden = False
+        self.other_profile.save()
+        self.assertEqual(self.positions(), [1, 2, 3, 4, 5])
+
+    def test_deleted_post_renumbers_the_topic(self):
+        posts = self.make_posts([self.user] * 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[1].delete()
+        self.assertEqual(self.positions(), [1, 2, 3])
+
+    def test_backfill_command(self):
+        from django.core.management import call_command
+        from io import StringIO
+        self.make_posts([self.user, self.other, self.user])
+        Post.objects.filter(topic=self.topic).update(position=None)
+        self.assertEqual(self.make_posts([self.user])[0].position, None) # unknown until the backfill
+        call_command('backfill_post_positions', stdout=StringIO())
+        self.assertEqual(self.positions(), [1, 2, 3, 4])
+
+    def test_post_redirect_page(self):
+        from forum.views import get_post_page_in_topic
+        posts = self.make_posts([self.user] * 31)
+        self.assertEqual(get_post_page_in_topic(posts[14].id, self.topic.id), 1)
+        self.assertEqual(get_post_page_in_topic(posts[15].id, self.topic.id), 2)
+        self.assertEqual(get_post_page_in_topic(posts[30].id, self.topic.id), 3)
+
+
+class TopicTreeTest(TestCase):
+    """The subforums tree is answered from the closure table, in one query whatever the depth."""
+    databases = {'default', 'archive'}
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Tree Category", slug="tree-category")
+        self.user = User.objects.create_user(username="tree_user", password="testpass")
+        self.root = Topic.objects.create(author=self.user, title="Root", category=self.category, is_sub_forum=True)
+        self.middle = Topic.objects.create(author=self.user, title="Middle", category=self.category, is_sub_forum=True, parent=self.root)
+        self.leaf = Topic.objects.create(author=self.user, title="Leaf", category=self.category, is_sub_forum=True, parent=self.middle)
+        self.topic = Topic.objects.create(author=self.user, title="Topic", category=self.category, parent=self.leaf)
+        self.other = Topic.objects.create(author=self.user, title="Other", category=self.category, is_sub_forum=True)
+
+    def test_ancestors_and_descendants(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(topic.ancestors()), [self.root, self.middle, self.leaf])
+        with self.assertNumQueries(1):
+            self.assertEqual(set(self.root.descendants()), {self.middle, self.leaf, self.topic})
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(self.middle.subtree_topic_ids()), sorted([self.middle.id, self.leaf.id, self.topic.id]))
+        with self.assertNumQueries(1):
+            self.assertEqual(topic.get_depth, 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(topic.get_tree, {self.root: [self.middle], self.middle: [self.leaf], self.leaf: []})
+
+    def test_move_keeps_the_tree_consistent(self):
+        from forum.models import TopicClosure
+        from forum.topic_tree import build_topic_links
+        middle = Topic.objects.get(pk=self.middle.pk)
+        middle.parent = self.other
+        middle.save()
+        self.assertEqual(list(Topic.objects.get(pk=self.topic.pk).ancestors()), [self.other, self.middle, self.leaf])
+        self.assertEqual(set(self.root.descendants()), set())
+        # Same rows as a rebuild from the parents
+        parents = dict(Topic.objects.values_list('id', 'parent_id'))
+        self.assertEqual(set(TopicClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), set(build_topic_links(parents)))
+
+        with self.assertRaises(ValidationError):
+            root = Topic.objects.get(pk=self.other.pk)
+            root.parent = self.leaf
+            root.save()
+
+    def test_rebuild_command(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from forum.models import TopicClosure
+        rows = set(TopicClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        TopicClosure.objects.all().delete()
+        call_command('rebuild_topic_tree', tree=['forum'], stdout=StringIO())
+        self.assertEqual(set(TopicClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), rows)
+
+    def test_subforum_unread(self):
+        from forum.views import check_subforum_unread
+        from forum.models import TopicReadStatus
+        self.assertTrue(check_subforum_unread(self.root, self.user))
+        TopicReadStatus.objects.create(user=self.user, topic=self.topic)
+        with self.assertNumQueries(1):
+            self.assertFalse(check_subforum_unread(self.root, self.user))
+
+
+class ReadWatermarkTest(TestCase):
+    """Marking things as read writes one watermark, and the unread checks combine it with the TopicReadStatus rows."""
+
+    def setUp(self):
+        from django.utils import timezone
+        self.now = timezone.now()
+        self.category = Category.objects.create(name="Read Category", slug="read-category")
+        self.other_category = Category.objects.create(name="Other Read Category", slug="other-read-category")
+        self.user = User.objects.create_user(username="read_user", password="testpass")
+        self.subforum = Topic.objects.create(author=self.user, title="Subforum", category=self.category, is_sub_forum=True)
+        self.nested = Topic.objects.create(author=self.user, title="Nested", category=self.category, is_sub_forum=True, parent=self.subforum)
+        self.topic = Topic.objects.create(author=self.user, title="Topic", category=self.category, parent=self.nested)
+        self.other = Topic.objects.create(author=self.user, title="Other", category=self.other_category)
+        Topic.objects.update(last_message_time=self.now - timezone.timedelta(hours=1))
+
+    def get_topics(self):
+        return list(Topic.objects.filter(id__in=[self.topic.id, self.other.id]).order_by('id'))
+
+    def test_new_profile_gets_a_watermark_instead_of_rows(self):
+        from forum.models import ReadWatermark, TopicReadStatus
+        from forum.read_state import get_read_times
+        Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.assertEqual(TopicReadStatus.objects.filter(user=self.user).count(), 0)
+        self.assertEqual(ReadWatermark.objects.filter(user=self.user, category=None, subforum=None).count(), 1)
+        self.assertEqual(set(get_read_times(self.user, self.get_topics())), {self.topic.id, self.other.id})
+
+    def test_scoped_watermarks(self):
+        from forum.read_state import mark_read, get_read_times
+        from forum.views import check_subforum_unread
+        self.assertTrue(check_subforum_unread(self.subforum, self.user))
+        with self.assertNumQueries(2):
+            mark_read(self.user, subforum=self.subforum) # UPDATE, then INSERT
+        with self.assertNumQueries(1):
+            mark_read(self.user, subforum=self.subforum)
+        self.assertFalse(check_subforum_unread(self.subforum, self.user))
+
+        topics = self.get_topics()
+        with self.assertNumQueries(3):
+            read_times = get_read_times(self.user, topics)
+        self.assertIn(self.topic.id, read_times)
+        self.assertNotIn(self.other.id, read_times)
+
+        mark_read(self.user, category=self.other_category)
+        self.assertIn(self.other.id, get_read_times(self.user, self.get_topics()))
+
+        # A new message makes the topic unread again
+        from django.utils import timezone
+        Topic.objects.filter(id=self.topic.id).update(last_message_time=timezone.now() + timezone.timedelta(minutes=1))
+        self.assertTrue(check_subforum_unread(self.subforum, self.user))
+
+    def test_compaction_deletes_the_rows_older_than_a_watermark(self):
+        from django.utils import timezone
+        from forum.models import TopicReadStatus
+        from forum.read_state import mark_read, compact_read_statuses
+        TopicReadStatus.objects.create(user=self.user, topic=self.topic)
+        TopicReadStatus.objects.create(user=self.user, topic=self.other)
+        TopicReadStatus.objects.all().update(last_read=self.now - timezone.timedelta(minutes=30))
+        mark_read(self.user, subforum=self.nested)
+        self.assertEqual(compact_read_statuses(), 1)
+        self.assertEqual(list(TopicReadStatus.objects.values_list('topic_id', flat=True)), [self.other.id])
+
+        # The rows newer than the watermark are kept
+        mark_read(self.user, when=self.now - timezone.timedelta(minutes=45))
+        self.assertEqual(compact_read_statuses(), 0)
+        mark_read(self.user)
+        self.assertEqual(compact_read_statuses(), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class UnreadFlagsTest(TestCase):
+    """The unread flags of a page of topics and subforums are one query whatever the depth, and cached per user."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        from django.utils import timezone
+        cache.clear()
+        self.category = Category.objects.create(name="Unread Category", slug="unread-category")
+        self.user = User.objects.create_user(username="unread_user", password="testpass")
+        self.subforums = []
+        self.topics = []
+        for index in range(3):
+            parent = Topic.objects.create(author=self.user, title=f"Subforum {index}", category=self.category, is_sub_forum=True)
+            self.subforums.append(parent)
+            for depth in range(index):
+                parent = Topic.objects.create(author=self.user, title=f"Nested {index}-{depth}", category=self.category, is_sub_forum=True, parent=parent)
+            self.topics.append(Topic.objects.create(author=self.user, title=f"Topic {index}", category=self.category, parent=parent))
+        Topic.objects.update(last_message_time=timezone.now() - timezone.timedelta(hours=1))
+        self.ids = [topic.id for topic in self.subforums + self.topics]
+
+    def test_flags_in_one_query_then_cached(self):
+        from forum.read_state import get_unread_flags
+        with self.assertNumQueries(1):
+            flags = get_unread_flags(self.user, self.ids)
+        self.assertTrue(all(flags.values()))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_flags(self.user, self.ids), flags)
+
+    def test_reads_and_new_messages_invalidate_the_flags(self):
+        from django.utils import timezone
+        from forum.models import TopicReadStatus
+        from forum.read_state import get_unread_flags, touch_user_read_state, touch_forum_read_state
+        get_unread_flags(self.user, self.ids)
+
+        TopicReadStatus.objects.create(user=self.user, topic=self.topics[2])
+        touch_user_read_state(self.user.id)
+        flags = get_unread_flags(self.user, self.ids)
+        self.assertFalse(flags[self.topics[2].id])
+        self.assertFalse(flags[self.subforums[2].id])
+        self.assertTrue(flags[self.subforums[1].id])
+
+        Topic.objects.filter(id=self.topics[2].id).update(last_message_time=timezone.now() + timezone.timedelta(minutes=1))
+        touch_forum_read_state()
+        self.assertTrue(get_unread_flags(self.user, self.ids)[self.subforums[2].id])
+
+    def test_anonymous_users_read_everything(self):
+        from django.contrib.auth.models import AnonymousUser
+        from forum.read_state import get_unread_flags
+        with self.assertNumQueries(0):
+            self.assertFalse(any(get_unread_flags(AnonymousUser(), self.ids).values()))
+
+
+class PresenceTest(TestCase):
+    """The online users are read from the presence tracker, and last_login is written in bulk."""
+
+    def setUp(self):
+        from unittest import mock
+        from forum import presence
+        from forum.models import Forum
+        # Use the tracker of this process, like when Redis is unavailable
+        patcher = mock.patch.object(presence, '_get_redis', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        presence._local_online.clear()
+        presence._local_pending.clear()
+        self.addCleanup(presence._local_online.clear)
+        self.addCleanup(presence._local_pending.clear)
+        self.users = []
+        for index in range(3):
+            user = User.objects.create_user(username=f"presence_user_{index}", password="testpass")
+            Profile.objects.create(user=user, birthdate="2000-01-01", gender="male", is_hidden=(index == 2))
+            self.users.append(user)
+        self.forum, _ = Forum.objects.get_or_create(name='UTF')
+        Forum.objects.filter(pk=self.forum.pk).update(online_record=1)
+
+    def test_online_users_without_queries(self):
+        from forum.presence import record_activity, get_online_user_ids, get_online_count, get_online_users
+        for user in self.users:
+            record_activity(user.id, hidden=user.profile.is_hidden)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_online_user_ids(), {self.users[0].id, self.users[1].id})
+            self.assertEqual(get_online_count(), 2)
+        self.assertEqual(list(get_online_users()), self.users[:2])
+
+    def test_flush_writes_last_login_and_online_record(self):
+        from django.utils import timezone
+        from forum.models import Forum
+        from forum.presence import record_activity, flush_presence
+        Profile.objects.update(last_login=timezone.now() - timezone.timedelta(days=1))
+        for user in self.users:
+            record_activity(user.id, hidden=user.profile.is_hidden)
+        with self.assertNumQueries(2): # one UPDATE for the profiles, one for the record
+            self.assertEqual(flush_presence(), 3)
+        recent = timezone.now() - timezone.timedelta(minutes=1)
+        self.assertEqual(Profile.objects.filter(user__in=self.users, last_login__gte=recent).count(), 3)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).online_record, 2)
+
+        # The record is never lowered
+        from forum import presence
+        presence._local_online.pop(self.users[0].id)
+        flush_presence()
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).online_record, 2)
+
+    def test_base_context_records_the_activity(self):
+        from forum.presence import get_online_user_ids
+        self.client.force_login(self.users[0])
+        self.client.get(reverse('index'))
+        self.assertIn(self.users[0].id, get_online_user_ids())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BoardStatsTest(TestCase):
+    """The headers and sidebars data is a shared snapshot, rebuilt once in a while by a single request."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username="stats_user", password="testpass")
+        Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+
+    def test_snapshot_is_shared(self):
+        from forum.board_stats import get_board_stats
+        stats = get_board_stats()
+        self.assertEqual(stats['latest_user'], self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_board_stats()['latest_user'], self.user)
+
+    def test_old_snapshot_is_used_while_another_request_rebuilds_it(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from forum import board_stats
+        board_stats.get_board_stats()
+        cache.add(board_stats.LOCK_KEY, 1, board_stats.LOCK_TIMEOUT) # another request is rebuilding it
+        with mock.patch.object(board_stats, 'REFRESH_INTERVAL', 0):
+            with self.assertNumQueries(0):
+                self.assertEqual(board_stats.get_board_stats()['latest_user'], self.user)
+            cache.delete(board_stats.LOCK_KEY)
+            with mock.patch.object(board_stats, 'build_board_stats', return_value={'latest_user': None}) as build:
+                self.assertIsNone(board_stats.get_board_stats()['latest_user'])
+                build.assert_called_once()
+
+    def test_online_groups_do_not_save_the_profiles(self):
+        from unittest import mock
+        from forum.views_context_processors import organize_online_users_by_groups
+        group = ForumGroup.objects.create(name="Stats Group", priority=4242, description="Desc", minimum_messages=0)
+        self.user.profile.groups.add(group)
+        with mock.patch.object(Profile, 'save') as save:
+            data = organize_online_users_by_groups(User.objects.filter(id=self.user.id))
+        save.assert_not_called()
+        self.assertEqual(data['structured_data'][0]['users'], [self.user])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PageCacheTest(TestCase):
+    """The pages of the anonymous users are stored, and dropped by the changes of their topics."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.category = Category.objects.create(name="Cache Category", slug="cache-category")
+        self.user = User.objects.create_user(username="cache_user", password="testpass")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.subforum = Topic.objects.create(author=self.user, title="Subforum", category=self.category, is_sub_forum=True)
+        self.topic = Topic.objects.create(author=self.user, title="Topic", category=self.category, parent=self.subforum)
+        self.other = Topic.objects.create(author=self.user, title="Other", category=self.category)
+        self.calls = []
+
+    def make_view(self, page_name, get_tags):
+        from django.http import HttpResponse
+        from django.middleware.csrf import get_token
+        from forum.page_cache import cache_anonymous_page
+
+        @cache_anonymous_page(page_name, get_tags)
+        def view(request, topicid):
+            self.calls.append(topicid)
+            return HttpResponse(f'<input type="hidden" name="csrfmiddlewaretoken" value="{get_token(request)}"> {len(self.calls)}')
+        return view
+
+    def get(self, view, topicid, path="/t", user=None):
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        request = RequestFactory().get(path)
+        request.user = user or AnonymousUser()
+        return view(request, topicid=topicid)
+
+    def test_anonymous_pages_are_stored(self):
+        from forum.page_cache import topic_tag, get_page_cache_stats
+        view = self.make_view('topic_details', lambda topicid: [topic_tag(topicid)])
+        first = self.get(view, self.topic.id)
+        second = self.get(view, self.topic.id)
+        self.assertEqual((first['X-Page-Cache'], second['X-Page-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(len(self.calls), 1)
+        # Each visitor gets their own CSRF token
+        self.assertNotEqual(first.content, second.content)
+        self.assertNotIn(b"__utf_page_cache_csrf_token__", second.content)
+
+        self.get(view, self.topic.id, path="/t?page=2") # (another page)
+        self.get(view, self.topic.id, user=self.user) # (not for the logged in users)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(get_page_cache_stats()['topic_details'], {'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3})
+
+    def test_changes_drop_the_pages_of_their_topics(self):
+        from forum.page_cache import topic_tag
+        view = self.make_view('topic_details', lambda topicid: [topic_tag(topicid)])
+        for topic in (self.topic, self.subforum, self.other):
+            self.get(view, topic.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.create(author=self.user, topic=self.topic, text="New message")
+        for topic in (self.topic, self.subforum, self.other):
+            self.get(view, topic.id)
+        self.assertEqual(self.calls, [self.topic.id, self.subforum.id, self.other.id, self.topic.id, self.subforum.id])
+
+    def test_hidden_user_drops_all_the_pages(self):
+        from forum.page_cache import topic_tag
+        view = self.make_view('topic_details', lambda topicid: [topic_tag(topicid)])
+        self.get(view, self.other.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.save() # (not hidden: nothing changes)
+        self.get(view, self.other.id)
+        self.assertEqual(len(self.calls), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.is_hidden = True
+            self.profile.save()
+        self.get(view, self.other.id)
+        self.assertEqual(len(self.calls), 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PostBlocksTest(TestCase):
+    """The HTML of the posts is cached for all the viewers, with their own controls on top."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.category = Category.objects.create(name="Blocks Category", slug="blocks-category")
+        self.user = User.objects.create_user(username="blocks_user", password="testpass")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.other = User.objects.create_user(username="blocks_other", password="testpass")
+        Profile.objects.create(user=self.other, birthdate="2000-01-01", gender="male")
+        self.topic = Topic.objects.create(author=self.user, title="Blocks", category=self.category)
+        for index in range(3):
+            Post.objects.create(author=self.user, topic=self.topic, text=f"[b]Message {index}[/b]")
+
+    def render(self, user, theme='modern'):
+        from unittest import mock
+        from django.test import RequestFactory
+        from forum import post_blocks
+        request = RequestFactory().get("/")
+        request.user = user
+        posts = Post.objects.select_related('author', 'author__profile', 'author__profile__top_group').filter(topic=self.topic).order_by('created_time')
+        with mock.patch.object(post_blocks, 'render_to_string', wraps=post_blocks.render_to_string) as render:
+            posts = post_blocks.render_post_blocks(request, theme, posts)
+        block_renders = [call for call in render.call_args_list if call.args[0].endswith('_post_block.html')]
+        return posts, len(block_renders)
+
+    def test_blocks_are_shared_between_viewers(self):
+        posts, renders = self.render(self.user)
+        self.assertEqual(renders, 3)
+        self.assertIn("<strong>Message 0</strong>", posts[0].block_html)
+        self.assertIn("Éditer le message", posts[0].block_html)
+        self.assertNotIn("\ue000", posts[0].block_html)
+
+        posts, renders = self.render(self.other)
+        self.assertEqual(renders, 0)
+        self.assertNotIn("Éditer le message", posts[0].block_html)
+
+    def test_markers_cannot_be_forged(self):
+        from forum.post_blocks import MARKER_FORMAT
+        post = Post.objects.filter(topic=self.topic).order_by('created_time').first()
+        post.text = f"__post_block_edit__ {MARKER_FORMAT.format(token='0' * 16, name='edit')}"
+        post.save()
+        posts, _ = self.render(self.other)
+        self.assertNotIn("Éditer le message", posts[0].block_html)
+
+    def test_edits_and_profile_changes_render_the_blocks_again(self):
+        self.render(self.other)
+        post = Post.objects.filter(topic=self.topic).order_by('created_time').first()
+        post.text = "Edited"
+        post.save()
+        self.assertEqual(self.render(self.other)[1], 1)
+        self.profile.signature = "New signature"
+        self.profile.save()
+        posts, renders = self.render(self.other)
+        self.assertEqual(renders, 3)
+        self.assertIn("New signature", posts[0].block_html)
+
+
+class NotificationsTest(TestCase):
+    """The notifications are sent after the commit, to the recipients of one query, with one Redis pipeline."""
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Notif Category", slug="notif-category")
+        self.author = User.objects.create_user(username="notif_author", password="testpass")
+        self.author_profile = Profile.objects.create(user=self.author, birthdate="2000-01-01", gender="male")
+        self.users = []
+        for index in range(4):
+            user = User.objects.create_user(username=f"notif_user_{index}", password="testpass")
+            Profile.objects.create(user=user, birthdate="2000-01-01", gender="male")
+            self.users.append(user)
+        self.subforum = Topic.objects.create(author=self.author, title="Subforum", category=self.category, is_sub_forum=True)
+        self.topic = Topic.objects.create(author=self.author, title="Topic", category=self.category, parent=self.subforum)
+        self.subforum.watchers.add(self.users[0], self.users[1])
+        self.topic.watchers.add(self.users[1], self.author)
+        self.category.watchers.add(self.users[2])
+        self.author_profile.followers.add(self.users[2], self.users[3])
+
+    def test_recipients_in_one_query(self):
+        from forum.notifications import get_recipient_ids
+        with self.assertNumQueries(1):
+            recipients = get_recipient_ids(self.author.id, self.category.id, self.topic.id)
+        self.assertEqual(recipients, {user.id for user in self.users})
+
+    def test_reply_is_published_after_the_commit(self):
+        from unittest import mock
+        from forum import signals, tasks
+        Post.objects.create(author=self.author, topic=self.topic, text="First post")
+        client = mock.MagicMock()
+        pipe = client.pipeline.return_value
+        pipe.execute.return_value = [b"1700000000000-0", 1] * len(self.users) # (XADD and EXPIRE of each user)
+        with mock.patch.object(signals, 'redis_client', client), \
+             mock.patch.object(tasks.notify_new_post, 'delay', side_effect=tasks.notify_new_post):
+            with self.captureOnCommitCallbacks() as callbacks:
+                Post.objects.create(author=self.author, topic=self.topic, text="Reply")
+            client.pipeline.assert_not_called()
+            for callback in callbacks:
+                callback()
+        self.assertEqual(sorted(call.args[0] for call in pipe.xadd.call_args_list), sorted(f"utf_forum:notifications:stream:{user.id}" for user in self.users))
+        self.assertEqual(sorted(call.args[0] for call in pipe.publish.call_args_list), sorted(f"user_notifications_{user.id}" for user in self.users))
+        self.assertEqual({call.args[1].split("\n")[0] for call in pipe.publish.call_args_list}, {"1700000000000-0"}) # (with the stream ids)
+        self.assertEqual(len({call.args[1] for call in pipe.publish.call_args_list}), 1) # (the same payload)
+        self.assertEqual(pipe.execute.call_count, 2)
+
+
+class NotificationHubTest(SimpleTestCase):
+    """The notifications of all the streams of a process come from one subscriber, through a queue per stream."""
+
+    def test_dispatch_to_the_streams_of_the_user(self):
+        import asyncio
+        from unittest import mock
+        from forum import notification_hub
+        from forum.notification_hub import NotificationHub
+
+        async def scenario():
+            hub = NotificationHub()
+            with mock.patch.object(NotificationHub, '_listen', new=mock.AsyncMock()), \
+                 mock.patch.object(NotificationHub, '_report_stats', new=mock.AsyncMock()):
+                first, second = hub.connect(1), hub.connect(1)
+                other = hub.connect(2)
+                hub.dispatch("user_notifications_1", '1700000000000-0\n{"message": "Salut"}')
+                self.assertEqual(await first.get(), ("1700000000000-0", '{"message": "Salut"}'))
+                self.assertEqual(await second.get(), ("1700000000000-0", '{"message": "Salut"}'))
+                self.assertTrue(other.empty())
+                hub.dispatch("user_notifications_2", '{"message": "Sans id"}') # (like send_test_notification)
+                self.assertEqual(await other.get(), (None, '{"message": "Sans id"}'))
+
+                # A stream that doesn't read keeps the latest messages
+                with mock.patch.object(notification_hub, 'QUEUE_SIZE', 2):
+                    slow = hub.connect(3)
+                for index in range(3):
+                    hub.dispatch("user_notifications_3", str(index))
+                self.assertEqual(hub.get_stats()['max_queue_depth'], 2)
+                self.assertEqual(hub.get_stats()['dropped'], 1)
+                self.assertEqual(slow.get_nowait(), (None, "1"))
+
+                for user_id, queue in ((1, first), (1, second), (2, other), (3, slow)):
+                    hub.disconnect(user_id, queue)
+                self.assertEqual(hub.get_stats()['streams'], 0)
+
+        asyncio.run(scenario())
+
+
+class NotificationReplayTest(SimpleTestCase):
+    """A stream that reconnects with a Last-Event-ID gets the notifications it missed."""
+
+    def test_missed_notifications_are_read_after_the_last_event_id(self):
+        import asyncio
+        from unittest import mock
+        from forum.notification_hub import NotificationHub, format_event
+
+        async def scenario():
+            hub = NotificationHub()
+            hub._client = mock.MagicMock()
+            hub._client.xrange = mock.AsyncMock(return_value=[(b"2-0", {b"data": b'{"message": "B"}'})])
+            self.assertEqual(await hub.read_missed(1, "1-0"), [("2-0", '{"message": "B"}')])
+            hub._client.xrange.assert_awaited_once()
+            self.assertEqual(hub._client.xrange.call_args.kwargs['min'], "(1-0") # (after it)
+            self.assertEqual(await hub.read_missed(1, "not an id"), [])
+            self.assertEqual(await hub.read_missed(1, None), [])
+
+        asyncio.run(scenario())
+        self.assertEqual(format_event("2-0", "{}"), "id: 2-0\ndata: {}\n\n")
+        self.assertEqual(format_event(None, "{}"), "data: {}\n\n")
+
+
+class WebhookDispatcherTest(SimpleTestCase):
+    """The webhook events are sent by one background worker, batched, and dropped when the queue is full."""
+
+    def setUp(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.received = []
+        received = self.received
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        # A local stand-in for the webhook
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/webhook"
+
+    def wait_for(self, condition):
+        import time
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_events_are_coalesced(self):
+        from forum.webhooks import WebhookDispatcher
+        dispatcher = WebhookDispatcher(self.url, batch_delay=0.2)
+        for index in range(5):
+            self.assertTrue(dispatcher.send("webhook_user", f"request {index}\n"))
+        self.wait_for(lambda: dispatcher.get_stats()['sent_events'] == 5)
+        self.assertEqual(dispatcher.get_stats()['sent'], 1)
+        self.assertEqual(self.received, [{'username': "webhook_user", 'content': "".join(f"request {index}\n" for index in range(5))}])
+
+    def test_long_batches_are_split(self):
+        from forum.webhooks import WebhookDispatcher, MAX_CONTENT_LENGTH
+        dispatcher = WebhookDispatcher(self.url, batch_delay=0.2)
+        for index in range(3):
+            dispatcher.send(f"user_{index}", "x" * (MAX_CONTENT_LENGTH // 2))
+        self.wait_for(lambda: dispatcher.get_stats()['sent_events'] == 3)
+        self.assertEqual([len(payload['content']) for payload in self.received], [MAX_CONTENT_LENGTH, MAX_CONTENT_LENGTH // 2])
+        self.assertEqual(self.received[0]['username'], "2 requêtes")
+
+    def test_full_queue_drops_the_events(self):
+        from unittest import mock
+        from forum.webhooks import WebhookDispatcher
+        dispatcher = WebhookDispatcher(self.url, queue_size=2)
+        dispatcher._worker = mock.Mock(is_alive=lambda: True) # (the worker doesn't take the events)
+        self.assertTrue(dispatcher.send("webhook_user", "a"))
+        self.assertTrue(dispatcher.send("webhook_user", "b"))
+        self.assertFalse(dispatcher.send("webhook_user", "c"))
+        self.assertEqual(dispatcher.get_stats()['dropped'], 1)
+        self.assertEqual(dispatcher.get_stats()['queued'], 2)
+
+
+@override_settings(DISABLE_CUSTOM_PRINTS=False, LOG_CELERY_LEVEL='')
+class LogPipelineTest(SimpleTestCase):
+    """safe_async_log filters by level first, writes the records from a listener thread, and only sends the
+    records from LOG_CELERY_LEVEL to Celery."""
+
+    def setUp(self):
+        import logging
+        from forum import log_pipeline
+        self.records = []
+        records = self.records
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger(log_pipeline.LOGGER_NAME)
+        handlers, level = logger.handlers, logger.level
+        log_pipeline.stop_pipeline()
+        logger.handlers = [ListHandler()]
+        logger.setLevel(logging.INFO)
+
+        def restore():
+            log_pipeline.stop_pipeline()
+            logger.handlers = handlers
+            logger.setLevel(level)
+        self.addCleanup(restore)
+
+    def test_filtered_and_queued_records(self):
+        from unittest import mock
+        from forum import log_pipeline, tasks
+        with mock.patch.object(tasks.async_log, 'delay') as delay:
+            tasks.safe_async_log("Not written", 'debug', 'topic_details')
+            tasks.safe_async_log("Written", 'info', 'topic_details')
+            tasks.safe_async_log("Written too", 'error')
+        log_pipeline.stop_pipeline() # (writes the waiting records)
+        delay.assert_not_called()
+        self.assertEqual(self.records, ["[topic_details] Written", "Written too"])
+
+    @override_settings(LOG_CELERY_LEVEL='error')
+    def test_celery_level(self):
+        from unittest import mock
+        from forum import log_pipeline, tasks
+        with mock.patch.object(tasks.async_log, 'delay') as delay:
+            tasks.safe_async_log("Written", 'info', 'index')
+            tasks.safe_async_log("Sent to Celery", 'error', 'index')
+        log_pipeline.stop_pipeline()
+        delay.assert_called_once_with("Sent to Celery", 'error', 'index')
+        self.assertEqual(self.records, ["[index] Written"])
+
+        # Written here when Celery is unavailable
+        with mock.patch.object(tasks.async_log, 'delay', side_effect=ConnectionError("down")):
+            tasks.safe_async_log("Not sent", 'critical', 'index')
+        log_pipeline.stop_pipeline()
+        self.assertEqual(self.records[-1], "[index] Not sent (Celery unavailable: down)")
+
+    def test_full_queue_drops_the_records(self):
+        import logging
+        import queue
+        from forum.log_pipeline import DroppingQueueHandler
+        handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+        logger = logging.getLogger("forum.tests.log_pipeline")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning("first")
+        logger.warning("second")
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_stop_with_a_full_queue(self):
+        import logging
+        from forum.log_pipeline import LogPipeline
+        logger = logging.getLogger("forum.tests.log_pipeline_full")
+        logger.propagate = False
+        logger.handlers = [logging.NullHandler()]
+        pipeline = LogPipeline(logger, queue_size=5, batch_size=2)
+        for index in range(50):
+            logger.warning(f"record {index}")
+        pipeline.stop()
+        self.assertEqual(pipeline.get_stats()['queued'], 0)
+        self.assertEqual(pipeline.queue.unfinished_tasks, 0)
+        self.assertIsNone(pipeline.listener.thread)
+
+
+class AsyncMiddlewareTest(SimpleTestCase):
+    """The forum middlewares run in the mode of the handler, without sync/async adaptation."""
+
+    def test_force_https_sync_and_async(self):
+        import asyncio
+        from asgiref.sync import iscoroutinefunction
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from forum.middleware import ForceHTTPSMiddleware
+
+        middleware = ForceHTTPSMiddleware(lambda request: HttpResponse("sync"))
+        self.assertFalse(iscoroutinefunction(middleware))
+        request = RequestFactory().get('/')
+        self.assertEqual(middleware(request).content, b"sync")
+        self.assertTrue(request.is_secure())
+
+        async def get_response(request):
+            return HttpResponse("async")
+        middleware = ForceHTTPSMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = RequestFactory().get('/')
+        self.assertEqual(asyncio.run(middleware(request)).content, b"async")
+        self.assertTrue(request.is_secure())
+
+    @override_settings(GET_WEBHOOK_URL="http://127.0.0.1/webhook")
+    def test_webhook_async_uses_auser(self):
+        import asyncio
+        from unittest import mock
+        from django.contrib.auth.models import AnonymousUser
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from forum import middleware as forum_middleware
+
+        async def get_response(request):
+            return HttpResponse("async")
+        user = mock.Mock(is_authenticated=True, username="async_user")
+        request = RequestFactory().get('/forum/')
+        request.user = AnonymousUser() # (not the one used in async mode)
+        async def auser():
+            return user
+        request.auser = auser
+
+        with mock.patch.object(forum_middleware, 'get_dispatcher') as get_dispatcher:
+            response = asyncio.run(forum_middleware.WebhookMiddleware(get_response)(request))
+        self.assertEqual(response.content, b"async")
+        username, content = get_dispatcher.return_value.send.call_args.args
+        self.assertEqual(username, "async_user (async)")
+        self.assertIn("/forum/", content)
+
+    def test_no_adaptation_under_asgi(self):
+        from django.conf import settings
+        from forum.management.commands.check_middleware import get_middleware_adaptations
+        middleware = [path for path in settings.MIDDLEWARE if not path.startswith('debug_toolbar.')]
+        results, top_adapted = get_middleware_adaptations(middleware, is_async=True)
+        self.assertEqual([path for path, mode, adapted in results if adapted], [])
+        self.assertFalse(top_adapted)
+
+        # A sync only middleware is adapted
+        results, top_adapted = get_middleware_adaptations(middleware + ['forum.management.commands.benchmark_asgi.SyncOnlyWebhookMiddleware'], is_async=True)
+        self.assertEqual([path for path, mode, adapted in results if adapted], ['forum.management.commands.benchmark_asgi.SyncOnlyWebhookMiddleware'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, RATELIMIT_ENABLE=False)
+class AsyncViewsTest(TestCase):
+    """The read paths of the hottest pages are async views, the other requests go to the sync views."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.enterContext(override_settings(ROOT_URLCONF='forum.tests_async_urls')) # (the URLs with ASYNC_VIEWS set)
+        self.category = Category.objects.create(name="Async Category", slug="async-category")
+        self.user = User.objects.create_user(username="async_user", password="testpass")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.subforum = Topic.objects.create(author=self.user, title="Async subforum", category=self.category, is_sub_forum=True)
+        self.topic = Topic.objects.create(author=self.user, title="Async topic", category=self.category, parent=self.subforum)
+        Post.objects.create(author=self.user, topic=self.topic, text="[b]Async message[/b]")
+
+    def test_urls_use_the_async_views(self):
+        from django.urls import resolve
+        from forum import views_async
+        self.assertIs(resolve(self.topic.get_absolute_url).func, views_async.topic_details)
+        self.assertIs(resolve(reverse('index')).func, views_async.index)
+
+    def test_async_read_paths(self):
+        from forum.models import TopicReadStatus
+        self.client.login(username="async_user", password="testpass")
+        response = self.client.get(self.topic.get_absolute_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "<strong>Async message</strong>")
+        self.assertTrue(TopicReadStatus.objects.filter(user=self.user, topic=self.topic).exists())
+
+        for url in (reverse('index'), self.subforum.get_absolute_url, reverse('category-details', args=[self.category.id, self.category.slug])):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(reverse('topic-details', args=[999999, "missing"])).status_code, 404)
+
+    def test_pages_are_counted_like_the_sync_view(self):
+        from django.utils import timezone
+        for _ in range(20):
+            Post.objects.create(author=self.user, topic=self.topic, text="Old message")
+        Post.objects.filter(topic=self.topic).update(created_time=timezone.now() - timezone.timedelta(days=30))
+        self.client.login(username="async_user", password="testpass")
+        response = self.client.get(self.topic.get_absolute_url, {'days': 7})
+        self.assertEqual(response.context['max_page'], 2) # (all the posts of the topic, like in views.topic_details)
+
+    def test_anonymous_pages_are_cached(self):
+        self.assertEqual(self.client.get(self.topic.get_absolute_url)['X-Page-Cache'], 'MISS')
+        self.assertEqual(self.client.get(self.topic.get_absolute_url)['X-Page-Cache'], 'HIT')
+
+    def test_post_goes_to_the_sync_view(self):
+        response = self.client.post(self.subforum.get_absolute_url, {'days': 7})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("days=7", response.url)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, RATELIMIT_ENABLE=False)
+class SearchTest(TestCase):
+    """The keywords are searched in the full-text index (the FTS5 table with SQLite)."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.category = Category.objects.create(name="Search Category", slug="search-category")
+        self.user = User.objects.create_user(username="search_user", password="testpass")
+        self.profile = Profile.objects.create(user=self.user, birthdate="2000-01-01", gender="male")
+        self.subforum = Topic.objects.create(author=self.user, title="Search subforum", category=self.category, is_sub_forum=True)
+        self.topic = Topic.objects.create(author=self.user, title="Le château", category=self.category, parent=self.subforum)
+        self.first = Post.objects.create(author=self.user, topic=self.topic, text="Les [b]chats[/b] sont élégants")
+        self.second = Post.objects.create(author=self.user, topic=self.topic, text="Un chien, un chat et encore un chat")
+        self.third = Post.objects.create(author=self.user, topic=self.topic, text="Rien à voir")
+
+    def search(self, keyword, terms='any', fields='msgonly'):
+        from forum.search import get_search_backend
+        return set(get_search_backend().filter(Post.objects.all(), keyword, terms, fields).values_list('id', flat=True))
+
+    def test_backend(self):
+        from forum.search import get_search_backend, SQLiteSearchBackend
+        self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_any_and_all(self):
+        self.assertEqual(self.search("chien elegant"), {self.first.id, self.second.id})
+        self.assertEqual(self.search("un chat", terms='all'), {self.second.id})
+        self.assertEqual(self.search("chat un", terms='all'), set())
+        self.assertEqual(self.search("ELEGANTS"), {self.first.id})
+        self.assertEqual(self.search("chateau"), set())
+        self.assertEqual(self.search("chateau", fields='all'), {self.first.id, self.second.id, self.third.id})
+
+    def test_index_follows_the_posts(self):
+        self.third.text = "Un chat noir"
+        self.third.save()
+        self.first.delete()
+        self.assertEqual(self.search("chat"), {self.second.id, self.third.id})
+        self.topic.title = "Le jardin"
+        self.topic.save()
+        self.assertEqual(self.search("jardin", fields='all'), {self.second.id, self.third.id})
+
+    def test_missing_triggers_are_created_again(self):
+        from django.db import connection
+        from forum.search import ensure_search_triggers, SQLITE_TRIGGERS
+        self.assertFalse(ensure_search_triggers())
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {SQLITE_TRIGGERS[0]}") # (like a migration remaking forum_post)
+        Post.objects.create(author=self.user, topic=self.topic, text="Un lapin")
+        self.assertEqual(self.search("lapin"), set())
+        self.assertTrue(ensure_search_triggers())
+        self.assertEqual(len(self.search("lapin")), 1)
+        Post.objects.create(author=self.user, topic=self.topic, text="Un autre lapin")
+        self.assertEqual(len(self.search("lapin")), 2)
+
+    def test_relevance_and_snippets(self):
+        response = self.client.get(reverse('search-results'), {'keyword': "chat", 'search_fields': 'msgonly', 'sort_by': 'relevance'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([message.id for message in response.context['results']], [self.second.id, self.first.id])
+        self.assertIn('<span class="posthilit">chat</span>', response.context['results'][0].search_snippet)
+        self.assertNotIn("[b]", response.context['results'][1].search_snippet)
+
+    def test_api(self):
+        response = self.client.get(reverse('api-search'), {'keyword': "chien"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['id'] for post in response.json()['results']], [self.second.id])
+        self.assertEqual(self.client.get(reverse('api-search')).status_code, 400)
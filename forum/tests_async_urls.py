@@ -0,0 +1,10 @@
+# forum/tests_async_urls.py
+
+# The URLs with ASYNC_VIEWS set (like under daphne, see entrypoint.sh), for AsyncViewsTest: the URLs of utf/urls.py
+# with the hottest pages routed to forum/views_async.py.
+
+from django.urls import get_resolver
+from forum import views, views_async
+from forum.management.commands.benchmark_concurrency import swap_views, HOT_VIEWS
+
+urlpatterns = swap_views(get_resolver('utf.urls').url_patterns, {getattr(views, name): getattr(views_async, name) for name in HOT_VIEWS})
@@ -0,0 +1,128 @@
+# forum/topic_tree.py
+
+from django.core.exceptions import ValidationError
+from django.db import models, router, transaction
+
+# The subforums tree is stored twice: with the parent of each topic, and in a closure table (TopicClosure for the forum,
+# ArchiveTopicClosure for the archive) with one row per (ancestor, descendant) pair, including (topic, topic) at depth 0.
+# The ancestors, descendants or whole subtree of a topic are then one indexed query, whatever the depth, instead of
+# following the parents one query per level.
+# The rows are kept up to date by TopicTreeMixin.save() (creation and moves), and deleted with the topics (CASCADE).
+# "python manage.py rebuild_topic_tree" rebuilds the tables, for the topics made with bulk_create or raw SQL.
+
+
+class TopicClosureBase(models.Model):
+    """A topic (descendant) and one of its ancestors (or itself at depth 0). The ancestor/descendant foreign keys are
+    declared in the subclasses (related names: descendant_links and ancestor_links)."""
+    depth = models.PositiveIntegerField() # 0 for the topic itself, 1 for its parent...
+
+    class Meta:
+        abstract = True
+
+
+class TopicTreeMixin:
+    """Ancestors and descendants of a topic, from the closure table named by closure_model_name (in the same app)."""
+    closure_model_name = None
+
+    @classmethod
+    def get_closure_model(cls):
+        return cls._meta.apps.get_model(cls._meta.app_label, cls.closure_model_name)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'parent_id' in instance.__dict__: # (not when deferred)
+            instance._loaded_parent_id = instance.parent_id # to detect the moves in save()
+        return instance
+
+    def ancestors(self, include_self=False):
+        """Get the parents of this topic, from the root topic to its direct parent (one query)."""
+        return type(self).objects.filter(
+            descendant_links__descendant_id=self.id,
+            descendant_links__depth__gte=0 if include_self else 1,
+        ).order_by('-descendant_links__depth')
+
+    def descendants(self, include_self=False):
+        """Get all the topics under this one, at any depth (one query)."""
+        return type(self).objects.filter(
+            ancestor_links__ancestor_id=self.id,
+            ancestor_links__depth__gte=0 if include_self else 1,
+        )
+
+    def subtree_topic_ids(self):
+        """Get the ids of this topic and of all the topics under it (one query)."""
+        return list(self.get_closure_model().objects.filter(ancestor_id=self.id).values_list('descendant_id', flat=True))
+
+    def save(self, *args, **kwargs):
+        closure_model = self.get_closure_model()
+        created = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        parent_may_change = not created and (update_fields is None or 'parent' in update_fields or 'parent_id' in update_fields)
+        if parent_may_change:
+            if hasattr(self, '_loaded_parent_id'):
+                old_parent_id = self._loaded_parent_id
+            else:
+                old_parent_id = type(self).objects.filter(pk=self.pk).values_list('parent_id', flat=True).first()
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            if created:
+                # The ancestors of the parent, one level further, and the topic itself
+                links = [closure_model(ancestor_id=self.id, descendant_id=self.id, depth=0)]
+                if self.parent_id is not None:
+                    links += [
+                        closure_model(ancestor_id=ancestor_id, descendant_id=self.id, depth=depth + 1)
+                        for ancestor_id, depth in closure_model.objects.filter(descendant_id=self.parent_id).values_list('ancestor_id', 'depth')
+                    ]
+                closure_model.objects.bulk_create(links)
+            elif parent_may_change and old_parent_id != self.parent_id:
+                move_topic_links(closure_model, self.id, self.parent_id)
+        self._loaded_parent_id = self.parent_id
+
+
+def move_topic_links(closure_model, topic_id, new_parent_id):
+    """Move the subtree of a topic under its new parent in the closure table."""
+    subtree = list(closure_model.objects.filter(ancestor_id=topic_id).values_list('descendant_id', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+    if new_parent_id in subtree_ids:
+        raise ValidationError("A topic can't be moved under itself or one of its children.")
+
+    # Forget the old ancestors of the whole subtree, then link it to the new ones
+    old_ancestor_ids = list(closure_model.objects.filter(descendant_id=topic_id, depth__gt=0).values_list('ancestor_id', flat=True))
+    closure_model.objects.filter(descendant_id__in=subtree_ids, ancestor_id__in=old_ancestor_ids).delete()
+    if new_parent_id is not None:
+        new_ancestors = list(closure_model.objects.filter(descendant_id=new_parent_id).values_list('ancestor_id', 'depth'))
+        closure_model.objects.bulk_create([
+            closure_model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + 1 + descendant_depth)
+            for ancestor_id, ancestor_depth in new_ancestors
+            for descendant_id, descendant_depth in subtree
+        ], batch_size=1000)
+
+
+def build_topic_links(parents):
+    """Get all the (ancestor_id, descendant_id, depth) rows of the closure table from a {topic_id: parent_id} dict."""
+    rows = []
+    for topic_id in parents:
+        current, depth, seen = topic_id, 0, set()
+        while current is not None and current not in seen: # (a broken parent loop stops at the first repeated topic)
+            seen.add(current)
+            rows.append((current, topic_id, depth))
+            current = parents.get(current)
+            depth += 1
+    return rows
+
+
+def rebuild_topic_links(topic_model, batch_size=1000):
+    """Rebuild the whole closure table of topic_model from the parents. Returns the number of rows."""
+    closure_model = topic_model.get_closure_model()
+    parents = dict(topic_model.objects.values_list('id', 'parent_id'))
+    rows = build_topic_links(parents)
+    using = router.db_for_write(closure_model)
+    with transaction.atomic(using=using):
+        closure_model.objects.all().delete()
+        closure_model.objects.bulk_create(
+            (closure_model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth) for ancestor_id, descendant_id, depth in rows),
+            batch_size=batch_size,
+        )
+    return len(rows)
@@ -1,13 +1,16 @@
 # forum/urls.py
 
 from django.urls import path
-from . import views
+from . import views, views_async
 from django.conf import settings
 from django.conf.urls.static import static
 
+# The read paths of the hottest pages are async views under ASGI, the sync ones are kept for WSGI (see forum/views_async.py)
+hot_views = views_async if settings.ASYNC_VIEWS else views
+
 urlpatterns = [
     path('', views.index_redirect, name='index-redirect'),
-    path('index/', views.index, name='index'),
+    path('index/', hot_views.index, name='index'),
     path('faq/', views.faq, name='faq'),
     path('register/regulation/', views.register_regulation, name='register-regulation'),
     path('register/', views.register, name='register'),
@@ -16,12 +19,12 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout-view'),
     path('profile/<int:userid>/', views.profile_details, name='profile-details'),
     path('memberlist', views.member_list, name='member-list'),
-    path('f<int:subforumid>-<slug:subforumslug>', views.subforum_details, name='subforum-details'),
-    path('t<int:topicid>-<slug:topicslug>', views.topic_details, name='topic-details'),
+    path('f<int:subforumid>-<slug:subforumslug>', hot_views.subforum_details, name='subforum-details'),
+    path('t<int:topicid>-<slug:topicslug>', hot_views.topic_details, name='topic-details'),
     path('testpage', views.test_page, name='test-page'),
     path('new_topic', views.new_topic, name='new-topic'),
     path('new_post', views.new_post, name='new-post'),
-    path('c<int:categoryid>-<slug:categoryslug>', views.category_details, name='category-details'),
+    path('c<int:categoryid>-<slug:categoryslug>', hot_views.category_details, name='category-details'),
     path('search/', views.search, name='search'),
     path('edit_profile/', views.edit_profile, name='edit-profile'),
     path('search_results', views.search_results, name='search-results'),
@@ -0,0 +1,173 @@
+# forum/view_counter.py
+
+import threading
+import time
+from collections import Counter
+from django.db import transaction
+from django.db.models import F
+from utf.utils import cprint
+
+# The topic views are not written to the database on every page view anymore (it used to be one UPDATE per topic and
+# parent subforum, on the hottest rows of the forum). record_topic_view() adds them to a buffer in Redis (or in this
+# process when Redis is unavailable), and flush_topic_views() writes them to Topic.total_views in bulk, from the
+# "flush-topic-views" Celery beat task (see forum/tasks.py and CELERY_BEAT_SCHEDULE).
+# The buffer only knows the viewed topics: their parent subforums get the views when they are flushed.
+# Until then, get_pending_views() gives the views that are still in the buffer (see Topic.get_total_views).
+
+# The same viewer is only counted once per topic in this window (it was the 3 minutes check on TopicReadStatus before)
+VIEW_DEDUPE_WINDOW = 3 * 60 # seconds
+# How often the buffer in this process is flushed when Redis is unavailable
+LOCAL_FLUSH_INTERVAL = 60 # seconds
+# How long to stop trying Redis after a connection error
+REDIS_RETRY_DELAY = 30 # seconds
+
+PENDING_KEY = "utf_forum:topic_views:pending"
+FLUSHING_KEY = "utf_forum:topic_views:flushing"
+SEEN_KEY = "utf_forum:topic_views:seen:{topic_id}:{viewer}"
+
+_local_pending = Counter()
+_local_seen = {} # (topic_id, viewer): expiry time
+_local_lock = threading.Lock()
+_local_last_flush = time.monotonic()
+_redis_retry_time = 0
+
+
+def _get_redis():
+    """Get the Redis client of the notifications, or None when it is unavailable."""
+    from .signals import redis_client # (forum.signals imports the models, which use this module)
+    if redis_client is None or time.monotonic() < _redis_retry_time:
+        return None
+    return redis_client
+
+def _redis_failed(e):
+    global _redis_retry_time
+    _redis_retry_time = time.monotonic() + REDIS_RETRY_DELAY
+    cprint(f"Topic views buffer: Redis unavailable, using the local buffer for {REDIS_RETRY_DELAY}s ({e})")
+
+
+def get_viewer_key(request):
+    """The key used to count a viewer once per window: the user id, or the IP address for anonymous visitors."""
+    if request.user.is_authenticated:
+        return f"user:{request.user.id}"
+    return f"ip:{request.META.get('REMOTE_ADDR', 'unknown')}"
+
+def record_topic_view(topic_id, viewer):
+    """Count a view of the topic (and of its parent subforums), unless this viewer already viewed it recently.
+    Returns True if the view was counted."""
+    client = _get_redis()
+    if client is not None:
+        try:
+            if not client.set(SEEN_KEY.format(topic_id=topic_id, viewer=viewer), 1, nx=True, ex=VIEW_DEDUPE_WINDOW):
+                return False
+            client.hincrby(PENDING_KEY, topic_id, 1)
+            return True
+        except Exception as e:
+            _redis_failed(e)
+
+    now = time.monotonic()
+    with _local_lock:
+        expiry = _local_seen.get((topic_id, viewer))
+        if expiry is not None and expiry > now:
+            return False
+        if len(_local_seen) > 10000: # forget the expired viewers once in a while
+            for key in [key for key, key_expiry in _local_seen.items() if key_expiry <= now]:
+                del _local_seen[key]
+        _local_seen[(topic_id, viewer)] = now + VIEW_DEDUPE_WINDOW
+        _local_pending[topic_id] += 1
+        flush_due = now - _local_last_flush > LOCAL_FLUSH_INTERVAL
+
+    # Without Redis, the beat task can't see the buffer of this process: flush it from here once in a while
+    if flush_due:
+        flush_local_topic_views()
+    return True
+
+def get_pending_views(topic_ids):
+    """Get the views of these topics that are not in the database yet, as a {topic_id: views} dict."""
+    topic_ids = list(topic_ids)
+    pending = {}
+    with _local_lock:
+        for topic_id in topic_ids:
+            if _local_pending.get(topic_id):
+                pending[topic_id] = _local_pending[topic_id]
+
+    client = _get_redis()
+    if client is not None and topic_ids:
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hmget(PENDING_KEY, topic_ids)
+            pipe.hmget(FLUSHING_KEY, topic_ids) # (being written to the database right now)
+            for values in pipe.execute():
+                for topic_id, value in zip(topic_ids, values):
+                    if value:
+                        pending[topic_id] = pending.get(topic_id, 0) + int(value)
+        except Exception as e:
+            _redis_failed(e)
+    return pending
+
+def set_pending_views(topics):
+    """Set topic.pending_views for each topic of a page, with one get_pending_views() call for all of them
+    (otherwise Topic.get_total_views asks Redis for each topic)."""
+    topics = list(topics)
+    pending = get_pending_views({topic.id for topic in topics})
+    for topic in topics:
+        topic.pending_views = pending.get(topic.id, 0)
+
+
+def apply_topic_views(views):
+    """Add the views ({topic_id: views}) to the topics and to all their parent subforums, in bulk. Returns the number of updated topics."""
+    from .models import Topic, TopicClosure
+
+    # Spread the views to the topics and all their parents, in one query (see forum/topic_tree.py)
+    views = {topic_id: count for topic_id, count in views.items() if count}
+    totals = Counter()
+    for ancestor_id, descendant_id in TopicClosure.objects.filter(descendant_id__in=views.keys()).values_list('ancestor_id', 'descendant_id'):
+        totals[ancestor_id] += views[descendant_id]
+
+    # One UPDATE per distinct number of views (most topics get a few views between two flushes)
+    topic_ids_by_count = {}
+    for topic_id, count in totals.items():
+        topic_ids_by_count.setdefault(count, []).append(topic_id)
+    with transaction.atomic():
+        for count, topic_ids in topic_ids_by_count.items():
+            Topic.objects.filter(id__in=topic_ids).update(total_views=F('total_views') + count)
+    return len(totals)
+
+def flush_local_topic_views():
+    """Write the views buffered in this process to the database."""
+    global _local_last_flush
+    with _local_lock:
+        views = dict(_local_pending)
+        _local_pending.clear()
+        _local_last_flush = time.monotonic()
+    if not views:
+        return 0
+    try:
+        return apply_topic_views(views)
+    except Exception:
+        # Put them back for the next flush
+        with _local_lock:
+            _local_pending.update(views)
+        raise
+
+def flush_topic_views():
+    """Write all the buffered views (Redis and this process) to the database. Returns the number of updated topics."""
+    updated = flush_local_topic_views()
+
+    client = _get_redis()
+    if client is None:
+        return updated
+    try:
+        # The pending views are moved aside, so that the new views don't wait for (or get lost in) this flush.
+        # If a flush failed, its views are still there and are written first.
+        if not client.exists(FLUSHING_KEY):
+            if not client.exists(PENDING_KEY):
+                return updated
+            client.rename(PENDING_KEY, FLUSHING_KEY)
+        views = {int(topic_id): int(count) for topic_id, count in client.hgetall(FLUSHING_KEY).items()}
+    except Exception as e:
+        _redis_failed(e)
+        return updated
+
+    updated += apply_topic_views(views)
+    client.delete(FLUSHING_KEY)
+    return updated
@@ -10,7 +10,7 @@ from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils import timezone
 from django.db import models
-from django.db.models import Case, When, Value, BooleanField, Q, Count, F, OuterRef, Subquery
+from django.db.models import Case, When, Value, BooleanField, Q, Count, F, OuterRef, Subquery, Exists
 from django.db.models.functions import Lower
 from django.urls import reverse
 from urllib.parse import urlencode
@@ -21,18 +21,26 @@ from precise_bbcode.models import SmileyTag
 from .views_context_processors import get_theme_context
 from utf.settings import THEME_LIST, DEFAULT_THEME
 from .tasks import async_log, safe_async_log
+from .view_counter import record_topic_view, get_viewer_key, set_pending_views
+from .read_state import mark_read, get_unread_flags, touch_user_read_state
+from .board_stats import get_board_stats
+from .notification_hub import get_hub, format_event, event_id_key
+from .page_cache import cache_anonymous_page, topic_tag, category_tag, INDEX_TAG, ANNOUNCEMENTS_TAG
+from .search import get_search_backend
 from utf.utils import cprint
 import os
 import requests
 import asyncio
 import json
-import redis.asyncio as redis
+import random
 from django.contrib.auth.decorators import login_required
 from asgiref.sync import sync_to_async
 
 # Load environment variables
 RESTRICT_NEW_USERS = os.getenv('RESTRICT_NEW_USERS', 'False') == 'True'
 POST_WEBHOOK_URL = os.getenv('POST_WEBHOOK_URL', '')
+SSE_HEARTBEAT_INTERVAL = 15 # seconds
+SSE_RETRY_RANGE = (2000, 10000) # milliseconds before the browser reconnects
 
 # Functions used by views
 
@@ -60,61 +68,19 @@ def generate_pagination(current_page, max_page):
     
     return pagination
 
-def check_subforum_unread(subforum, user, depth=0, max_depth=10, read_status_cache=None):
+def check_subforum_unread(subforum, user):
     """
-    Check if any child topic in a subforum is unread by the user.
+    Check if any topic under a subforum (at any depth) is unread by the user.
     
     Args:
         subforum: The subforum to check
         user: The current user
-        depth: Current recursion depth (to prevent infinite loops)
-        max_depth: Maximum recursion depth to prevent stack overflow
-        read_status_cache: Optional dict of {topic_id: last_read} to avoid repeated queries
     
     Returns:
         Boolean indicating if the subforum contains any unread content
     """
-    # Safety check to prevent infinite recursion
-    if depth > max_depth:
-        return False
-        
-    if not user.is_authenticated:
-        return False
-    
-    # Get all direct child topics of this subforum
-    child_topics = subforum.children.all()
-    
-    if not child_topics.exists():
-        return False
-    
-    # Use cache if provided, otherwise fetch from DB
-    if read_status_cache is not None:
-        read_status_map = read_status_cache
-    else:
-        # Get read statuses for these topics in bulk
-        read_statuses = TopicReadStatus.objects.filter(
-            user=user,
-            topic__in=child_topics
-        ).values('topic_id', 'last_read')
-        
-        # Build a lookup dictionary {topic_id: last_read_time}
-        read_status_map = {rs['topic_id']: rs['last_read'] for rs in read_statuses}
-    
-    # Check each child topic
-    for topic in child_topics:
-        # If the topic is a subforum, check it recursively
-        if getattr(topic, 'is_sub_forum', False):
-            if check_subforum_unread(topic, user, depth + 1, max_depth, None):
-                return True
-        else:
-            # For regular topics, check its read status
-            last_read = read_status_map.get(topic.id)
-            if not last_read:  # Never read
-                return True
-            if topic.last_message_time > last_read:
-                return True
-    
-    return False
+    # For several subforums, use get_unread_flags directly (one query for all of them)
+    return get_unread_flags(user, [subforum.id])[subforum.id]
 
 def get_percentage(small, big):
     try:
@@ -149,10 +115,9 @@ def get_message_frequency(message_count, date_joined, date_now=None):
 def get_post_page_in_topic(post_id, topic_id, posts_per_page=15):
     try:
         post = Post.objects.get(id=post_id, topic_id=topic_id)
-        topic = post.topic
-        relative_position = topic.public_replies.filter(created_time__lte=post.created_time).count()
+        relative_position = post.get_relative_id # stored on the post (see Post.position)
         safe_async_log(f"Relative position: {relative_position}", 'debug', 'get_post_page_in_topic')
-        page_number = max((relative_position // (posts_per_page+1)) + 1, 1)
+        page_number = max(((relative_position - 1) // posts_per_page) + 1, 1)
         return page_number
     except Post.DoesNotExist:
         return None
@@ -162,20 +127,11 @@ def mark_all_topics_read_for_user(user):
     if not user.is_authenticated:
         return
 
-    # Get all topics in the forum
-    all_topics = Topic.objects.all()
+    # One watermark for the whole forum instead of one row per topic (see forum/read_state.py)
+    mark_read(user)
 
-    # Iterate through each topic and mark it as read for the user
-    for topic in all_topics:
-        TopicReadStatus.objects.update_or_create(
-            user=user,
-            topic=topic,
-            defaults={'last_read': timezone.now()}
-        )
-
-# TODO: [2] Make the filter recursive for nested subforums
 def mark_as_read_with_filter(user, filter_dict):
-    """Mark all topics as read for the user."""
+    """Mark all topics of a subforum (at any depth) or of a category as read for the user."""
     if not user.is_authenticated:
         return
     
@@ -197,27 +153,24 @@ def mark_as_read_with_filter(user, filter_dict):
         else:
             category = int(category)
 
-    # Get topics according to the filter
+    # Get the subforum or category according to the filter
     if subforum != -1:
-        topics = Topic.objects.filter(parent=subforum)
+        subforum = Topic.objects.filter(id=subforum, is_sub_forum=True).first()
+        if subforum is None or not subforum.descendants().exists(): # For error handling, if no topics are found
+            return False
+        mark_read(user, subforum=subforum)
+        safe_async_log(f"Marked subforum {subforum.id} as read for user {user.username}", 'info', 'mark_as_read_with_filter')
 
     elif category != -1:
-        topics = Topic.objects.filter(category=category)
+        category = Category.objects.filter(id=category).first()
+        if category is None or not Topic.objects.filter(category=category).exists(): # For error handling, if no topics are found
+            return False
+        mark_read(user, category=category)
+        safe_async_log(f"Marked category {category.id} as read for user {user.username}", 'info', 'mark_as_read_with_filter')
 
     else: # If no filter is provided, return False (for error handling)
         return False
 
-    if topics.count() == 0: # For error handling, if no topics are found
-        return False
-    # Iterate through each topic and mark it as read for the user
-    for topic in topics:
-        TopicReadStatus.objects.update_or_create(
-            user=user,
-            topic=topic,
-            defaults={'last_read': timezone.now()}
-        )
-        safe_async_log(f"Marked topic {topic.id} as read for user {user.username}", 'info', 'mark_as_read_with_filter')
-    
     # Return True if topics were marked as read
     return True
 
@@ -233,6 +186,38 @@ def user_can_vote(user, poll):
     # Check if the user has voted in the poll
     return not poll.options.filter(voters=user).exists()
 
+def set_poll_percentages(poll_options, total_poll_votes):
+    """Add the percentage and the bar length of each option of a poll (annotated with vote_count)."""
+    for option in poll_options:
+        if total_poll_votes > 0:
+            percentage = int((option.vote_count / total_poll_votes) * 100)
+        else:
+            percentage = 0
+        option.percentage = percentage
+        if percentage > 0:
+            option.bar_length = int(2 * percentage + (0.05 * 2 * percentage))
+        else:
+            option.bar_length = 0
+
+def can_render_quick_reply(user, topic):
+    """Check if the quick reply form is shown to the user under a topic."""
+    if user.is_authenticated == False or (topic.is_locked and not user.profile.is_user_staff):
+        return False
+    if RESTRICT_NEW_USERS:
+        try:
+            user_profile = Profile.objects.get(user=user)
+            user_groups = user_profile.groups.all()
+            # Check if the user has no group
+            if user_groups.count() == 0:
+                return False
+            # Check if the user is "Outsider" as top group
+            top_group = user_profile.get_top_group
+            if top_group.name == "Outsider":
+                return False
+        except Profile.DoesNotExist:
+            return False
+    return True
+
 def theme_render(request, template_name, context=None, content_type=None, status=None, using=None):
     if not THEME_LIST:
         raise ValueError("THEME_LIST is empty. Please define at least one theme in settings.py.")
@@ -278,6 +263,7 @@ def index_redirect(request):
 @ratelimit(key='user_or_ip', method=['GET'], rate='200/h')
 
 @ratelimit(key='user_or_ip', method=['POST'], rate='3/5m')
+@cache_anonymous_page('index', lambda: [INDEX_TAG]) # (see forum/page_cache.py)
 def index(request):
     if request.method == "POST":
         form = AuthenticationForm(data=request.POST)
@@ -290,94 +276,23 @@ def index(request):
             return redirect('index')
     else:
         form = AuthenticationForm()
-    utf, created = Forum.objects.get_or_create(name='UTF')
-    if created:
-        safe_async_log("Forum UTF created", 'info', 'index')
-        utf.save()
 
     categories = Category.objects.filter(is_hidden=False)
     timezone_now = timezone.now()
     
-    global_read_status_map = {}
-    if request.user.is_authenticated:
-        # Collect all topic IDs across all categories first
-        all_topic_ids = []
-        for category in categories:
-            topics_list = list(category.index_topics.select_related('latest_message').prefetch_related('children').all().order_by('id'))
-            all_topic_ids.extend([topic.id for topic in topics_list])
-        
-        # Single bulk query for all read statuses across all categories
-        if all_topic_ids:
-            read_statuses = TopicReadStatus.objects.filter(
-                user=request.user,
-                topic_id__in=all_topic_ids
-            ).values('topic_id', 'last_read')
-            global_read_status_map = {rs['topic_id']: rs['last_read'] for rs in read_statuses}
-    
     # Process topics for each category
     for category in categories:
         # Get topics but don't use the queryset directly
-        topics_list = list(category.index_topics.select_related('latest_message').prefetch_related('children').all().order_by('id')) # order by id for some reason idk
-        
-        # If user is authenticated, check read status for all topics
-        if request.user.is_authenticated:
-            # Use the pre-fetched global read status map
-            # Attach is_unread to each topic object
-            for topic in topics_list:
-                if getattr(topic, 'is_sub_forum', False):
-                    # For subforums, check if any child is unread
-                    # Pass in the topic as the subforum to check
-                    topic.is_unread = check_subforum_unread(topic, request.user)
-                else:
-                    # For regular topics, check its own read status
-                    last_read = global_read_status_map.get(topic.id)
-                    if not last_read:
-                        topic.is_unread = True  # Never read
-                    else:
-                        topic.is_unread = topic.last_message_time > last_read
-        else:
-            # If user is not authenticated, mark all topics as read
-            for topic in topics_list:
-                topic.is_unread = False
-        
-        # Store the processed list directly on the category
-        category.processed_topics = topics_list
+        category.processed_topics = list(category.index_topics.select_related('latest_message').prefetch_related('children').all().order_by('id')) # order by id for some reason idk
 
-    online = User.objects.filter(profile__isnull=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30), profile__is_hidden=False).order_by('username')
+    # Unread flags of all topics and subforums of the page at once (always read for anonymous users, see forum/read_state.py)
+    unread_flags = get_unread_flags(request.user, [topic.id for category in categories for topic in category.processed_topics])
+    for category in categories:
+        for topic in category.processed_topics:
+            topic.is_unread = unread_flags.get(topic.id, False)
 
-    groups = ForumGroup.objects.all()
-
-    try:
-        presentations = Topic.objects.filter(is_sub_forum=True, title="Présentations").first()
-    except Topic.DoesNotExist:
-        presentations = None
-    try:
-        regles = Topic.objects.filter(is_sub_forum=False, is_announcement=True).first()
-    except Topic.DoesNotExist:
-        regles = None
-
-    today = timezone_now.date()
-    next_week = today + timezone.timedelta(days=7)
-
-    birthdays_today = User.objects.filter(
-        profile__birthdate__day=today.day,
-        profile__birthdate__month=today.month,
-        profile__is_hidden=False,
-    ).select_related('profile').order_by('username')
-
-    if today.month == next_week.month:
-        birthdays_in_week = User.objects.filter(
-            profile__birthdate__month=today.month,
-            profile__birthdate__day__gte=today.day,
-            profile__birthdate__day__lte=next_week.day,
-            profile__is_hidden=False,
-        ).select_related('profile').order_by('username')
-    else:
-        birthdays_in_week = User.objects.filter(
-            Q(profile__birthdate__month=today.month, profile__birthdate__day__gte=today.day) |
-            Q(profile__birthdate__month=next_week.month, profile__birthdate__day__lte=next_week.day),
-            profile__is_hidden=False,
-        ).select_related('profile').order_by('username')
+    # Forum counters, who is online, birthdays... (a shared snapshot, see forum/board_stats.py)
+    stats = get_board_stats()
 
     # Quick access
     recent_posts = Post.objects.select_related('author', 'topic').filter(topic__is_sub_forum=False, author__profile__is_hidden=False).order_by('-created_time')[:6]
@@ -388,14 +303,15 @@ def index(request):
 
     context = {
         "categories": categories,
-        "utf":utf,
-        "online":online,
+        "utf": stats['utf'],
+        "online": stats['online'],
         "form": form,
-        "groups":groups,
-        "presentations":presentations,
-        "regles":regles,
-        "birthdays_today":birthdays_today,
-        "birthdays_in_week":birthdays_in_week,
+        "groups": stats['groups'],
+        "presentations": stats['presentations'],
+        "regles": stats['regles'],
+        "birthdays_today": stats['birthdays_today'],
+        "birthdays_in_week": stats['birthdays_in_week'],
+        "latest_user": stats['latest_user'],
         "recent_posts": recent_posts,
         "recent_topic_with_poll": recent_topic_with_poll,
         "timezone_now": timezone_now,
@@ -569,6 +485,7 @@ def member_list(request):
     return theme_render(request, "memberlist.html", context)
 
 @ratelimit(key='user_or_ip', method=['GET'], rate='50/5s')
+@cache_anonymous_page('subforum_details', lambda subforumid, subforumslug: [topic_tag(subforumid), ANNOUNCEMENTS_TAG])
 def subforum_details(request, subforumid, subforumslug):
     try:
         subforum = Topic.objects.select_related('category').get(id=subforumid)
@@ -608,50 +525,12 @@ def subforum_details(request, subforumid, subforumslug):
 
     tree = subforum.get_tree
 
-    if request.user.is_authenticated:
-        # Combine all topic lists for a single bulk query
-        all_topics_combined = list(topics) + list(announcement_topics) + list(all_subforums)
-        
-        read_statuses = TopicReadStatus.objects.filter(
-            user=request.user,
-            topic__in=all_topics_combined
-        )
-        read_status_map = {rs.topic_id: rs.last_read for rs in read_statuses}
-        
-        # Apply read status to regular topics
-        for topic in topics:
-            if topic.is_sub_forum:
-                topic.is_unread = check_subforum_unread(topic, request.user)
-            else:
-                # Set user_last_read to a very old date if None (never read) to make template comparison work
-                last_read_value = read_status_map.get(topic.id, None)
-                topic.user_last_read = last_read_value if last_read_value else datetime.min.replace(tzinfo=dt_timezone.utc)
-        
-        # Apply read status to announcements
-        for announcement in announcement_topics:
-            if announcement.is_sub_forum:
-                announcement.is_unread = check_subforum_unread(announcement, request.user)
-            else:
-                # Set user_last_read to a very old date if None (never read) to make template comparison work
-                last_read_value = read_status_map.get(announcement.id, None)
-                announcement.user_last_read = last_read_value if last_read_value else datetime.min.replace(tzinfo=dt_timezone.utc)
-        
-        # Apply read status to subforums
-        for child_subforum in all_subforums:
-            child_subforum.is_unread = check_subforum_unread(child_subforum, request.user)
-    else:
-        for topic in topics:
-            if topic.is_sub_forum:
-                topic.is_unread = False
-            else:
-                topic.user_last_read = datetime.max.replace(tzinfo=dt_timezone.utc)
-        for announcement in announcement_topics:
-            if announcement.is_sub_forum:
-                announcement.is_unread = False
-            else:
-                announcement.user_last_read = datetime.max.replace(tzinfo=dt_timezone.utc)
-        for child_subforum in all_subforums:
-            child_subforum.is_unread = False
+    # Unread flags of all topics and subforums of the page at once (always read for anonymous users, see forum/read_state.py)
+    all_topics_combined = list(topics) + list(announcement_topics) + list(all_subforums)
+    unread_flags = get_unread_flags(request.user, [topic.id for topic in all_topics_combined])
+    for topic in all_topics_combined:
+        topic.is_unread = unread_flags.get(topic.id, False)
+    set_pending_views(all_topics_combined) # (the views of all the topics of the page at once)
 
     # Pass topic watch status to template
     if request.user.is_authenticated:
@@ -739,7 +618,7 @@ def new_topic(request):
 
                 send_webhook({"content": f"New topic successfully created: {new_topic_instance.title}"}, POST_WEBHOOK_URL)
 
-                return redirect(topic_details, new_topic_instance.id, new_topic_instance.slug)
+                return redirect('topic-details', new_topic_instance.id, new_topic_instance.slug)
             else:
                 send_webhook({"content": "New topic creation failed"}, POST_WEBHOOK_URL)
 
@@ -790,7 +669,7 @@ def new_topic(request):
             if form.is_valid():
                 new_topic = form.save()
                 send_webhook({"content": f"New topic successfully created: {new_topic.title}"}, POST_WEBHOOK_URL)
-                return redirect(topic_details, new_topic.id, new_topic.slug)
+                return redirect('topic-details', new_topic.id, new_topic.slug)
             else:
                 send_webhook({"content": "New topic creation failed"}, POST_WEBHOOK_URL)
         else:
@@ -812,6 +691,7 @@ def new_topic(request):
 
 @ratelimit(key='user_or_ip', method=['POST'], rate='8/m')
 @ratelimit(key='user_or_ip', method=['POST'], rate='200/d')
+@cache_anonymous_page('topic_details', lambda topicid, topicslug: [topic_tag(topicid)])
 def topic_details(request, topicid, topicslug):
     safe_async_log(f"Entered topic_details view for topicid={topicid}, topicslug={topicslug}, method={request.method}", 'debug', 'topic_details')
     try:
@@ -819,24 +699,12 @@ def topic_details(request, topicid, topicslug):
         safe_async_log(f"Topic found: {topic}", 'debug', 'topic_details')
         if request.user.is_authenticated:
             safe_async_log(f"User is authenticated: {request.user}", 'debug', 'topic_details')
-            read_status, createdBool = TopicReadStatus.objects.get_or_create(user=request.user, topic=topic) # Get the read status for the topic, before updating
-            safe_async_log(f"TopicReadStatus: {read_status}, created: {createdBool}", 'debug', 'topic_details')
-            if createdBool == False: # If the read status already exists, check if it has been 3 minutes since the last read
-                if read_status.last_read + timezone.timedelta(minutes=3) < timezone.now():
-                    current = topic
-                    while current != None: # Check if the topic is a subforum, and if so, get the parent topic
-                        current.total_views += 1 # Increment the topic views
-                        current.save(update_fields=["total_views"])
-                        safe_async_log(f"Incremented total_views for topic {current.id}, now {current.total_views}", 'debug', 'topic_details')
-                        current = current.parent # Go to the parent topic
-            else: # Else, always increment the topic views
-                current = topic
-                while current != None: # Check if the topic is a subforum, and if so, get the parent topic
-                    current.total_views += 1 # Increment the topic views
-                    current.save(update_fields=["total_views"])
-                    safe_async_log(f"Incremented total_views for topic {current.id}, now {current.total_views}", 'debug', 'topic_details')
-                    current = current.parent # Go to the parent topic
+            # The views are buffered and written to the topic and its parents in bulk (see forum/view_counter.py),
+            # the same user is only counted once every 3 minutes
+            if record_topic_view(topic.id, get_viewer_key(request)):
+                safe_async_log(f"Counted a view for topic {topic.id}", 'debug', 'topic_details')
             TopicReadStatus.objects.update_or_create( user=request.user, topic=topic, defaults={'last_read': timezone.now()})  # Mark the topic as read for the user
+            touch_user_read_state(request.user.id) # (drop the cached unread flags, see forum/read_state.py)
     except Topic.DoesNotExist as e:
         safe_async_log(f"Topic.DoesNotExist: {e}", 'error', 'topic_details')
         return error_page(request, "Erreur", "Ce sujet n'existe pas.", status=404)
@@ -896,18 +764,8 @@ def topic_details(request, topicid, topicslug):
             vote_count=Count('voters')
         ).order_by('id')
         # Add percentage and bar length to each option object
-        for option in poll_options:
-            option.vote_count = option.vote_count  # The annotated value
-            if total_poll_votes > 0:
-                percentage = int((option.vote_count / total_poll_votes) * 100)
-            else:
-                percentage = 0
-            option.percentage = percentage
-            if percentage > 0:
-                option.bar_length = int(2 * percentage + (0.05 * 2 * percentage))
-            else:
-                option.bar_length = 0
-                
+        set_poll_percentages(poll_options, total_poll_votes)
+
         # Check if the user has already voted in the poll
         if request.user.is_authenticated:
             user = request.user
@@ -1033,24 +891,7 @@ def topic_details(request, topicid, topicslug):
         user_can_vote_bool = user_can_vote(request.user, topic.poll)
         safe_async_log(f"[DEBUG] user_can_vote_bool: {user_can_vote_bool}", 'debug', 'view')
 
-    render_quick_reply = True
-
-    if request.user.is_authenticated == False or (topic.is_locked and not request.user.profile.is_user_staff):
-        render_quick_reply = False
-    elif RESTRICT_NEW_USERS:
-        try:
-            user_profile = Profile.objects.get(user=request.user)
-            user_groups = user_profile.groups.all()
-            # Check if the user has no group
-            if user_groups.count() == 0:
-                render_quick_reply = False
-            else:
-                # Check if the user is "Outsider" as top group
-                top_group = user_profile.get_top_group
-                if top_group.name == "Outsider":
-                    render_quick_reply = False
-        except Profile.DoesNotExist:
-            render_quick_reply = False
+    render_quick_reply = can_render_quick_reply(request.user, topic)
     # print(f"LAST MESSAGE TIME : {topic.last_message_time}")
 
     # Get the neighboring topics
@@ -1157,6 +998,7 @@ def new_post(request):
     return theme_render(request, 'new_post_form.html', context)
 
 @ratelimit(key='user_or_ip', method=['GET'], rate='20/5s')
+@cache_anonymous_page('category_details', lambda categoryid, categoryslug: [category_tag(categoryid), ANNOUNCEMENTS_TAG])
 def category_details(request, categoryid, categoryslug):
     try:
         category = Category.objects.get(id=categoryid)
@@ -1208,67 +1050,12 @@ def category_details(request, categoryid, categoryslug):
                 'author', 'author__profile', 'author__profile__top_group', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__author__profile__top_group', 'poll'
     ).all().order_by('-last_message_time')
 
-    # Add read status for authenticated users
-    if request.user.is_authenticated:
-        # Handle index_topics
-        read_statuses_index = TopicReadStatus.objects.filter(
-            user=request.user,
-            topic__in=index_topics
-        )
-        read_status_map_index = {rs.topic_id: rs.last_read for rs in read_statuses_index}
-        for topic in index_topics:
-            if topic.is_sub_forum:
-                topic.is_unread = check_subforum_unread(topic, request.user)
-            else:
-                # Set user_last_read to a very old date if None (never read) to make template comparison work
-                last_read_value = read_status_map_index.get(topic.id, None)
-                topic.user_last_read = last_read_value if last_read_value else datetime.min.replace(tzinfo=dt_timezone.utc)
-        
-        # Handle root_not_index_topics
-        read_statuses_root = TopicReadStatus.objects.filter(
-            user=request.user,
-            topic__in=root_not_index_topics
-        )
-        read_status_map_root = {rs.topic_id: rs.last_read for rs in read_statuses_root}
-        for topic in root_not_index_topics:
-            if topic.is_sub_forum:
-                topic.is_unread = check_subforum_unread(topic, request.user)
-            else:
-                # Set user_last_read to a very old date if None (never read) to make template comparison work
-                last_read_value = read_status_map_root.get(topic.id, None)
-                topic.user_last_read = last_read_value if last_read_value else datetime.min.replace(tzinfo=dt_timezone.utc)
-        
-        # Handle announcements
-        read_statuses_ann = TopicReadStatus.objects.filter(
-            user=request.user,
-            topic__in=announcements
-        )
-        read_status_map_ann = {rs.topic_id: rs.last_read for rs in read_statuses_ann}
-        for announcement in announcements:
-            if announcement.is_sub_forum:
-                announcement.is_unread = check_subforum_unread(announcement, request.user)
-            else:
-                # Set user_last_read to a very old date if None (never read) to make template comparison work
-                last_read_value = read_status_map_ann.get(announcement.id, None)
-                announcement.user_last_read = last_read_value if last_read_value else datetime.min.replace(tzinfo=dt_timezone.utc)
-    else:
-        # Mark all as read for non-authenticated users
-        # The template checks if user is authenticated first, so these values won't be used
-        for topic in index_topics:
-            if topic.is_sub_forum:
-                topic.is_unread = False
-            else:
-                topic.user_last_read = datetime.max.replace(tzinfo=dt_timezone.utc)
-        for topic in root_not_index_topics:
-            if topic.is_sub_forum:
-                topic.is_unread = False
-            else:
-                topic.user_last_read = datetime.max.replace(tzinfo=dt_timezone.utc)
-        for announcement in announcements:
-            if announcement.is_sub_forum:
-                announcement.is_unread = False
-            else:
-                announcement.user_last_read = datetime.max.replace(tzinfo=dt_timezone.utc)
+    # Unread flags of all topics and subforums of the page at once (always read for anonymous users, see forum/read_state.py)
+    all_topics_combined = list(index_topics) + list(root_not_index_topics) + list(announcements)
+    unread_flags = get_unread_flags(request.user, [topic.id for topic in all_topics_combined])
+    for topic in all_topics_combined:
+        topic.is_unread = unread_flags.get(topic.id, False)
+    set_pending_views(all_topics_combined) # (the views of all the topics of the page at once)
 
     # Pass category watch status to template
     if request.user.is_authenticated:
@@ -1421,32 +1208,17 @@ def search_results(request):
             order_by_field = 'author__username'
         elif sort_by == "forum":
             order_by_field = 'topic__parent__id'
+        elif sort_by == "relevance" and keyword:
+            order_by_field = '-search_rank' # (the best results first, whatever the order)
 
         # Adjust for ascending/descending order
 
-    if order == "DESC":
+    if order == "DESC" and order_by_field != '-search_rank':
         if order_by_field.startswith('-'):
             order_by_field = order_by_field[1:]
         else:
             order_by_field = '-' + order_by_field
 
-    if search_terms == "all":
-        if keyword:
-            if search_fields == "all":
-                custom_filter &= Q(text__icontains=keyword) | Q(topic__title__icontains=keyword)
-            elif search_fields == "msgonly":
-                custom_filter &= Q(text__icontains=keyword)
-    elif search_terms == "any":
-        if keyword:
-            keywords = keyword.split()
-            keyword_filter = Q()
-            for word in keywords:
-                if search_fields == "all":
-                    keyword_filter |= Q(text__icontains=word) | Q(topic__title__icontains=word)
-                elif search_fields == "msgonly":
-                    keyword_filter |= Q(text__icontains=word)
-            custom_filter &= keyword_filter
-
     if author:
         custom_filter &= Q(author__username__iexact=author)
 
@@ -1472,10 +1244,18 @@ def search_results(request):
     current_page = int(request.GET.get('page', 1))
     limit = current_page * messages_per_page
     safe_async_log(f"order by field : {order_by_field}", 'info', 'view')
-    all_results = Post.objects.select_related('topic', 'author', 'topic__parent', 'author__profile').filter(custom_filter).order_by(order_by_field)
+    # The keyword is searched by the full-text index of the database (see forum/search.py)
+    search_backend = get_search_backend()
+    all_results = search_backend.filter(Post.objects.filter(custom_filter), keyword, search_terms, search_fields)
+    order_by_fields = [order_by_field]
+    if order_by_field == '-search_rank':
+        all_results = search_backend.annotate_rank(all_results, keyword, search_terms, search_fields)
+        order_by_fields.append('-id')
+    all_results = all_results.select_related('topic', 'author', 'topic__parent', 'author__profile').order_by(*order_by_fields)
 
     if show_results == "topics":
         # Get distinct topic IDs from the posts
+        matching_posts = all_results
         topic_ids = all_results.values_list('topic', flat=True).distinct()
         
         # Get the actual Topic objects using those IDs
@@ -1484,12 +1264,21 @@ def search_results(request):
         # Adjust ordering for Topic objects
         # Remove the 'topic__' prefix since we're querying Topic directly now
         topic_order_field = order_by_field.replace('topic__', '')
+        if topic_order_field == '-search_rank':
+            # The rank of a topic is the rank of its best post
+            best_post = matching_posts.filter(topic=OuterRef('pk')).order_by('-search_rank').values('search_rank')[:1]
+            all_results = all_results.annotate(search_rank=Subquery(best_post))
         all_results = all_results.order_by(topic_order_field)
 
     result_count = all_results.count()
     if result_count == 0:
         return error_page(request, "Informations", "Aucun sujet ou message ne correspond à vos critères de recherche", status=404)
-    results = all_results[limit - messages_per_page : limit]
+    results = list(all_results[limit - messages_per_page : limit])
+    set_pending_views(results if show_results == "topics" else [message.topic for message in results])
+    if show_results != "topics" and keyword:
+        snippets = search_backend.get_snippets([message.id for message in results], keyword, search_terms, search_fields)
+        for message in results:
+            message.search_snippet = snippets.get(message.id)
 
     max_page = (result_count + messages_per_page - 1) // messages_per_page
     pagination = generate_pagination(current_page, max_page)
@@ -1939,77 +1728,42 @@ async def sse_post_event(request):
         return HttpResponseForbidden("Authentication required")
 
     user_id = user.id
-    channel_name = f"user_notifications_{user_id}"
+    last_event_id = request.headers.get('Last-Event-ID') # (sent by the browser when it reconnects)
 
     async def event_stream():
-        # Get Redis URL based on environment (same logic as signals.py)
-        DEVELOPMENT_MODE = os.getenv('DEVELOPMENT_MODE', 'False') == 'True'
-        if DEVELOPMENT_MODE:
-            redis_url = "redis://localhost:6379"
-        else:
-            redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-        
-        redis_client = None
-        pubsub = None
-        
+        # The notifications come from the Redis subscriber shared by all the streams of this process (see forum/notification_hub.py)
+        hub = get_hub()
+        queue = hub.connect(user_id) # (before the replay, so nothing is missed in between)
+        cprint(f"User {user_id} connected to the notifications ({hub.get_stats()['streams']} stream(s) in this process)")
         try:
-            redis_client = redis.from_url(redis_url, socket_timeout=5, socket_connect_timeout=5)
-            pubsub = redis_client.pubsub()
-            await pubsub.subscribe(channel_name)
-            cprint(f"User {user_id} subscribed to {channel_name} (Redis: {redis_url.split('@')[-1] if '@' in redis_url else redis_url})")
-            
+            # Spread the reconnections of the browsers (after a deploy for example)
+            yield f"retry: {random.randint(*SSE_RETRY_RANGE)}\n\n"
             # Send initial connection message
             yield ": connected\n\n"
-            
-            last_heartbeat = asyncio.get_event_loop().time()
-            heartbeat_interval = 15  # Send heartbeat every 15 seconds
-            
-            # Create a task for listening to messages
-            listen_task = asyncio.create_task(pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0))
-            
+
+            # The notifications missed since the last one received by the browser
+            last_sent = None
+            try:
+                for event_id, event_data in await hub.read_missed(user_id, last_event_id):
+                    yield format_event(event_id, event_data)
+                    last_sent = event_id
+            except Exception as e:
+                cprint(f"Could not replay the notifications of user {user_id}: {e}")
+
             while True:
-                current_time = asyncio.get_event_loop().time()
-                
-                # Check if we need to send a heartbeat
-                if current_time - last_heartbeat >= heartbeat_interval:
-                    yield ": heartbeat\n\n"
-                    last_heartbeat = current_time
-                
-                # Check for messages with timeout
                 try:
-                    message = await asyncio.wait_for(listen_task, timeout=0.5)
-                    
-                    if message and message["type"] == "message":
-                        event_data = message["data"].decode('utf-8')
-                        yield f"data: {event_data}\n\n"
-                        last_heartbeat = current_time
-                    
-                    # Create new task for next message
-                    listen_task = asyncio.create_task(pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0))
-                    
+                    event_id, event_data = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_INTERVAL)
                 except asyncio.TimeoutError:
-                    # No message received, create new task and continue
-                    listen_task = asyncio.create_task(pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0))
-                    await asyncio.sleep(0.1)
-                
+                    yield ": heartbeat\n\n"
+                    continue
+                if event_id is not None and last_sent is not None and event_id_key(event_id) <= event_id_key(last_sent):
+                    continue # (already replayed)
+                yield format_event(event_id, event_data)
         except asyncio.CancelledError:
             cprint(f"Client for user {user_id} disconnected (cancelled).")
             raise
-        except Exception as e:
-            cprint(f"Error in SSE stream for user {user_id}: {e}")
-            yield f"event: error\ndata: Connection error\n\n"
         finally:
-            cprint(f"Cleaning up connection for user {user_id}")
-            if pubsub:
-                try:
-                    await pubsub.unsubscribe(channel_name)
-                except Exception as e:
-                    cprint(f"Error unsubscribing: {e}")
-            if redis_client:
-                try:
-                    await redis_client.close()
-                except Exception as e:
-                    cprint(f"Error closing redis: {e}")
+            hub.disconnect(user_id, queue)
 
     response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
     response['Cache-Control'] = 'no-cache'
@@ -0,0 +1,334 @@
+# forum/views_async.py
+
+import asyncio
+import inspect
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.forms import AuthenticationForm
+from django.db.models import Case, When, Value, BooleanField, Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django_ratelimit import ALL
+from django_ratelimit.core import is_ratelimited
+from django_ratelimit.exceptions import Ratelimited
+from . import views
+from .forms import QuickReplyForm, RecentTopicsForm, RecentPostsForm, PollVoteFormUnique, PollVoteFormMultiple
+from .models import Category, Forum, Post, Topic, TopicReadStatus, SmileyCategory
+from .board_stats import get_board_stats
+from .read_state import get_unread_flags, touch_user_read_state
+from .view_counter import record_topic_view, get_viewer_key, set_pending_views
+from .page_cache import cache_anonymous_page, topic_tag, category_tag, INDEX_TAG, ANNOUNCEMENTS_TAG
+from .tasks import safe_async_log
+
+# Under ASGI (Daphne), Django runs the sync views in a thread with sync_to_async. The read paths of the hottest pages
+# (index, category, subforum and topic) are async views here: the queries are made with the async ORM, and the ones
+# that don't depend on each other are started together with asyncio.gather (the queries still run in the thread of the
+# request with Django 5.1, but the request doesn't hold it while it waits for the cache, Redis or the other queries).
+# The templates are rendered in the thread, with the loaded querysets (their results are cached in them).
+# The POST requests (login, quick reply, poll votes, filters) are handled by the sync views, without their decorators.
+# forum/urls.py uses these views when ASYNC_VIEWS is set (by entrypoint.sh for daphne, not for a WSGI server), and
+# "python manage.py benchmark_concurrency" compares the throughput of both.
+
+
+def aratelimit(group=None, key=None, rate=None, method=ALL, block=True):
+    """The ratelimit decorator of django_ratelimit, for the async views (the counters are updated in the thread)."""
+    def decorator(fn):
+        @wraps(fn)
+        async def _wrapped(request, *args, **kw):
+            if method is not ALL and request.method not in method:
+                # (not counted, no need to go to the thread)
+                return await fn(request, *args, **kw)
+            await load_user(request)
+            old_limited = getattr(request, 'limited', False)
+            ratelimited = await sync_to_async(is_ratelimited)(request=request, group=group, fn=fn, key=key, rate=rate, method=method, increment=True)
+            request.limited = ratelimited or old_limited
+            if ratelimited and block:
+                cls = getattr(settings, 'RATELIMIT_EXCEPTION_CLASS', Ratelimited)
+                raise (import_string(cls) if isinstance(cls, str) else cls)()
+            return await fn(request, *args, **kw)
+        return _wrapped
+    return decorator
+
+def sync_fallback(sync_view):
+    """The sync view without its decorators (ratelimit and page cache, already applied to the async view), for the
+    requests that are not read only."""
+    return sync_to_async(inspect.unwrap(sync_view))
+
+async def load_user(request):
+    """Load the user of the request with the async API, and set it as request.user so that the code running in the
+    thread (templates, context processors) doesn't load it again."""
+    user = await request.auser()
+    request.user = user
+    return user
+
+async def fetch(queryset):
+    """Load the results of a queryset with the async ORM. They are cached in the queryset, so the template can still
+    use it (iterate, count...) without new queries."""
+    async for _ in queryset:
+        pass
+    return queryset
+
+async def render(request, template_name, context=None, status=None):
+    return await sync_to_async(views.theme_render)(request, template_name, context, status=status)
+
+async def error_page(request, error_title, error_message, status=500):
+    return await sync_to_async(views.error_page)(request, error_title, error_message, status=status)
+
+async def set_unread_flags(user, topics):
+    """Set topic.is_unread for each topic and subforum (see forum/read_state.py)."""
+    unread_flags = await sync_to_async(get_unread_flags)(user, [topic.id for topic in topics])
+    for topic in topics:
+        topic.is_unread = unread_flags.get(topic.id, False)
+
+async def set_topic_flags(user, topics):
+    """Set topic.is_unread and topic.pending_views for each topic of a listing page."""
+    await asyncio.gather(set_unread_flags(user, topics), sync_to_async(set_pending_views)(topics))
+
+
+@aratelimit(key='user_or_ip', method=['GET'], rate='5/10s')
+@aratelimit(key='user_or_ip', method=['GET'], rate='200/h')
+@aratelimit(key='user_or_ip', method=['POST'], rate='3/5m')
+@cache_anonymous_page('index', lambda: [INDEX_TAG]) # (see forum/page_cache.py)
+async def index(request):
+    if request.method not in ('GET', 'HEAD'):
+        return await sync_fallback(views.index)(request)
+    user = await load_user(request)
+
+    categories = await fetch(Category.objects.filter(is_hidden=False))
+    recent_posts = Post.objects.select_related('author', 'topic').filter(topic__is_sub_forum=False, author__profile__is_hidden=False).order_by('-created_time')[:6]
+    category_topics, stats, _, recent_topic_with_poll = await asyncio.gather(
+        asyncio.gather(*[
+            fetch(category.index_topics.select_related('latest_message').prefetch_related('children').all().order_by('id'))
+            for category in categories
+        ]),
+        sync_to_async(get_board_stats)(), # (see forum/board_stats.py)
+        fetch(recent_posts),
+        Topic.objects.filter(poll__isnull=False).order_by('-created_time').afirst(),
+    )
+    for category, topics in zip(categories, category_topics):
+        category.processed_topics = list(topics)
+    await set_unread_flags(user, [topic for category in categories for topic in category.processed_topics])
+
+    safe_async_log(f"Recent topic with poll: {recent_topic_with_poll}", 'debug', 'index')
+
+    context = {
+        "categories": categories,
+        "utf": stats['utf'],
+        "online": stats['online'],
+        "form": AuthenticationForm(),
+        "groups": stats['groups'],
+        "presentations": stats['presentations'],
+        "regles": stats['regles'],
+        "birthdays_today": stats['birthdays_today'],
+        "birthdays_in_week": stats['birthdays_in_week'],
+        "latest_user": stats['latest_user'],
+        "recent_posts": recent_posts,
+        "recent_topic_with_poll": recent_topic_with_poll,
+        "timezone_now": timezone.now(),
+    }
+    return await render(request, "index.html", context)
+
+
+@aratelimit(key='user_or_ip', method=['GET'], rate='50/5s')
+@cache_anonymous_page('subforum_details', lambda subforumid, subforumslug: [topic_tag(subforumid), ANNOUNCEMENTS_TAG])
+async def subforum_details(request, subforumid, subforumslug):
+    if request.method not in ('GET', 'HEAD'):
+        return await sync_fallback(views.subforum_details)(request, subforumid, subforumslug)
+    user = await load_user(request)
+    try:
+        subforum = await Topic.objects.select_related('category').aget(id=subforumid)
+    except Topic.DoesNotExist:
+        return await error_page(request, "Erreur", "Le sous-forum n'a pas été trouvé.", status=404)
+
+    form = RecentTopicsForm(request.GET or None)
+    days = int(request.GET.get('days', 0))
+    topics_per_page = min(int(request.GET.get('per_page', 50)),250)
+    current_page = int(request.GET.get('page', 1))
+    limit = current_page * topics_per_page
+    all_topics = subforum.children.select_related('author', 'author__profile', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__topic').filter(is_sub_forum=False)
+    all_subforums = Topic.objects.select_related('category', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__topic').filter(parent=subforum, is_sub_forum=True)
+    announcement_topics = Topic.objects.select_related('author', 'author__profile', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__topic', 'poll').filter(is_announcement=True)
+    topics = all_topics
+    if days > 0:
+        # Filter topics based on the number of days
+        date_threshold = timezone.now() - timezone.timedelta(days=days)
+        topics = topics.filter(last_message_time__gte=date_threshold)
+    topics = topics.order_by('-is_pinned', '-last_message_time')[limit - topics_per_page : limit]
+
+    count, _, _, _, tree, is_watched = await asyncio.gather(
+        all_topics.acount(),
+        fetch(topics),
+        fetch(all_subforums),
+        fetch(announcement_topics),
+        sync_to_async(lambda: subforum.get_tree)(),
+        Topic.objects.filter(id=subforumid, watchers=user).aexists() if user.is_authenticated else asyncio.sleep(0, False),
+    )
+    max_page = (count + topics_per_page - 1) // topics_per_page
+    await set_topic_flags(user, list(topics) + list(announcement_topics) + list(all_subforums))
+
+    context = {"announcement_topics":announcement_topics,
+                "topics":topics,
+                "subforum":subforum,
+                "tree":tree,
+                "all_subforums":all_subforums,
+                "form":form,
+                "pagination":views.generate_pagination(current_page, max_page),
+                "current_page":current_page,
+                "max_page":max_page,
+                "is_watched": is_watched}
+    return await render(request, 'subforum_details.html', context)
+
+
+@aratelimit(key='user_or_ip', method=['POST'], rate='8/m')
+@aratelimit(key='user_or_ip', method=['POST'], rate='200/d')
+@cache_anonymous_page('topic_details', lambda topicid, topicslug: [topic_tag(topicid)])
+async def topic_details(request, topicid, topicslug):
+    if request.method not in ('GET', 'HEAD'):
+        return await sync_fallback(views.topic_details)(request, topicid, topicslug)
+    user = await load_user(request)
+    try:
+        topic = await Topic.objects.select_related('poll', 'author', 'author__profile', 'parent').aget(id=topicid)
+    except Topic.DoesNotExist as e:
+        safe_async_log(f"Topic.DoesNotExist: {e}", 'error', 'topic_details')
+        return await error_page(request, "Erreur", "Ce sujet n'existe pas.", status=404)
+
+    if user.is_authenticated:
+        # The views are buffered and written to the topic and its parents in bulk (see forum/view_counter.py)
+        await sync_to_async(record_topic_view)(topic.id, get_viewer_key(request))
+        await TopicReadStatus.objects.aupdate_or_create(user=user, topic=topic, defaults={'last_read': timezone.now()})
+        await sync_to_async(touch_user_read_state)(user.id)
+
+    posts_per_page = min(int(request.GET.get('per_page', 15)),250)
+    current_page = int(request.GET.get('page', 1))
+    limit = current_page * posts_per_page
+    all_posts = Post.objects.select_related('author', 'author__profile', 'author__profile__top_group').filter(topic=topic, author__profile__is_hidden=False)
+    topic_posts = all_posts # (the pages are counted without the days filter, like in views.topic_details)
+    days = int(request.GET.get('days', 0))
+    order = request.GET.get('order', 'ASC')
+    if order == "DESC":
+        all_posts = all_posts.reverse()
+    if days > 0:
+        date_threshold = timezone.now() - timezone.timedelta(days=days)
+        all_posts = all_posts.filter(created_time__gte=date_threshold)
+    posts = all_posts.order_by('created_time')[limit - posts_per_page : limit]
+
+    # The neighboring topics
+    previous_topic = Topic.objects.filter(last_message_time__lt=topic.last_message_time, parent=topic.parent, is_sub_forum=False).order_by('-last_message_time').afirst()
+    next_topic = Topic.objects.filter(last_message_time__gt=topic.last_message_time, parent=topic.parent, is_sub_forum=False).order_by('last_message_time').afirst()
+    smiley_categories = SmileyCategory.objects.prefetch_related('smileys').order_by('id')
+    is_watched = Topic.objects.filter(id=topic.id, watchers=user).aexists() if user.is_authenticated else asyncio.sleep(0, False)
+
+    count, _, tree, previous_topic, next_topic, _, is_watched, render_quick_reply, poll_data = await asyncio.gather(
+        topic_posts.acount(),
+        fetch(posts),
+        sync_to_async(lambda: topic.get_tree)(),
+        previous_topic,
+        next_topic,
+        fetch(smiley_categories),
+        is_watched,
+        sync_to_async(views.can_render_quick_reply)(user, topic),
+        get_poll_data(topic, user),
+    )
+    max_page = (count + posts_per_page - 1) // posts_per_page
+    form, sort_form = await sync_to_async(lambda: (QuickReplyForm(user=user, topic=topic), RecentPostsForm(request.GET or None)))()
+
+    context = {"posts": posts,
+               "tree":tree,
+               "topic":topic,
+               "subforum":topic.parent,
+               "form":form,
+               "pagination":views.generate_pagination(current_page, max_page),
+               "current_page" : current_page,
+               "max_page":max_page,
+               "render_quick_reply":render_quick_reply,
+               "previous_topic":previous_topic,
+               "next_topic":next_topic,
+               "sort_form":sort_form,
+               "smiley_categories":smiley_categories,
+               "all_posts": all_posts,
+               "is_watched": is_watched,
+               **poll_data,
+               }
+    return await render(request, 'topic_details.html', context)
+
+async def get_poll_data(topic, user):
+    """The poll part of the context of topic_details (for a GET request)."""
+    if not hasattr(topic, 'poll'):
+        return {"has_poll": False, "poll_vote_form": None, "user_can_vote": False, "user_has_voted": 0, "poll_options": None}
+    poll = topic.poll
+    poll_options = poll.options.annotate(vote_count=Count('voters')).order_by('id')
+    total, _, user_has_voted, user_can_vote = await asyncio.gather(
+        poll.options.aaggregate(total=Count('voters')),
+        fetch(poll_options),
+        sync_to_async(poll.has_user_voted)(user),
+        sync_to_async(views.user_can_vote)(user, poll),
+    )
+    views.set_poll_percentages(poll_options, total['total'] or 0)
+    form_class = PollVoteFormUnique if poll.max_choices_per_user == 1 else PollVoteFormMultiple
+    return {
+        "has_poll": True,
+        "poll_vote_form": await sync_to_async(form_class)(poll_options=poll.options.all()),
+        "user_can_vote": user_can_vote,
+        "user_has_voted": 1 if user_has_voted else 0,
+        "poll_options": poll_options,
+    }
+
+
+@aratelimit(key='user_or_ip', method=['GET'], rate='20/5s')
+@cache_anonymous_page('category_details', lambda categoryid, categoryslug: [category_tag(categoryid), ANNOUNCEMENTS_TAG])
+async def category_details(request, categoryid, categoryslug):
+    if request.method not in ('GET', 'HEAD'):
+        return await sync_fallback(views.category_details)(request, categoryid, categoryslug)
+    user = await load_user(request)
+    try:
+        category = await Category.objects.aget(id=categoryid)
+    except Category.DoesNotExist:
+        return await error_page(request, "Erreur", "La catégorie n'a pas été trouvée.", status=404)
+
+    form = RecentTopicsForm(request.GET or None)
+    days = int(request.GET.get('days', 0))
+
+    utf, created = await Forum.objects.aget_or_create(name='UTF')
+    if created:
+        safe_async_log("Forum UTF created", 'info', 'view')
+
+    index_topics = category.index_topics.select_related(
+            'author', 'author__profile', 'author__profile__top_group', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__author__profile__top_group', 'poll',
+            'latest_message__topic'
+    ).all().order_by('id')
+    root_not_index_topics = Topic.objects.annotate(
+        is_root=Case(
+            When(parent__isnull=True, then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField()
+        )
+    ).select_related(
+            'author', 'author__profile', 'author__profile__top_group', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__author__profile__top_group', 'poll'
+    ).filter(is_root=True, category=category).exclude(id__in=index_topics.values_list('id', flat=True)).order_by('-is_pinned', '-last_message_time')
+    if days > 0:
+        date_threshold = timezone.now() - timezone.timedelta(days=days)
+        index_topics = index_topics.filter(last_message_time__gte=date_threshold)
+        root_not_index_topics = root_not_index_topics.filter(last_message_time__gte=date_threshold)
+    announcements = utf.announcement_topics.select_related(
+                'author', 'author__profile', 'author__profile__top_group', 'latest_message', 'latest_message__author', 'latest_message__author__profile', 'latest_message__author__profile__top_group', 'poll'
+    ).all().order_by('-last_message_time')
+
+    _, _, _, is_watched = await asyncio.gather(
+        fetch(index_topics),
+        fetch(root_not_index_topics),
+        fetch(announcements),
+        Category.objects.filter(id=category.id, watchers=user).aexists() if user.is_authenticated else asyncio.sleep(0, False),
+    )
+    await set_topic_flags(user, list(index_topics) + list(root_not_index_topics) + list(announcements))
+
+    context = {
+        "category": category,
+        "index_topics": index_topics,
+        "root_not_index_topics": root_not_index_topics,
+        "forum": utf,
+        "form": form,
+        "announcements": announcements,
+        "is_watched": is_watched,
+    }
+    return await render(request, "category_details.html", context)
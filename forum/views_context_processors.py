@@ -1,8 +1,12 @@
 from .models import *
 import random
 from django.utils import timezone
-from django.db.models import Count, Q
+from django.db.models import Count, Q, QuerySet
 from utf.utils import cprint
+from .presence import get_online_user_ids, is_user_online
+from .board_stats import get_sidebar_context
+from .post_blocks import render_post_blocks
+from .view_counter import set_pending_views
 
 # The header_size variable is used to determine the size of the header image in the base template.
 # It can be 'small' or 'big', depending on the context of the page being rendered.
@@ -11,10 +15,6 @@ from utf.utils import cprint
 # Context provider functions
 # Naming convention: <theme_name>__<template>__processor
 def modern__index__processor(request, base_context):
-    online_users_qs = base_context["online"]
-    
-    online_data = organize_online_users_by_groups(online_users_qs)
-
     filter_list = ['normal', 'popular', 'newposts']
     index_filter = request.GET.get('filter', 'normal')
     if index_filter not in filter_list:
@@ -26,17 +26,15 @@ def modern__index__processor(request, base_context):
     else:
         filtered_topics = None # This shouldn't display anyway
 
-    utf = Forum.objects.filter(name='UTF').first()
+    if filtered_topics is not None:
+        filtered_topics = list(filtered_topics)
+        set_pending_views(filtered_topics) # (the views of all the topics of the list at once)
 
     return {
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
+        **get_sidebar_context(), # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
         'header_size': 'big',
         'index_filter': index_filter,
         'filtered_topics': filtered_topics,
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
     }
 
 def modern__faq__processor(request, base_context):
@@ -50,18 +48,10 @@ def modern__register_regulation__processor(request, base_context):
     }
 
 def modern__memberlist__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
-    utf = Forum.objects.filter(name='UTF').first()
+    sidebar = get_sidebar_context()
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
     }
 
 def modern__profile_page__processor(request, base_context):
@@ -72,8 +62,8 @@ def modern__profile_page__processor(request, base_context):
     now = timezone.now()
     req_user = base_context.get('req_user')
 
-    if req_user and hasattr(req_user, 'profile') and req_user.profile and req_user.profile.last_login:
-        user_is_online = now - req_user.profile.last_login <= timezone.timedelta(minutes=30)
+    if req_user and hasattr(req_user, 'profile') and req_user.profile and not req_user.profile.is_hidden:
+        user_is_online = is_user_online(req_user.id)
     
     topics_created = Topic.objects.filter(author=req_user).filter(is_sub_forum=False).count()
 
@@ -109,18 +99,10 @@ def modern__new_topic_form__processor(request, base_context):
 
 
 def modern__subforum_details__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
-    utf = Forum.objects.filter(name='UTF').first()
+    sidebar = get_sidebar_context()
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
     }
 
 
@@ -138,8 +120,9 @@ def modern__search__processor(request, base_context):
 
 def modern__search_results__processor(request, base_context):
     results = base_context.get('results', [])
+    online_ids = get_online_user_ids()
     for result in results:
-        result.author_is_online = result.author.profile.last_login >= timezone.now() - timezone.timedelta(minutes=30)
+        result.author_is_online = result.author.id in online_ids
     return {
         'header_size': 'small',
         'results': results, # For avataronline / avataroffline display
@@ -170,32 +153,23 @@ def modern__new_pm_form_thread__processor(request, base_context):
     }
 
 def modern__category_details__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
-    utf = Forum.objects.filter(name='UTF').first()
+    sidebar = get_sidebar_context()
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
     }
 
 
 def modern__topic_details__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
-    utf = Forum.objects.filter(name='UTF').first()
+    sidebar = get_sidebar_context()
 
     posts = base_context.get('posts', [])
-    online_ids = [user.id for user in online]
+    online_ids = get_online_user_ids()
 
     for post in posts:
         if post.author.id in online_ids:
             post.user_is_online = True
+    posts = render_post_blocks(request, 'modern', posts) # The HTML of each post, cached (see forum/post_blocks.py)
 
     all_posts = base_context.get('all_posts', [])
     participants = User.objects.filter(
@@ -206,21 +180,14 @@ def modern__topic_details__processor(request, base_context):
 
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
         'posts': posts, # With user_is_online flag
         'participants': participants,
     }
 
 
 def modern__group_details__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
+    sidebar = get_sidebar_context()
     mods = base_context.get('mods', [])
     members = base_context.get('members', [])
 
@@ -233,17 +200,10 @@ def modern__group_details__processor(request, base_context):
             members.insert(0, mod) # Append at the top
     group_member_count = len(members)
 
-    utf = Forum.objects.filter(name='UTF').first()
     total_count = Profile.objects.all().count()  # Total number of profiles in the forum
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
         "members": members,
         "group_member_count": group_member_count,
         "total_count": total_count,
@@ -257,9 +217,7 @@ def modern__pm_inbox__processor(request, base_context):
 
 
 def modern__groups__processor(request, base_context):
-    online = User.objects.filter(profile__is_hidden=False, profile__last_login__gte=timezone.now() - timezone.timedelta(minutes=30)).order_by('username')
-    online_data = organize_online_users_by_groups(online)
-    utf = Forum.objects.filter(name='UTF').first()
+    sidebar = get_sidebar_context()
 
     all_groups = base_context.get('all_groups', [])
     for group in all_groups:
@@ -272,16 +230,10 @@ def modern__groups__processor(request, base_context):
         ))
         group.members_overview = members_list[:5]
 
-    member_count = utf.total_users
+    member_count = sidebar['utf'].total_users
     return {
         'header_size': 'small',
-        'recently_active_users': get_recently_active_users(12), # For _stats_header.html
-        'online': online,
-        'online_groups': online_data['groups'], # For _who_is_online.html
-        'online_users_by_group': online_data['users_by_group'],
-        'online_users_with_groups': online_data['structured_data'],
-        "utf": utf, # For _stats_header.html
-        "creation_year": utf.created_time.year if not utf else "2025", # For _stats_header.html
+        **sidebar, # For _stats_header.html and _who_is_online.html (see forum/board_stats.py)
         'all_groups': all_groups,
         'member_count': member_count,
     }
@@ -293,6 +245,13 @@ def modern__pm_details__processor(request, base_context):
     }
 
 
+def classic__topic_details__processor(request, base_context):
+    posts = render_post_blocks(request, 'classic', base_context.get('posts', [])) # The HTML of each post, cached (see forum/post_blocks.py)
+    return {
+        'posts': posts,
+    }
+
+
 def test__index__processor(request, base_context):
     """Testing hello world context processor for the test theme."""
     
@@ -330,6 +289,10 @@ THEME_CONTEXT_REGISTRY = {
         'pm_details.html': modern__pm_details__processor,
         # ... more views as needed
     },
+    'classic': {
+        'topic_details.html': classic__topic_details__processor,
+        # ... more views as needed
+    },
     'test': {
         'index.html': test__index__processor,
         # ... more views as needed
@@ -378,17 +341,27 @@ def organize_online_users_by_groups(online_users_qs):
     - 'users_by_group': Dictionary mapping groups to their users  
     - 'structured_data': List of dicts with group and users for templates
     """
-    # Get online users with their profile and group data
-    # TODO: [10] WARNING : Not all profiles have a top group set, so this might not work as expected. It should use get_top_group method instead.
-    online_users = online_users_qs.select_related('profile', 'profile__top_group').prefetch_related('profile__groups')
+    # Get online users with their profile and group data (a list is used as is, it should be prefetched the same way)
+    if isinstance(online_users_qs, QuerySet):
+        online_users = online_users_qs.select_related('profile', 'profile__top_group').prefetch_related('profile__groups')
+    else:
+        online_users = online_users_qs
     
     # Group users by their top group
     users_by_group = {}
     all_groups = set()
+    default_group = None
     
     for user in online_users:
         if user.profile:
-            top_group = user.profile.get_top_group
+            # Like get_top_group, but from the prefetched groups and without saving the profile
+            top_group = user.profile.top_group or max(user.profile.groups.all(), key=lambda group: group.priority, default=None)
+            if top_group is None:
+                if default_group is None:
+                    default_group = ForumGroup.objects.order_by('-priority').last()
+                top_group = default_group
+            if top_group is None:
+                continue
             all_groups.add(top_group)
             
             if top_group not in users_by_group:
@@ -0,0 +1,125 @@
+# forum/webhooks.py
+
+import logging
+import queue
+import threading
+import time
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# WebhookMiddleware used to start a thread with its own event loop and HTTP client (a new TCP+TLS connection) for each
+# request of a logged in user. Now the events are put in a bounded queue, and one worker thread per process sends them
+# with a pooled keep-alive client: the events waiting in the queue are sent together, in as few webhook calls as the
+# message size limit allows. When the queue is full (the webhook is down or too slow), the new events are dropped and
+# counted. get_dispatcher() gives the dispatcher of a webhook URL.
+
+# Events waiting to be sent, the next ones are dropped
+QUEUE_SIZE = 1000
+# How long the worker waits for more events before sending a batch
+BATCH_DELAY = 1.0 # seconds
+# Maximum size of the content of a webhook call (the limit of the Discord webhooks)
+MAX_CONTENT_LENGTH = 2000
+# Timeout of a webhook call
+REQUEST_TIMEOUT = 3.0 # seconds
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+class WebhookDispatcher:
+    """Sends the events of a webhook URL from one background thread, batched."""
+
+    def __init__(self, url, queue_size=QUEUE_SIZE, batch_delay=BATCH_DELAY, client=None):
+        self.url = url
+        self.batch_delay = batch_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.client = client or httpx.Client(timeout=REQUEST_TIMEOUT, limits=httpx.Limits(max_keepalive_connections=1))
+        self.sent = 0 # webhook calls
+        self.sent_events = 0
+        self.failed = 0
+        self.dropped = 0
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def send(self, username, content):
+        """Queue an event (never blocks). Returns False if it was dropped."""
+        try:
+            self.queue.put_nowait((username, content))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1 and not getattr(settings, 'DISABLE_CUSTOM_PRINTS', False):
+                logger.warning(f"Webhook queue is full, {self.dropped} tracking event(s) dropped so far")
+            return False
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True)
+                    self._worker.start()
+        return True
+
+    def get_stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'sent_events': self.sent_events,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+    def _next_batch(self):
+        """Wait for an event, then take all the events that come in the next batch_delay seconds."""
+        events = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_delay
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                events.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _make_payloads(self, events):
+        """Coalesce the events in as few payloads as possible (each content at most MAX_CONTENT_LENGTH long)."""
+        payloads = []
+        usernames, contents, length = [], [], 0
+        for username, content in events:
+            content = content[:MAX_CONTENT_LENGTH]
+            if contents and length + len(content) > MAX_CONTENT_LENGTH:
+                payloads.append(self._make_payload(usernames, contents))
+                usernames, contents, length = [], [], 0
+            usernames.append(username)
+            contents.append(content)
+            length += len(content)
+        if contents:
+            payloads.append(self._make_payload(usernames, contents))
+        return payloads
+
+    def _make_payload(self, usernames, contents):
+        username = usernames[0] if len(set(usernames)) == 1 else f"{len(contents)} requêtes"
+        return {'username': username, 'content': "".join(contents)}, len(contents)
+
+    def _run(self):
+        while True:
+            events = self._next_batch()
+            for payload, count in self._make_payloads(events):
+                try:
+                    response = self.client.post(self.url, json=payload)
+                    response.raise_for_status()
+                    self.sent += 1
+                    self.sent_events += count
+                except httpx.HTTPError as e:
+                    self.failed += 1
+                    if not getattr(settings, 'DISABLE_CUSTOM_PRINTS', False):
+                        logger.error(f"Failed to send tracking data to webhook: {e}")
+
+
+def get_dispatcher(url):
+    """Get the dispatcher of a webhook URL (one per process)."""
+    dispatcher = _dispatchers.get(url)
+    if dispatcher is None:
+        with _dispatchers_lock:
+            dispatcher = _dispatchers.get(url)
+            if dispatcher is None:
+                dispatcher = _dispatchers[url] = WebhookDispatcher(url)
+    return dispatcher
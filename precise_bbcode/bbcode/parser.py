@@ -1,6 +1,10 @@
 import re
 from collections import defaultdict
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import groupby
 
+from precise_bbcode.bbcode.regexes import tag_scanner_re
 from precise_bbcode.bbcode.regexes import url_re
 from precise_bbcode.conf import settings as bbcode_settings
 from precise_bbcode.core.utils import replace
@@ -17,6 +21,9 @@ class BBCodeToken(object):
     TK_DATA = 'data'
     TK_NEWLINE = 'newline'
 
+    # A long post produces thousands of tokens: no per-instance __dict__
+    __slots__ = ('type', 'tag_name', 'option', 'text')
+
     def __init__(self, type, tag_name, option, text):
         self.type = type
         self.tag_name = tag_name
@@ -54,6 +61,15 @@ class BBCodeToken(object):
         return self.type == self.TK_NEWLINE
 
 
+# A compiled smilies table:
+#   regex: finds the positions where a smiley code starts (the code is group 1)
+#   html: code -> HTML, with the replacements done by the following codes
+#   priority: code -> position in the substitution order
+#   codes_at: code matched by the regex -> codes matching at the same position
+#   exact: whether the substitutions can be done from the matches
+SmiliesMatcher = namedtuple('SmiliesMatcher', ['regex', 'html', 'priority', 'codes_at', 'exact'])
+
+
 class BBCodeParser(object):
     # BBCode tags are enclosed in square brackets [ and ] rather than < and > ; the following
     # constants should not be modified
@@ -65,12 +81,17 @@ class BBCodeParser(object):
         self.newline_char = bbcode_settings.BBCODE_NEWLINE
         self.replace_html = bbcode_settings.BBCODE_ESCAPE_HTML
         self.normalize_newlines = bbcode_settings.BBCODE_NORMALIZE_NEWLINES
+        self.max_nesting_depth = bbcode_settings.BBCODE_MAX_NESTING_DEPTH
+        self.max_tokens = bbcode_settings.BBCODE_MAX_TOKENS
 
         # Initializes the placeholders, bbcodes and smilies stores
         self.placeholders = {}
         self.bbcodes = {}
         self.smilies = {}
 
+        # Compiled smilies table (built on first use, and reset by add_smiley/remove_smiley)
+        self._smilies_matcher = None
+
     def add_placeholder(self, placeholder_klass):
         """
         Installs a placeholder. A placeholder is an instance of the BBCodePlaceholder
@@ -110,6 +131,14 @@ class BBCodeParser(object):
         available smilies.
         """
         self.smilies[code] = img
+        self._smilies_matcher = None
+
+    def remove_smiley(self, code):
+        """
+        Remove a smiley code from the dictionary containing the available smilies.
+        """
+        self.smilies.pop(code, None)
+        self._smilies_matcher = None
 
     def _parse_tag(self, tag):
         """
@@ -154,6 +183,90 @@ class BBCodeParser(object):
                 The content of the tag option if available, defaults to None
             Token text
                 The original text of the token
+
+        The input is scanned once with a precompiled regex (see 'tag_scanner_re'). The produced
+        token stream is exactly the one of the original str.find based lexer, which is kept as
+        '_get_tokens_reference' for the differential tests.
+        """
+        if self.normalize_newlines:
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+
+        tokens = []
+        append = tokens.append
+        bbcodes = self.bbcodes
+        Token = BBCodeToken
+        TK_DATA = BBCodeToken.TK_DATA
+        TK_NEWLINE = BBCodeToken.TK_NEWLINE
+
+        def add_text(text):
+            # Same as _get_textual_tokens, without the regex split for the (common) single-line case
+            if '\n' not in text:
+                append(Token(TK_DATA, None, None, text))
+                return
+            lines = text.split('\n')
+            last = len(lines) - 1
+            for i, line in enumerate(lines):
+                if line:
+                    append(Token(TK_DATA, None, None, line))
+                if i < last:
+                    append(Token(TK_NEWLINE, None, None, '\n'))
+
+        # A lone '[' after the last ']' can never start a tag: the original lexer stops there
+        last_tag_ending = data.rfind(self._TAG_ENDING)
+        pos = 0
+        for match in tag_scanner_re.finditer(data):
+            tag_start, tag_end = match.span()
+            previous_pos = pos
+            if tag_start > pos:
+                add_text(data[pos:tag_start])
+
+            if tag_end - tag_start > 1:
+                # A tag candidate: '[' + anything without brackets + ']'
+                tag = match.group()
+                name = tag[1:-1]
+                token = None
+                if '\n' not in name and '\r' not in name:
+                    name = name.strip()
+                    closing = name.startswith('/')
+                    if closing:
+                        name = name[1:]
+                    option = None
+                    if '=' in name:
+                        if not closing:
+                            name, option = name.split('=', 1)
+                        else:
+                            name = ''
+                    name = name.strip().lower()
+                    if name and name in bbcodes:
+                        if closing:
+                            token = Token(Token.TK_END_TAG, name, None, tag)
+                        else:
+                            token = Token(Token.TK_START_TAG, name, option, tag)
+                if token is not None:
+                    append(token)
+                else:
+                    add_text(tag)
+                pos = tag_end
+            elif tag_start < last_tag_ending:
+                # A '[' followed by another '[' before any ']': the text up to the next '[' will
+                # be tokenized as data on its own
+                pos = tag_start
+            else:
+                # An unmatched '[': like the original lexer, everything from the previous position
+                # is tokenized as data (even if a part of it has just been tokenized)
+                add_text(data[previous_pos:])
+                pos = len(data)
+                break
+
+        # Tokenize the remaining data
+        if pos < len(data):
+            add_text(data[pos:])
+        return tokens
+
+    def _get_tokens_reference(self, data):
+        """
+        The original str.find based lexer. It is not used for rendering anymore and is only kept as
+        a reference implementation for the differential tests of 'get_tokens'.
         """
         tokens = []
         pos = tag_start = tag_end = 0
@@ -226,63 +339,149 @@ class BBCodeParser(object):
         and converts them to textual tokens. The non-valid tokens must not be swallowed.
         The tag tokens that are not valid in the BBCode tree will be converted to textual tokens
         (eg. in '[b][i]test[/b][/i]'the 'b' tags will be tokenized as data).
+        The start tags that would be nested deeper than 'max_nesting_depth' are converted to
+        textual tokens as well (and so are their end tags, which do not match anything anymore).
         """
+        TK_START_TAG = BBCodeToken.TK_START_TAG
+        TK_END_TAG = BBCodeToken.TK_END_TAG
+        TK_NEWLINE = BBCodeToken.TK_NEWLINE
+        bbcodes = self.bbcodes
+        max_depth = self.max_nesting_depth
+
         opening_tags = []
+        # Number of occurrences of each tag name in opening_tags, so that checking whether a tag
+        # is opened does not need to scan the whole stack
+        opened_counts = defaultdict(int)
+
+        def pop_opening_tag():
+            tag = opening_tags.pop()
+            opened_counts[tag[0].tag_name] -= 1
+            return tag
+
         for index, token in enumerate(tokens):
-            if token.is_start_tag:
-                tag_options = self.bbcodes[token.tag_name]._options
-                if tag_options.same_tag_closes and len(opening_tags) > 0 \
+            token_type = token.type
+            if token_type == TK_START_TAG:
+                tag_options = bbcodes[token.tag_name]._options
+                if tag_options.same_tag_closes and opening_tags \
                         and opening_tags[-1][0].tag_name == token.tag_name:
-                    opening_tags.pop()
+                    pop_opening_tag()
                 if not tag_options.standalone:
+                    if max_depth and len(opening_tags) >= max_depth:
+                        tokens[index] = BBCodeToken(BBCodeToken.TK_DATA, None, None, token.text)
+                        continue
                     opening_tags.append((token, index))
-            elif token.is_end_tag:
-                tag_options = self.bbcodes[token.tag_name]._options
-                if len(opening_tags) > 0:
+                    opened_counts[token.tag_name] += 1
+            elif token_type == TK_END_TAG:
+                tag_options = bbcodes[token.tag_name]._options
+                if opening_tags:
                     previous_tag, _ = opening_tags[-1]
-                    previous_tag_options = self.bbcodes[previous_tag.tag_name]._options
+                    previous_tag_options = bbcodes[previous_tag.tag_name]._options
                     if previous_tag_options.end_tag_closes:
-                        opening_tags.pop()
+                        pop_opening_tag()
 
                     if not opening_tags:
                         continue
 
                     if (opening_tags[-1][0].tag_name != token.tag_name and
-                       token.tag_name in [x[0].tag_name for x in opening_tags] and
+                       opened_counts[token.tag_name] > 0 and
                        tag_options.render_embedded):
                         # In this case, we iterate to the first opening of the current tag : all the
                         # tags between the current tag and its opening are converted to textual
                         # tokens
-                        for tag in reversed(opening_tags):
-                            tk, index = tag
+                        while opening_tags:
+                            tk, tk_index = pop_opening_tag()
                             if tk.tag_name == token.tag_name:
-                                opening_tags.pop()
                                 break
-                            else:
-                                tokens[index] = BBCodeToken(
-                                    BBCodeToken.TK_DATA, None, None, tk.text)
-                                opening_tags.pop()
+                            tokens[tk_index] = BBCodeToken(
+                                BBCodeToken.TK_DATA, None, None, tk.text)
                     elif opening_tags[-1][0].tag_name != token.tag_name:
                         tokens[index] = BBCodeToken(BBCodeToken.TK_DATA, None, None, token.text)
                     else:
-                        opening_tags.pop()
+                        pop_opening_tag()
                 else:
                     tokens[index] = BBCodeToken(BBCodeToken.TK_DATA, None, None, token.text)
-            elif token.is_newline:
-                if len(opening_tags) > 0:
+            elif token_type == TK_NEWLINE:
+                if opening_tags:
                     previous_tag, _ = opening_tags[-1]
-                else:
-                    previous_tag = None
-                if previous_tag:
-                    previous_tag_options = self.bbcodes[previous_tag.tag_name]._options
+                    previous_tag_options = bbcodes[previous_tag.tag_name]._options
                     if previous_tag_options.newline_closes:
-                        opening_tags.pop()
+                        pop_opening_tag()
         # The remaining tags do not have a closing tag, they must be converted to testual tokens)
         for tag in opening_tags:
             token, index = tag
             tokens[index] = BBCodeToken(BBCodeToken.TK_DATA, None, None, token.text)
         return tokens
 
+    def _drop_tags_over_limit(self, tokens):
+        """
+        Converts the tag tokens found after the first 'max_tokens' tokens to textual tokens.
+        """
+        if self.max_tokens and len(tokens) > self.max_tokens:
+            for index in range(self.max_tokens, len(tokens)):
+                token = tokens[index]
+                if token.type == BBCodeToken.TK_START_TAG or token.type == BBCodeToken.TK_END_TAG:
+                    tokens[index] = BBCodeToken(BBCodeToken.TK_DATA, None, None, token.text)
+        return tokens
+
+    def _find_closing_positions(self, tokens):
+        """
+        Given a list of lexical tokens, computes for each (non standalone) start tag the position
+        of the token that closes it, in two linear passes. Returns a list with a tuple of the form
+        (end_pos, consume_now) at the index of each start tag (and None everywhere else).
+
+        The rules are the ones of '_find_closing_token', which scans the following tokens for each
+        tag: the first newline if the tag is closed by newlines, the first start tag of the same
+        name if the tag is closed by a similar tag, otherwise the end tag of the same name that
+        balances the similar start tags embedded in the tag. When the tag is rendered inside
+        another tag, the position is capped by the end of the parent tag.
+        """
+        TK_START_TAG = BBCodeToken.TK_START_TAG
+        TK_END_TAG = BBCodeToken.TK_END_TAG
+        TK_NEWLINE = BBCodeToken.TK_NEWLINE
+        bbcodes = self.bbcodes
+        tokens_count = len(tokens)
+        closing_positions = [None] * tokens_count
+
+        # Forward pass: the embedded similar tags are balanced with one stack per tag name
+        matching_ends = {}
+        similar_starts = defaultdict(list)
+        for index, token in enumerate(tokens):
+            if token.type == TK_START_TAG:
+                similar_starts[token.tag_name].append(index)
+            elif token.type == TK_END_TAG and similar_starts[token.tag_name]:
+                matching_ends[similar_starts[token.tag_name].pop()] = index
+
+        # Backward pass: the next newline, similar start tag and similar end tag of each token
+        next_newline = tokens_count
+        next_starts = {}
+        next_ends = {}
+        for index in range(tokens_count - 1, -1, -1):
+            token = tokens[index]
+            if token.type == TK_NEWLINE:
+                next_newline = index
+            elif token.type == TK_END_TAG:
+                next_ends[token.tag_name] = index
+            elif token.type == TK_START_TAG:
+                tag_options = bbcodes[token.tag_name]._options
+                if not tag_options.standalone:
+                    end_pos, consume_now = tokens_count, True
+                    if tag_options.newline_closes and next_newline < end_pos:
+                        end_pos = next_newline
+                    if tag_options.same_tag_closes:
+                        next_start = next_starts.get(token.tag_name, tokens_count)
+                        if next_start < end_pos:
+                            end_pos, consume_now = next_start, False
+                    if tag_options.same_tag_closes or not tag_options.render_embedded:
+                        # The similar start tags are not counted: the first similar end tag wins
+                        end_tag_pos = next_ends.get(token.tag_name, tokens_count)
+                    else:
+                        end_tag_pos = matching_ends.get(index, tokens_count)
+                    if end_tag_pos < end_pos:
+                        end_pos, consume_now = end_tag_pos, True
+                    closing_positions[index] = (end_pos, consume_now)
+                next_starts[token.tag_name] = index
+        return closing_positions
+
     def _print_lexical_token_stream(self, data):  # pragma: no cover
         """
         Given an input text, print out the lexical token stream.
@@ -328,6 +527,112 @@ class BBCodeParser(object):
         """
         Given a list of lexical tokens, do the rendering process. During this process, some
         semantic verifications are done on this lexical token stream.
+        The tags are matched once by '_find_closing_positions', and the embedded tags are rendered
+        with an explicit stack instead of recursive calls on slices of the token list, so that the
+        rendering time stays linear in the number of tokens.
+        """
+        TK_START_TAG = BBCodeToken.TK_START_TAG
+        TK_DATA = BBCodeToken.TK_DATA
+        TK_NEWLINE = BBCodeToken.TK_NEWLINE
+        bbcodes = self.bbcodes
+        closing_positions = self._find_closing_positions(tokens)
+
+        def finish_tag(tag, token, inner, parent_tag, token_end, end):
+            # Strip and replaces newlines if specified in the tag options
+            if tag._options.strip:
+                inner = inner.strip()
+            if tag._options.transform_newlines:
+                inner = inner.replace('\n', self.newline_char)
+
+            rendered_tag = tag.do_render(self, inner, token.option, parent_tag)
+
+            # Swallow the first trailing newline if necessary
+            if tag._options.swallow_trailing_newline:
+                next_itk = token_end + 1
+                if next_itk < end and tokens[next_itk].type == TK_NEWLINE:
+                    token_end = next_itk
+            return rendered_tag, token_end
+
+        # Each stacked frame is a tag whose embedded tokens are being rendered:
+        # (tag, token, token_end, rendered list of the parent, parent tag, end of the parent)
+        stack = []
+        rendered = []
+        itk = 0
+        end = len(tokens)
+        while True:
+            if itk >= end:
+                if not stack:
+                    break
+                # The embedded tokens of the current tag are rendered: go back to its parent
+                tag, token, token_end, parent_rendered, parent_tag, end = stack.pop()
+                rendered_tag, token_end = finish_tag(
+                    tag, token, ''.join(rendered), parent_tag, token_end, end)
+                rendered = parent_rendered
+                rendered.append(rendered_tag)
+                # Goto the token following the end tag
+                itk = token_end + 1
+                continue
+
+            # Fetch the considered token
+            token = tokens[itk]
+
+            # Try to render it according to its type
+            if token.type == TK_START_TAG:
+                # Fetch some data about the current tag
+                tag = bbcodes[token.tag_name]
+
+                if tag._options.standalone:
+                    rendered.append(tag.do_render(self, None, token.option, parent_tag))
+                else:
+                    # First find the closing tag associated with this tag (it cannot be outside
+                    # of the parent tag)
+                    token_end, consume_now = closing_positions[itk]
+                    if token_end >= end:
+                        token_end, consume_now = end, True
+                    embedded_start, embedded_end = itk + 1, token_end
+
+                    # If the end tag should not be consumed, back up one (after processing the
+                    # embedded tokens)
+                    if not consume_now:
+                        token_end -= 1
+
+                    if tag._options.render_embedded:
+                        # Render the embedded tokens first, the tag is rendered when they are done
+                        stack.append((tag, token, token_end, rendered, parent_tag, end))
+                        rendered = []
+                        parent_tag = tag
+                        itk = embedded_start
+                        end = embedded_end
+                        continue
+
+                    inner = self._render_textual_content(
+                        ''.join(tokens[i].text for i in range(embedded_start, embedded_end)),
+                        tag._options.escape_html, tag._options.replace_links,
+                        tag._options.render_embedded)
+                    rendered_tag, token_end = finish_tag(
+                        tag, token, inner, parent_tag, token_end, end)
+                    rendered.append(rendered_tag)
+
+                    # Goto the end tag index
+                    itk = token_end
+            elif token.type == TK_DATA:
+                replace_specialchars = parent_tag._options.escape_html if parent_tag else True
+                replace_links = parent_tag._options.replace_links if parent_tag else True
+                replace_smilies = parent_tag._options.render_embedded if parent_tag else True
+                rendered.append(self._render_textual_content(
+                    token.text, replace_specialchars, replace_links, replace_smilies))
+            elif token.type == TK_NEWLINE:
+                rendered.append(self.newline_char if parent_tag is None else token.text)
+
+            # Goto the next token!
+            itk += 1
+        return ''.join(rendered)
+
+    def _render_tokens_reference(self, tokens, parent_tag=None):
+        """
+        The original recursive renderer (it finds the closing tags with '_find_closing_token').
+        It is not used for rendering anymore and is only kept as a reference implementation for
+        the differential tests of '_render_tokens'.
         """
         itk = 0
         rendered = []
@@ -354,7 +659,7 @@ class BBCodeParser(object):
                         token_end -= 1
 
                     if tag._options.render_embedded:
-                        inner = self._render_tokens(embedded_tokens, parent_tag=tag)
+                        inner = self._render_tokens_reference(embedded_tokens, parent_tag=tag)
                     else:
                         inner = self._render_textual_content(
                             ''.join(tk.text for tk in embedded_tokens),
@@ -395,6 +700,122 @@ class BBCodeParser(object):
         """
         Given an input text, update it by replacing the HTML special characters, the links with
         their HTML corresponding tags and the smilies codes with the corresponding images.
+        The smilies codes are found in one pass using a table compiled once (see
+        '_get_smilies_matcher'), and the links regex is skipped when the text cannot contain a
+        link. The output is the one of '_render_textual_content_reference'.
+        """
+        if replace_specialchars:
+            data = replace(data, self.replace_html)
+
+        # Each alternative of url_re needs a '.' or a '://'
+        if replace_links and ('.' in data or '://' in data):
+            data = url_re.sub(self._link_replacement, data)
+
+        if replace_smilies and self.smilies:
+            matcher = self._smilies_matcher or self._get_smilies_matcher()
+            if matcher.exact:
+                data = self._substitute_smilies(data, matcher)
+            elif matcher.regex.search(data):
+                # The table cannot be applied from the matches: do the original substitutions, but
+                # only for the texts that contain at least one smiley code
+                data = replace(data, sorted(self.smilies.items(), reverse=True))
+
+        return data
+
+    def _substitute_smilies(self, data, matcher):
+        """
+        Replaces the smilies codes of a text using a compiled smilies table. The original
+        implementation replaces the codes one after the other, so an occurrence of a code is
+        replaced if it doesn't overlap an occurrence replaced before it: all the occurrences are
+        found in one pass, and then picked in the same order.
+        """
+        occurrences = []
+        for match in matcher.regex.finditer(data):
+            start = match.start()
+            # The codes matching at this position are the matched one and its prefixes
+            for code in matcher.codes_at[match.group(1)]:
+                occurrences.append((matcher.priority[code], start, code))
+        if not occurrences:
+            return data
+
+        occurrences.sort()
+        taken = bytearray(len(data))
+        replaced = []
+        for _, start, code in occurrences:
+            end = start + len(code)
+            if not any(taken[start:end]):
+                taken[start:end] = b'\x01' * len(code)
+                replaced.append((start, end, code))
+
+        replaced.sort()
+        pieces = []
+        last_end = 0
+        for start, end, code in replaced:
+            pieces.append(data[last_end:start])
+            pieces.append(matcher.html[code])
+            last_end = end
+        pieces.append(data[last_end:])
+        return ''.join(pieces)
+
+    @staticmethod
+    def _link_replacement(match):
+        url = match.group(0)
+        href = url if '://' in url else 'http://' + url
+        return '<a href="{0}">{1}</a>'.format(href, url)
+
+    def _get_smilies_matcher(self):
+        """
+        Compiles the smilies table into a SmiliesMatcher (see above). The original implementation
+        replaces the codes one after the other in reverse sorted order, including in the HTML of
+        the smilies already replaced, so the HTML of each code is stored with the replacements of
+        the codes coming after it already done.
+
+        The matches can only be used in place of the original substitutions if a code can never
+        appear across the boundaries of the HTML of a smiley replaced before it: otherwise the
+        matcher is not "exact", and its regex is only used to skip the texts without any smiley.
+        """
+        ordered_smilies = sorted(self.smilies.items(), reverse=True)
+        codes = [code for code, _ in ordered_smilies]
+
+        def straddles(code, html):
+            # Whether the code could match across the beginning or the end of the HTML
+            return html in code or any(html.endswith(code[:size]) or html.startswith(code[-size:])
+                                       for size in range(1, len(code)))
+
+        smilies_html = {}
+        exact = '' not in codes
+        for i, (code, html) in enumerate(ordered_smilies):
+            for later_code, later_html in ordered_smilies[i + 1:]:
+                if straddles(later_code, html):
+                    exact = False
+                html = html.replace(later_code, later_html)
+            smilies_html[code] = html
+
+        # Codes are tried in order, so the code matched at a position is the longest one and the
+        # other codes matching there are its prefixes
+        codes_at = {
+            code: [code] + [other for other in codes if other != code and code.startswith(other)]
+            for code in codes}
+
+        # The codes are grouped by first character (they are contiguous in reverse sorted order),
+        # otherwise re tries every alternative at every position of the text
+        alternatives = [
+            re.escape(first_char) + '(?:{})'.format('|'.join(re.escape(code[1:]) for code in group))
+            for first_char, group in groupby(codes, key=lambda code: code[:1])]
+
+        self._smilies_matcher = SmiliesMatcher(
+            regex=re.compile('(?=({}))'.format('|'.join(alternatives))),
+            html=smilies_html,
+            priority={code: i for i, code in enumerate(codes)},
+            codes_at=codes_at,
+            exact=exact,
+        )
+        return self._smilies_matcher
+
+    def _render_textual_content_reference(self, data, replace_specialchars, replace_links, replace_smilies):
+        """
+        The original implementation of '_render_textual_content'. It is not used for rendering
+        anymore and is only kept as a reference implementation for the differential tests.
         """
         if replace_specialchars:
             data = replace(data, self.replace_html)
@@ -415,6 +836,51 @@ class BBCodeParser(object):
         """
         Renders the given data by using the declared BBCodes tags.
         """
-        lexical_units = self._drop_syntactic_errors(self.get_tokens(data))
+        lexical_units = self._drop_syntactic_errors(self._drop_tags_over_limit(self.get_tokens(data)))
         rendered = self._render_tokens(lexical_units)
         return rendered
+
+    def render_plaintext(self, data):
+        """
+        Renders the given data as plain text (for text previews, notifications...), by calling the
+        'render_plaintext' method of the tags for each tag token. The tags are not matched like
+        for the HTML rendering: each tag token is converted on its own, except for the tags with
+        'plaintext_content' set, which get the text up to the first end tag that follows them.
+        """
+        TK_START_TAG = BBCodeToken.TK_START_TAG
+        TK_END_TAG = BBCodeToken.TK_END_TAG
+        bbcodes = self.bbcodes
+        tokens = self.get_tokens(data)
+
+        # Positions of the end tags of each tag, to find the first end tag following a start tag
+        end_positions = defaultdict(list)
+        for itk, token in enumerate(tokens):
+            if token.type == TK_END_TAG:
+                end_positions[token.tag_name].append(itk)
+
+        rendered = []
+        itk = 0
+        while itk < len(tokens):
+            token = tokens[itk]
+            if token.type == TK_START_TAG or token.type == TK_END_TAG:
+                tag = bbcodes[token.tag_name]
+                text = None
+                if tag.plaintext_content and token.type == TK_START_TAG:
+                    positions = end_positions[token.tag_name]
+                    index = bisect_right(positions, itk)
+                    if index < len(positions):
+                        token_end = positions[index]
+                        content = ''.join(tokens[i].text for i in range(itk + 1, token_end))
+                        text = tag.render_plaintext(self, token, content)
+                        if text is not None:
+                            # The content and the end tag are consumed
+                            itk = token_end
+                    else:
+                        text = tag.render_plaintext(self, token, None)
+                else:
+                    text = tag.render_plaintext(self, token)
+                rendered.append(token.text if text is None else text)
+            else:
+                rendered.append(token.text)
+            itk += 1
+        return ''.join(rendered)
@@ -5,6 +5,11 @@ import re
 url_re = re.compile(r'(?im)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\([^\s()<>]+\))+(?:\([^\s()<>]+\)|[^\s`!()\[\]{};:\'".,<>?]))')  # noqa
 
 
+# Tokenizer regex: matches a tag candidate (a '[' followed by the first ']' with no other bracket
+# in between) or, failing that, a lone '['
+tag_scanner_re = re.compile(r'\[[^\[\]]*\]|\[')
+
+
 # BBCode placeholder regexes
 placeholder_re = re.compile(r'{([a-zA-Z]+\d*=?[^\s\[\]\{\}=]*)}')
 placeholder_content_re = re.compile(r'^(?P<placeholder_name>[a-zA-Z]+)(\d*)(=[^\s\[\]\{\}=]*)?$')
@@ -108,6 +108,9 @@ class BBCodeTag(with_metaclass(BBCodeTagBase)):
     name = None
     definition_string = None
     format_string = None
+    # Whether 'render_plaintext' gets the content of the tag instead of being called for the start
+    # and end tags separately
+    plaintext_content = False
 
     def do_render(self, parser, value, option=None, parent=None):
         """
@@ -142,6 +145,23 @@ class BBCodeTag(with_metaclass(BBCodeTagBase)):
         # and the format string are not used.
         raise NotImplementedError
 
+    def render_plaintext(self, parser, token, content=None):
+        """
+        The render_plaintext function is used to transform a BBCode tag token to plain text (see
+        BBCodeParser.render_plaintext).
+
+            token
+                The start or end token of the tag.
+            content
+                Only for the start tokens of the tags with 'plaintext_content' set: the original text
+                up to the first end tag following the start tag, or None if there is none.
+
+        The returned text replaces the token (and the content and the end tag if a content was
+        given). If None is returned, the original text is kept. The default implementation removes
+        the tag tokens and keeps their content.
+        """
+        return ''
+
     def _render_default(self, parser, value, option=None, parent=None):
         placeholders = re.findall(placeholder_re, self.definition_string)
         # Get the format data
@@ -27,6 +27,12 @@ BBCODE_ALLOW_CUSTOM_TAGS = getattr(settings, 'BBCODE_ALLOW_CUSTOM_TAGS', True)
 BBCODE_NORMALIZE_NEWLINES = getattr(settings, 'BBCODE_NORMALIZE_NEWLINES', True)
 
 
+# Limits for pathological inputs: the tags nested deeper than BBCODE_MAX_NESTING_DEPTH and the
+# tags found after the first BBCODE_MAX_TOKENS tokens are rendered as text (0 disables a limit)
+BBCODE_MAX_NESTING_DEPTH = getattr(settings, 'BBCODE_MAX_NESTING_DEPTH', 100)
+BBCODE_MAX_TOKENS = getattr(settings, 'BBCODE_MAX_TOKENS', 50000)
+
+
 # Smileys options
 BBCODE_ALLOW_SMILIES = getattr(settings, 'BBCODE_ALLOW_SMILIES', True)
 SMILIES_UPLOAD_TO = getattr(settings, 'BBCODE_SMILIES_UPLOAD_TO', 'precise_bbcode/smilies')
@@ -198,6 +198,15 @@ class SmileyTag(models.Model):
         parser = get_parser()
         parser.add_smiley(self.code, self.html_code)
 
+    def delete(self, *args, **kwargs):
+        code = self.code
+        super(SmileyTag, self).delete(*args, **kwargs)
+
+        # Remove the deleted smiley from the BBCode parser pool of
+        # available smilies
+        parser = get_parser()
+        parser.remove_smiley(code)
+
     @property
     def html_code(self):
         """
@@ -70,5 +70,6 @@ eventSource.onmessage = function(event) {
 eventSource.onerror = function(err) {
     console.error("EventSource failed:", err);
     //createToast("La connexion avec le serveur de notifications a été perdue.", 15000);
-    eventSource.close();
+    // The browser reconnects by itself (after the "retry" delay sent by the server) with the id of the last
+    // notification received, and the server sends the missed ones
 };
\ No newline at end of file
@@ -233,6 +233,17 @@ else:
 # Archive pages cache timeout (12 hours in seconds)
 ARCHIVE_CACHE_TIMEOUT = 12 * 60 * 60  # 43200 seconds
 
+# Notifications kept for each user, to replay them when a notification stream reconnects (see forum/notifications.py)
+NOTIFICATION_STREAM_MAXLEN = int(os.getenv('NOTIFICATION_STREAM_MAXLEN', '100'))  # Notifications per user
+NOTIFICATION_STREAM_TTL = int(os.getenv('NOTIFICATION_STREAM_TTL', str(24 * 60 * 60)))  # Seconds after the last notification
+
+# Async views for the read paths of the hottest pages (see forum/views_async.py), only for an ASGI server: set by
+# entrypoint.sh for daphne. A WSGI server (runserver, gunicorn) keeps the sync views. Read once, from the environment.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+
+# Level from which the messages of safe_async_log are sent to Celery instead of the log queue (empty to disable)
+LOG_CELERY_LEVEL = os.getenv('LOG_CELERY_LEVEL', '')
+
 # Channel Layers configuration
 if DEVELOPMENT_MODE:
     if USE_REDIS_IN_DEV:
@@ -310,6 +321,22 @@ CELERY_BEAT_SCHEDULE = {
     #     'task': 'your_app.tasks.cleanup_expired_sessions',
     #     'schedule': crontab(minute=0, hour=2),  # Daily at 2 AM
     # },
+    'flush-topic-views': {
+        'task': 'forum.tasks.flush_topic_views',
+        'schedule': 60.0,  # Every minute (the views are buffered in Redis, see forum/view_counter.py)
+    },
+    'flush-presence': {
+        'task': 'forum.tasks.flush_presence',
+        'schedule': 60.0,  # Every minute (the activity of the users is buffered in Redis, see forum/presence.py)
+    },
+    'refresh-board-stats': {
+        'task': 'forum.tasks.refresh_board_stats',
+        'schedule': 60.0,  # Every minute (the snapshot of the headers and sidebars, see forum/board_stats.py)
+    },
+    'compact-read-statuses': {
+        'task': 'forum.tasks.compact_read_statuses',
+        'schedule': 24 * 60 * 60.0,  # Every day (the rows older than a read watermark, see forum/read_state.py)
+    },
 }
 
 
@@ -382,6 +409,12 @@ LOGGING = {
             'level': 'DEBUG' if DEVELOPMENT_MODE else 'INFO',
             'propagate': False,
         },
+        # The messages of safe_async_log, written by a listener thread (see forum/log_pipeline.py)
+        'forum.views': {
+            'handlers': ['console', 'file'] if DEVELOPMENT_MODE else ['file', 'error_file'],
+            'level': 'DEBUG' if DEVELOPMENT_MODE else 'INFO',
+            'propagate': False,
+        },
         'django': {
             'handlers': ['console', 'file'] if DEVELOPMENT_MODE else ['file', 'error_file'],
             'level': 'INFO',